@@ -4,7 +4,6 @@ This module is for exploring the implementation of the ETL thing
 import argparse
 import queue
 from core.registry import Job
-from queue import Empty
 from datetime import datetime, timezone, timedelta
 
 from core.logs import get_logger
@@ -58,34 +57,27 @@ if __name__ == "__main__":
     to = datetime(2020, 10, 27, 18, 0, 0, 0, timezone.utc)
     hist_job = Extract(job, {"from": to - timedelta(hours=2), "to": to})
     queues.history.put([hist_job])
-    keep_going = True
     """
-    keep_going = True
-    while keep_going:
-        try:
-            logger.debug("Retrieving Extract job")
-            extract_job = queues.extract.get()
+    logger.debug("Retrieving Extract jobs")
+    extract_jobs = queues.extract.get_many()
+    while extract_jobs:
+        for extract_job in extract_jobs:
             extraction_stage(extract_job, queues.transform)
-        except Empty:
-            logger.debug("No more stuff to Extract")
-            keep_going = False
+        extract_jobs = queues.extract.get_many()
+    logger.debug("No more stuff to Extract")
 
-    keep_going = True
-    while keep_going:
-        try:
-            logger.debug("Retrieving Transform job")
-            transform_job = queues.transform.get()  # type: Transform
+    logger.debug("Retrieving Transform jobs")
+    transform_jobs = queues.transform.get_many()
+    while transform_jobs:
+        for transform_job in transform_jobs:  # type: Transform
             transformation_stage(transform_job, queues.load)
-        except Empty:
-            logger.debug("No more stuff to Transform")
-            keep_going = False
+        transform_jobs = queues.transform.get_many()
+    logger.debug("No more stuff to Transform")
 
-    keep_going = True
-    while keep_going:
-        try:
-            logger.debug("Retrieving Load job")
-            load_job = queues.load.get()  # type: Load
+    logger.debug("Retrieving Load jobs")
+    load_jobs = queues.load.get_many()
+    while load_jobs:
+        for load_job in load_jobs:  # type: Load
             loading_stage(load_job)
-        except Empty:
-            logger.debug("No more stuff to Load")
-            keep_going = False
+        load_jobs = queues.load.get_many()
+    logger.debug("No more stuff to Load")
@@ -1,6 +1,8 @@
+import json
 from datetime import datetime, timedelta, timezone
+from itertools import chain
 from math import floor
-from typing import Any, Union
+from typing import Any, Iterable, Iterator, Union
 
 from core.etl import (
     AbstractQueue,
@@ -11,9 +13,18 @@ from core.etl import (
     Transform,
     Load,
     Job,
+    QueuePutError,
 )
+from core import metrics
+from core.checkpoints import Checkpoint
+from core.concurrency import Deadline, DeadlineExceeded
 from core.logs import get_logger
-from core.config import TIMEWINDOW_SIZE
+from core.config import (
+    TIMEWINDOW_SIZE,
+    FUSE_THRESHOLD,
+    PARTITION_MAX_BYTES,
+    PARTITION_MAX_ITEMS,
+)
 
 logger = get_logger(__name__)
 
@@ -42,38 +53,136 @@ def job_creation_stage(config_id: str, queue: AbstractQueue) -> None:
     queue.put(extract_jobs)
 
 
-def extraction_stage(extract_job: Extract, queue: AbstractQueue, is_historical=False):
-    # Perform an extraction
-    logger.debug(f"Starting extraction stage job {extract_job.job.id}")
-    extracted_data, to_datetime = run_extraction_job(extract_job)
-    if not extracted_data:
-        logger.info(
-            f"Job ID {extract_job.job.id} ({extract_job.job.name}): no new data"
-        )
-    else:
-        transform_jobs = create_transformation_job(extract_job, extracted_data)
-        queue.put(transform_jobs)
-    if not is_historical:
-        extract_job.update_extraction_datetime(to_datetime)
+def count_items(data: Any) -> int:
+    if not data:
+        return 0
+    return len(data) if isinstance(data, (list, tuple, dict)) else 1
+
+
+def extraction_stage(
+    extract_job: Extract,
+    queue: AbstractQueue,
+    is_historical=False,
+    deadline: Deadline = None,
+) -> int:
+    """
+    Returns the number of extracted items. Extractions that stop at their
+    checkpoint because of the deadline queue what they got so far and raise
+    DeadlineExceeded, the job's next delivery resumes them.
+    """
+    with metrics.record_stage("extraction", extract_job.job.id) as stage_metrics:
+        # Perform an extraction
+        logger.debug(f"Starting extraction stage job {extract_job.job.id}")
+        checkpoint = extract_job.open_checkpoint(deadline)
+        extracted_data, to_datetime = run_extraction_job(extract_job, checkpoint)
+        if isinstance(extracted_data, Iterator):
+            extracted_data = collect_if_fusable(extract_job, extracted_data)
+        if isinstance(extracted_data, Iterator):
+            # Lazily extracted data is partitioned as it is produced
+            try:
+                stage_metrics.items = stream_transformation_jobs(
+                    extract_job, extracted_data, queue, checkpoint=checkpoint
+                )
+            except QueuePutError:
+                # The redelivery resumes after the last queued partition
+                checkpoint.flush()
+                raise
+        else:
+            stage_metrics.items = count_items(extracted_data)
+            if extracted_data and should_fuse(extract_job, extracted_data):
+                fused_stage(extract_job, extracted_data)
+            elif extracted_data:
+                transform_jobs = create_transformation_job(extract_job, extracted_data)
+                queue.put(transform_jobs)
+            checkpoint.commit(stage_metrics.items)
+        if checkpoint.interrupted:
+            checkpoint.flush()
+            raise DeadlineExceeded(
+                f"Extraction of job {extract_job.job.id} stopped after "
+                f"{stage_metrics.items} items, it will resume from its checkpoint"
+            )
+        checkpoint.clear()
+        if not stage_metrics.items:
+            logger.info(
+                f"Job ID {extract_job.job.id} ({extract_job.job.name}): no new data"
+            )
+        if not is_historical:
+            extract_job.update_extraction_datetime(to_datetime)
+    return stage_metrics.items
 
 
 def transformation_stage(transform_job: Transform, queue: AbstractQueue) -> None:
-    logger.debug(f"Starting transformation job {transform_job.job.id}")
-    # Perform a transformation
-    transformed_data = run_transformation_job(transform_job)
+    with metrics.record_stage("transformation", transform_job.job.id) as stage_metrics:
+        logger.debug(f"Starting transformation job {transform_job.job.id}")
+        # Perform a transformation
+        transformed_data = run_transformation_job(transform_job)
+        stage_metrics.items = count_items(transformed_data)
+        if not transformed_data:
+            logger.info(
+                f"Job ID {transform_job.job.id} "
+                f"({transform_job.job.name}): no data to transform"
+            )
+        else:
+            load_jobs = create_loading_job(transform_job, transformed_data)
+            queue.put(load_jobs)
+
+
+def loading_stage(load_job: Load) -> None:
+    with metrics.record_stage("loading", load_job.job.id) as stage_metrics:
+        logger.debug(f"Starting loading job {load_job.job.id}")
+        stage_metrics.items = count_items(load_job.transformed_data)
+        run_loading_job(load_job)
+
+
+def should_fuse(extract_job: Extract, extracted_data: Any) -> bool:
+    """
+    Whether the extracted data is small enough to be transformed and loaded
+    without going through the queues
+    """
+    threshold = fuse_threshold(extract_job)
+    return threshold > 0 and item_size(extracted_data) <= threshold
+
+
+def fuse_threshold(extract_job: Extract) -> int:
+    threshold = extract_job.job.template.fuse_threshold
+    return FUSE_THRESHOLD if threshold is None else threshold
+
+
+def collect_if_fusable(
+    extract_job: Extract, extracted_data: Iterator
+) -> Union[list, Iterator]:
+    """
+    Lazily extracted data small enough to be fused, as a list. Anything bigger
+    is still an iterator and only the items read to find out are held.
+    """
+    threshold = fuse_threshold(extract_job)
+    if threshold <= 0:
+        return extracted_data
+    items = []
+    size = 0
+    for item in extracted_data:
+        items.append(item)
+        size += item_size(item)
+        if size > threshold:
+            return chain(items, extracted_data)
+    return items
+
+
+def fused_stage(extract_job: Extract, extracted_data: Any) -> None:
+    """Runs transformation and loading inline for the extracted data"""
+    logger.debug(f"Starting fused transformation and loading {extract_job.job.id}")
+    transform_job = Transform.build(extract_job.job, extracted_data)
+    with metrics.record_stage("transformation", extract_job.job.id) as stage_metrics:
+        transformed_data = run_transformation_job(transform_job)
+        stage_metrics.items = count_items(transformed_data)
     if not transformed_data:
         logger.info(
             f"Job ID {transform_job.job.id} "
             f"({transform_job.job.name}): no data to transform"
         )
-    else:
-        load_jobs = create_loading_job(transform_job, transformed_data)
-        queue.put(load_jobs)
-
-
-def loading_stage(load_job: Load) -> None:
-    logger.debug(f"Starting loading job {load_job.job.id}")
-    run_loading_job(load_job)
+        return
+    for load_job in create_loading_job(transform_job, transformed_data):
+        loading_stage(load_job)
 
 
 def create_extraction_jobs(config_id: str) -> Extract:
@@ -87,7 +196,7 @@ def create_extraction_jobs(config_id: str) -> Extract:
     """
     # Build a job object
     logger.debug(f"Retrieving job config {config_id}")
-    base_job = Job.get(_id=config_id)
+    base_job = Job.get_resolved(config_id)
 
     to = datetime.now(timezone.utc)
     since = base_job.last_run
@@ -114,41 +223,142 @@ def create_extraction_jobs(config_id: str) -> Extract:
     return extract_jobs
 
 
-def run_extraction_job(extract_job: Extract) -> Any:
+def run_extraction_job(extract_job: Extract, checkpoint: Checkpoint = None) -> Any:
     logger.info(f"Running Extract job {extract_job.job.id}")
-    extracted_data = extract_job.run()
+    extracted_data = extract_job.run(checkpoint)
     return extracted_data
 
 
-def create_transformation_job(extract_job: Extract, extracted_data: list) -> list:
+def item_size(item: Any) -> int:
+    """Size in bytes of the item once serialized"""
+    return len(json.dumps(item, default=str).encode())
+
+
+def iter_partitions(
+    data: Iterable,
+    max_items: int = PARTITION_MAX_ITEMS,
+    max_bytes: int = PARTITION_MAX_BYTES,
+) -> Iterator[list]:
+    """
+    Splits data in lists of at most max_items whose serialized size stays
+    under max_bytes. An item bigger than max_bytes gets a partition of its own.
+    """
+    partition: list = []
+    partition_bytes = 0
+    for item in data:
+        size = item_size(item)
+        if partition and partition_bytes + size > max_bytes:
+            yield partition
+            partition = []
+            partition_bytes = 0
+        partition.append(item)
+        partition_bytes += size
+        # Full partitions go out right away, data may still be coming
+        if len(partition) >= max_items:
+            yield partition
+            partition = []
+            partition_bytes = 0
+    if partition:
+        yield partition
+
+
+def partition_data(
+    data: Any,
+    max_items: int = PARTITION_MAX_ITEMS,
+    max_bytes: int = PARTITION_MAX_BYTES,
+) -> list:
     """
-    Creates a Transform job following and Extract job for the extracted data
+    Partitions list data as per iter_partitions, anything else is not
+    splittable and is returned as a single partition
+    """
+    if not isinstance(data, (list, tuple)):
+        return [data]
+    return list(iter_partitions(data, max_items, max_bytes))
+
+
+def create_transformation_job(
+    extract_job: Extract,
+    extracted_data: list,
+    partition_items: int = PARTITION_MAX_ITEMS,
+    partition_size: int = PARTITION_MAX_BYTES,
+) -> list:
+    """
+    Creates Transform jobs following and Extract job for the extracted data
 
     Params:
     =======
 
     :extract_job: Extract: The extract job after which to create the tramsform job
     :extracted_data: Any: The data to be transformed
+    :partition_items: int: Max amount of items per Transform job
     :partition_size: int: Data partition size in bytes
     """
     jobs = []
-    logger.info(f"Building a Transform job {extract_job.job.id}")
-    transform_job = Transform.build(extract_job.job, extracted_data)
-    jobs.append(transform_job)
+    for partition in partition_data(extracted_data, partition_items, partition_size):
+        transform_job = Transform.build(extract_job.job, partition)
+        jobs.append(transform_job)
+    logger.info(f"Built {len(jobs)} Transform jobs for job {extract_job.job.id}")
     return jobs
 
 
+def stream_transformation_jobs(
+    extract_job: Extract,
+    extracted_data: Iterator,
+    queue: AbstractQueue,
+    partition_items: int = PARTITION_MAX_ITEMS,
+    partition_size: int = PARTITION_MAX_BYTES,
+    checkpoint: Checkpoint = None,
+) -> int:
+    """
+    Queues a Transform job for each partition of the extracted data as soon
+    as it is complete, while the rest is still being extracted, and moves
+    checkpoint past the queued items.
+    Returns the number of extracted items.
+    """
+    items = 0
+    jobs = 0
+    for partition in iter_partitions(extracted_data, partition_items, partition_size):
+        # Raises QueuePutError if the partition isn't queued, so the
+        # checkpoint never moves past items that aren't in the queue
+        queue.put([Transform.build(extract_job.job, partition)])
+        items += len(partition)
+        jobs += 1
+        if checkpoint is not None:
+            checkpoint.commit(items)
+    logger.info(f"Built {jobs} Transform jobs for job {extract_job.job.id}")
+    return items
+
+
 def run_transformation_job(transform_job: Transform) -> Any:
     logger.debug(f"Running Transform job {transform_job.job.id}")
     transformed_data = transform_job.run()
     return transformed_data
 
 
-def create_loading_job(transform_job: Transform, transformed_data: Any) -> list:
+def create_loading_job(
+    transform_job: Transform,
+    transformed_data: Any,
+    partition_items: int = PARTITION_MAX_ITEMS,
+    partition_size: int = PARTITION_MAX_BYTES,
+) -> list:
+    """
+    Creates Load jobs for the transformed data
+
+    Params:
+    =======
+
+    :transform_job: Transform: The transform job after which to create the load job
+    :transformed_data: Any: The data to be loaded
+    :partition_items: int: Max amount of items per Load job
+    :partition_size: int: Data partition size in bytes
+    """
     jobs = []
-    logger.info(f"Building a Load job {transform_job.job.id}")
-    load_job = Load.build(transform_job.job, transformed_data)
-    jobs.append(load_job)
+    for partition in partition_data(
+        transformed_data, partition_items, partition_size
+    ):
+        load_job = Load.build(transform_job.job, partition)
+        jobs.append(load_job)
+    logger.info(f"Built {len(jobs)} Load jobs for job {transform_job.job.id}")
     return jobs
 
 
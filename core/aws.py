@@ -0,0 +1,108 @@
+"""
+Process wide pool of boto3 clients and resources.
+
+Lambda containers are reused between invocations, so anything kept at module
+level survives warm starts. Clients are thread safe and shared by every thread,
+resources are not, so those are pooled per thread.
+"""
+
+import threading
+
+import boto3
+import sqs_extended_client  # noqa: F401
+
+from core.logs import get_logger
+
+logger = get_logger(__name__)
+
+# Errors of S3 reads of missing keys. Without s3:ListBucket on the bucket S3
+# answers AccessDenied instead of NoSuchKey
+MISSING_OBJECT_CODES = frozenset({"NoSuchKey", "404", "AccessDenied", "403"})
+
+_lock = threading.Lock()
+_clients: dict = {}
+_local = threading.local()
+
+
+def get_client(service_name: str, region_name: str = None, endpoint_url: str = None):
+    """
+    Returns a pooled boto3 client for the service, region and endpoint,
+    creating it the first time it is requested
+    """
+    key = (service_name, region_name, endpoint_url)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                logger.debug(f"Creating {service_name} client")
+                client = boto3.client(
+                    service_name, region_name=region_name, endpoint_url=endpoint_url
+                )
+                _clients[key] = client
+    return client
+
+
+def get_extended_sqs_client(
+    large_payload_bucket: str,
+    message_size_threshold: int,
+    region_name: str = None,
+    endpoint_url: str = None,
+):
+    """
+    Returns a pooled SQS client sending messages bigger than
+    message_size_threshold bytes through large_payload_bucket. The extended
+    client reads its settings from client attributes, so each bucket and
+    threshold gets its own client, set up once when created.
+    """
+    key = (
+        "sqs",
+        region_name,
+        endpoint_url,
+        large_payload_bucket,
+        message_size_threshold,
+    )
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                logger.debug(f"Creating sqs client for bucket {large_payload_bucket}")
+                client = boto3.client(
+                    "sqs", region_name=region_name, endpoint_url=endpoint_url
+                )
+                client.large_payload_support = large_payload_bucket
+                client.message_size_threshold = message_size_threshold
+                client.always_through_s3 = False
+                _clients[key] = client
+    return client
+
+
+def get_resource(
+    service_name: str, region_name: str = None, endpoint_url: str = None
+):
+    """
+    Returns a boto3 resource for the service, region and endpoint pooled
+    for the calling thread
+    """
+    resources = getattr(_local, "resources", None)
+    if resources is None:
+        resources = _local.resources = {}
+    key = (service_name, region_name, endpoint_url)
+    resource = resources.get(key)
+    if resource is None:
+        logger.debug(f"Creating {service_name} resource")
+        with _lock:
+            # Session creation is not thread safe
+            resource = boto3.resource(
+                service_name, region_name=region_name, endpoint_url=endpoint_url
+            )
+        resources[key] = resource
+    return resource
+
+
+def clear_pool():
+    """Drops every pooled client and the calling thread resources"""
+    with _lock:
+        _clients.clear()
+    _local.resources = {}
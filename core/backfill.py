@@ -0,0 +1,110 @@
+"""
+Persisted backfill cursors.
+
+A backfill walks a job's history from ``until`` back to ``since`` one window
+at a time. Its state lives in the job row so that the history lambda only
+needs to know which window comes next, and so that backfills can be paused,
+resumed and resized without touching any queue. A backfill is leased to one
+invocation at a time, see Job.lease_backfill, so overlapping history lambdas
+don't extract the same windows.
+"""
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+ACTIVE = "active"
+PAUSED = "paused"
+DONE = "done"
+
+
+@dataclass
+class Backfill:
+    since: datetime
+    until: datetime
+    cursor: datetime
+    window_minutes: int
+    state: str = ACTIVE
+    # Until when an invocation holds the backfill
+    leased_until: Optional[datetime] = None
+
+    @classmethod
+    def start(
+        cls, days: int, window_minutes: int, now: datetime = None
+    ) -> "Backfill":
+        until = now or datetime.now(timezone.utc)
+        return cls(
+            since=until - timedelta(days=days),
+            until=until,
+            cursor=until,
+            window_minutes=window_minutes,
+        )
+
+    @property
+    def active(self) -> bool:
+        return self.state == ACTIVE
+
+    def next_window(self) -> Optional[dict]:
+        """
+        The window ending at the cursor, None when paused or finished
+        """
+        if not self.active or self.cursor <= self.since:
+            return None
+        left = max(self.cursor - timedelta(minutes=self.window_minutes), self.since)
+        return {"from": left, "to": self.cursor}
+
+    def next_windows(self, amount: int) -> List[dict]:
+        """The next amount windows, or less if the backfill ends before"""
+        planned = replace(self)
+        windows = []
+        while len(windows) < amount:
+            window = planned.next_window()
+            if window is None:
+                break
+            windows.append(window)
+            planned.advance(window)
+        return windows
+
+    def advance(self, window: dict) -> None:
+        """Moves the cursor past an extracted window"""
+        self.cursor = window["from"]
+        if self.cursor <= self.since:
+            self.state = DONE
+
+    def to_item(self) -> dict:
+        item = {
+            "since": self.since.isoformat(),
+            "until": self.until.isoformat(),
+            "cursor": self.cursor.isoformat(),
+            "window_minutes": self.window_minutes,
+            "state": self.state,
+        }
+        if self.leased_until is not None:
+            item["leased_until"] = self.leased_until.isoformat()
+        return item
+
+    @classmethod
+    def from_item(cls, item: dict) -> "Backfill":
+        return cls(
+            since=datetime.fromisoformat(item["since"]),
+            until=datetime.fromisoformat(item["until"]),
+            cursor=datetime.fromisoformat(item["cursor"]),
+            window_minutes=int(item["window_minutes"]),
+            state=item.get("state", ACTIVE),
+            leased_until=datetime.fromisoformat(item["leased_until"])
+            if item.get("leased_until")
+            else None,
+        )
+
+
+def pause(job) -> bool:
+    return job.update_backfill(expected_state=ACTIVE, state=PAUSED)
+
+
+def resume(job) -> bool:
+    return job.update_backfill(expected_state=PAUSED, state=ACTIVE)
+
+
+def resize(job, window_minutes: int) -> bool:
+    if window_minutes <= 0:
+        raise ValueError("window_minutes must be positive")
+    return job.update_backfill(window_minutes=window_minutes)
@@ -0,0 +1,101 @@
+"""
+In-process caches that survive warm Lambda invocations.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class TTLCache:
+    """
+    Bounded, thread safe LRU cache whose entries expire ttl seconds after
+    being set. A ttl of None keeps entries until they are evicted. With sizeof
+    the bound is on the summed size of the values, e.g. their bytes, instead
+    of on their count.
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: Optional[float] = None,
+        on_evict: Callable[[Any], None] = None,
+        sizeof: Callable[[Any], int] = None,
+    ):
+        """
+        Parameters
+        ----------
+        maxsize : int
+            entries, or summed sizes with sizeof, kept before evicting the
+            least recently used
+        ttl : float
+            seconds an entry is valid for
+        on_evict : callable
+            called with each value leaving the cache
+        sizeof : callable
+            size of a value, 1 per value when None
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _discard(self, key: Hashable):
+        _, value = self._entries.pop(key)
+        self.size -= self.sizeof(value)
+        if self.on_evict:
+            self.on_evict(value)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                self._discard(key)
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.maxsize <= 0 or self.ttl == 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if key in self._entries:
+                self._discard(key)
+            # Would evict everything else and then itself
+            if self.sizeof(value) > self.maxsize:
+                return
+            self._entries[key] = (expires_at, value)
+            self.size += self.sizeof(value)
+            while self.size > self.maxsize:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._discard(key)
+
+    def purge_expired(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            expired = [
+                key
+                for key, (expires_at, _) in self._entries.items()
+                if expires_at is not None and expires_at <= now
+            ]
+            for key in expired:
+                self._discard(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            for key in list(self._entries):
+                self._discard(key)
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,89 @@
+"""
+Registry of the catalog callables used by the jobs.
+
+Catalog paths like ``misp_automated.misp.extraction.pull_feeds`` are resolved
+against ``core.catalog`` once per process and kept here, so building a job
+(or deserializing one from a queue) is a dictionary lookup.
+"""
+import importlib
+import inspect
+import threading
+from typing import Callable, Iterable, List
+
+from core.logs import get_logger
+
+logger = get_logger(__name__)
+
+_callables: dict = {}
+_lock = threading.Lock()
+
+
+def resolve_callable(callable_path: str) -> Callable:
+    """Imports the module and gets the callable from it, once"""
+    job_callable = _callables.get(callable_path)
+    if job_callable is None:
+        with _lock:
+            job_callable = _callables.get(callable_path)
+            if job_callable is None:
+                # TODO: sanitization of the code is critical here. What are we loading?
+                exploded_path = ["core", "catalog"]
+                exploded_path.extend(callable_path.split("."))
+                module = importlib.import_module(".".join(exploded_path[:-1]))
+                job_callable = getattr(module, exploded_path[-1])
+                _callables[callable_path] = job_callable
+    return job_callable
+
+
+def takes_argument(job_callable: Callable, name: str) -> bool:
+    """Whether the callable has a parameter called name"""
+    try:
+        return name in inspect.signature(job_callable).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def prewarm(callable_paths: Iterable[str]) -> List[str]:
+    """
+    Resolves the given paths ahead of time
+
+    Returns
+    -------
+    list
+        The paths that could not be resolved
+    """
+    failed = []
+    for callable_path in set(callable_paths):
+        try:
+            resolve_callable(callable_path)
+        except Exception as ex:
+            logger.warning(f"Unable to resolve {callable_path}: {ex}")
+            failed.append(callable_path)
+    return failed
+
+
+def prewarm_templates() -> List[str]:
+    """
+    Resolves every callable referenced by the templates. Meant to be called
+    at Lambda init, failures are logged and never raised.
+
+    Returns
+    -------
+    list
+        The paths that could not be resolved
+    """
+    from core.registry import Template
+
+    try:
+        templates = Template.all()
+    except Exception as ex:
+        logger.warning(f"Unable to list templates for prewarming: {ex}")
+        return []
+    paths = []
+    for template in templates:
+        paths.extend((template.extract, template.transform, template.load))
+    return prewarm(paths)
+
+
+def clear_callables():
+    with _lock:
+        _callables.clear()
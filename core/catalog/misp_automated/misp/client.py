@@ -0,0 +1,14 @@
+from pymisp import PyMISP
+
+from core.http import throttled_session
+
+
+def build_client(url: str, key: str, ssl, conf: dict) -> PyMISP:
+    """
+    PyMISP client whose API calls go through the throttled HTTP layer,
+    paced as set by rate_limit in conf
+    """
+    client = PyMISP(url=url, key=key, ssl=ssl)
+    # PyMISP keeps a single private session for all its calls
+    throttled_session(key, conf, session=client._PyMISP__session)
+    return client
@@ -1,14 +1,20 @@
 from datetime import datetime, timedelta, timezone
+from functools import partial
 from pymisp import PyMISP, PyMISPError
 
+from core.catalog.misp_automated.misp.client import build_client
+from core.checkpoints import Checkpoint
 from core.registry import Job
 from core.logs import get_logger
 from core.config import TIMEWINDOW_SIZE
+from core.windows import iter_bisecting, pull_bisecting
 
 
 logger = get_logger(__name__)
 
 MAX_PULL_REPORTS = 500
+# MISP timestamps are in seconds
+TIMESTAMP_RESOLUTION = timedelta(seconds=1)
 
 
 class FeedClient:
@@ -19,10 +25,11 @@ class FeedClient:
 
     def get_misp_client(self):
         # Initializing MISP connection
-        misp_conn = PyMISP(
+        misp_conn = build_client(
             url=self.job.user_conf.source_conf.get("url"),
             key=self.job.user_conf.source_secrets.get("key"),
             ssl=self.job.user_conf.source_conf.get("verify_server_cert", False),
+            conf=self.job.user_conf.source_conf,
         )
 
         if misp_conn and hasattr(misp_conn, "get_version"):
@@ -47,7 +54,10 @@ class FeedClient:
                 f"Searching MISP Events from {since.isoformat()} to {to.isoformat()}"
             )
             response = misp_conn.search(
-                timestamp=(since, to), tag=not_this_tags, pythonify=True,
+                timestamp=(since, to),
+                tag=not_this_tags,
+                limit=MAX_PULL_REPORTS,
+                pythonify=True,
             )
         except PyMISPError as pyexe:
             logger.error(f"MISP Communication Error : {pyexe}")
@@ -56,6 +66,9 @@ class FeedClient:
         finally:
             return response
 
+    def query_events(self, misp_conn: PyMISP, since: datetime, to: datetime):
+        return self.clean_response(self.query_misp(misp_conn, since, to)) or []
+
     @staticmethod
     def clean_response(response):
         results = None
@@ -76,37 +89,51 @@ class FeedClient:
     def get_current_datetime(self):
         return datetime.now(timezone.utc)
 
-    def pull_feeds(self):
+    def get_window(self):
+        """The job's timewindow or, without one, the window since the last run"""
+        window = self.job.user_conf.source_conf.get("timewindow", None)
+        if window:
+            return window["from"], window["to"]
+        # If there is no timewindow build one of 5 minutes or less
+        to = self.get_current_datetime()
+        since = self.job.last_run
+        if not since:
+            since = to - self.TIME_DELTA
+        elif (to - since) > timedelta(minutes=TIMEWINDOW_SIZE):
+            to = since + self.TIME_DELTA
+        return since, to
+
+    def get_expected_events(self) -> float:
+        """Events the timewindow is expected to hold, 0 when unknown"""
+        window = self.job.user_conf.source_conf.get("timewindow") or {}
+        return window.get("expected_items", 0)
+
+    def pull_feeds(self, checkpoint: Checkpoint = None):
         """
         Pulls MISP Events.
         It exclude al events tagged as TruSTAR
         Additionally checks that the Event is not an Enclave Event
+        With a checkpoint the events are returned lazily, see iter_feeds.
         """
         results = None
         to = None
         try:
             misp_client = self.get_misp_client()
-            window = self.job.user_conf.source_conf.get("timewindow", None)
-            if window:
-                to = window["to"]
-                since = window["from"]
-            else:
-                # If there is no timewindow build one of 5 minutes or less
-                to = self.get_current_datetime()
-                since = self.job.last_run
-                if not since:
-                    since = to - self.TIME_DELTA
-                elif (to - since) > timedelta(minutes=TIMEWINDOW_SIZE):
-                    to = since + self.TIME_DELTA
-
-            # Fetch MISP events data
-            response = self.query_misp(misp_client, since, to)
-            if response:
-                results = self.clean_response(response)
-                # Sort data list based on timestamp column. Latest events on top
-                results = sorted(results, key=lambda k: k.timestamp, reverse=True)
-            else:
-                results = []
+            if checkpoint is not None:
+                return self.iter_feeds(misp_client, checkpoint)
+            since, to = self.get_window()
+
+            # Fetch MISP events data, windows with MAX_PULL_REPORTS are split
+            results = pull_bisecting(
+                partial(self.query_events, misp_client),
+                since,
+                to,
+                MAX_PULL_REPORTS,
+                resolution=TIMESTAMP_RESOLUTION,
+                expected=self.get_expected_events(),
+            )
+            # Sort data list based on timestamp column. Latest events on top
+            results = sorted(results, key=lambda k: k.timestamp, reverse=True)
 
         except Exception as ex:
             logger.error(f"Could not query on MISP Client Error: {ex}")
@@ -114,11 +141,47 @@ class FeedClient:
         else:
             return [r.to_json() for r in results], to
 
+    def iter_feeds(self, misp_client: PyMISP, checkpoint: Checkpoint):
+        """
+        Events of the window one split of it at a time, oldest split first
+        and latest events on top within each. A delivery after one that
+        stopped at its checkpoint starts from the first split left.
+        """
+        expected = 0
+        if checkpoint.resumed:
+            since = datetime.fromisoformat(checkpoint.state["since"])
+            to = datetime.fromisoformat(checkpoint.state["to"])
+        else:
+            since, to = self.get_window()
+            expected = self.get_expected_events()
+        windows = iter_bisecting(
+            partial(self.query_events, misp_client),
+            since,
+            to,
+            MAX_PULL_REPORTS,
+            resolution=TIMESTAMP_RESOLUTION,
+            expected=expected,
+        )
+        steps = (
+            (
+                [
+                    r.to_json()
+                    for r in sorted(results, key=lambda k: k.timestamp, reverse=True)
+                ],
+                {
+                    "since": (window["to"] + TIMESTAMP_RESOLUTION).isoformat(),
+                    "to": to.isoformat(),
+                },
+            )
+            for window, results in windows
+        )
+        return checkpoint.iter_steps(steps), to
+
 
-def pull_feeds(job: Job):
+def pull_feeds(job: Job, checkpoint: Checkpoint = None):
     try:
         feed_client = FeedClient(job)
-        results, to_datetime = feed_client.pull_feeds()
+        results, to_datetime = feed_client.pull_feeds(checkpoint)
         return results, to_datetime
     except Exception as ex:
         logger.error(f"Failed to pull feed for job {job.id}")
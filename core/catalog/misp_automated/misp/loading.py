@@ -1,6 +1,7 @@
-from pymisp import PyMISP, MISPEvent
+from pymisp import MISPEvent
 from trustar.models.enclave import Enclave, EnclavePermissions
 
+from core.catalog.misp_automated.misp.client import build_client
 from core.registry import Job
 from core.etl import Load
 from core.logs import get_logger
@@ -16,8 +17,8 @@ class MISPLoader:
     def _build_client(self):
         conf = self.job.user_conf.destination_conf
         secret = self.job.user_conf.destination_secrets
-        self.client = PyMISP(
-            url=conf["url"], key=secret["key"], ssl=conf.get("ssl", True)
+        self.client = build_client(
+            url=conf["url"], key=secret["key"], ssl=conf.get("ssl", True), conf=conf
         )
 
     @staticmethod
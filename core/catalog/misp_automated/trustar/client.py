@@ -0,0 +1,142 @@
+import copy
+import hashlib
+import json
+import threading
+
+from requests import HTTPError, Session
+from requests.auth import HTTPBasicAuth
+from trustar import TruStar
+from trustar.api_client import ApiClient
+
+from core.cache import TTLCache
+from core.config import REGISTRY_CACHE_SIZE, TRUSTAR_CLIENT_TTL
+from core.http import throttled_session
+from core.logs import get_logger
+
+logger = get_logger(__name__)
+
+# Conf keys that change from one job to another without affecting the client
+POOL_IGNORED_KEYS = frozenset({"timewindow"})
+
+
+class SessionApiClient(ApiClient):
+    """
+    ApiClient sending its requests through a session. Throttling and retries
+    are left to the session adapters, see core.http.
+    """
+
+    session: Session = None
+    _token_lock: threading.Lock = None
+
+    def _refresh_token(self):
+        """
+        Gets a new OAuth2 token through the session. Threads sharing the
+        client that saw the same expired token only get one.
+        """
+        expired = self.token
+        with self._token_lock:
+            if self.token is not None and self.token != expired:
+                return
+            response = self.session.post(
+                self.auth,
+                auth=HTTPBasicAuth(self.api_key, self.api_secret),
+                data={"grant_type": "client_credentials"},
+                verify=self.verify,
+                proxies=self.proxies,
+            )
+            self.last_response = response
+            if 400 <= response.status_code < 600:
+                kind = "Client" if response.status_code < 500 else "Server"
+                raise HTTPError(
+                    f"{response.status_code} {kind} Error "
+                    f"(Trace-Id: {self._get_trace_id(response)}): "
+                    "unable to get token",
+                    response=response,
+                )
+            self.token = response.json()["access_token"]
+
+    def _send(self, method, path, headers=None, params=None, data=None, **kwargs):
+        request_headers = self._get_headers(is_json=method in ["POST", "PUT"])
+        if headers is not None:
+            request_headers.update(headers)
+        response = self.session.request(
+            method=method,
+            url=f"{self.base}/{path}",
+            headers=request_headers,
+            verify=self.verify,
+            params=params,
+            data=data,
+            proxies=self.proxies,
+            **kwargs,
+        )
+        self.last_response = response
+        return response
+
+    def request(self, method, path, headers=None, params=None, data=None, **kwargs):
+        response = self._send(method, path, headers, params, data, **kwargs)
+        if self._is_expired_token_response(response):
+            self._refresh_token()
+            response = self._send(method, path, headers, params, data, **kwargs)
+
+        if 400 <= response.status_code < 600:
+            try:
+                reason = response.json()["message"]
+            except Exception:
+                reason = "unknown cause"
+            kind = "Client" if response.status_code < 500 else "Server"
+            raise HTTPError(
+                f"{response.status_code} {kind} Error "
+                f"(Trace-Id: {self._get_trace_id(response)}): {reason}",
+                response=response,
+            )
+        return response
+
+
+def build_client(conf: dict) -> TruStar:
+    """
+    TruStar client whose API calls go through the throttled HTTP layer,
+    paced as set by rate_limit in conf
+    """
+    client = TruStar(config=conf)
+    api_client = copy.copy(client._client)
+    api_client.__class__ = SessionApiClient
+    api_client.session = throttled_session(api_client.api_key, conf)
+    api_client._token_lock = threading.Lock()
+    client._client = api_client
+    return client
+
+
+def _close(client: TruStar) -> None:
+    client._client.session.close()
+
+
+# Clients, with their token and open connections, kept across invocations
+_clients = TTLCache(REGISTRY_CACHE_SIZE, TRUSTAR_CLIENT_TTL, on_evict=_close)
+
+
+def conf_hash(conf: dict) -> str:
+    """Hash of the conf keys that make up a client, secrets included"""
+    relevant = {k: v for k, v in conf.items() if k not in POOL_IGNORED_KEYS}
+    return hashlib.sha256(
+        json.dumps(relevant, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def get_client(user_conf_id: str, conf: dict, secrets: dict) -> TruStar:
+    """
+    The pooled client of a user conf, built the first time it's asked for
+    or after its conf or secrets change. Neither conf nor secrets are
+    modified.
+    """
+    client_conf = {**conf, **secrets}
+    key = (user_conf_id, conf_hash(client_conf))
+    client = _clients.get(key)
+    if client is None:
+        logger.debug(f"Building TruSTAR client for user conf {user_conf_id}")
+        client = build_client(client_conf)
+        _clients.set(key, client)
+    return client
+
+
+def clear_clients() -> None:
+    _clients.clear()
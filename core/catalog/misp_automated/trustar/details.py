@@ -0,0 +1,76 @@
+"""
+Cache of TruSTAR report details.
+
+Details are keyed by report id and updated timestamp, so a report listed again
+by an overlapping window, a backfill or a retry is only fetched again once it
+changes. Entries are kept serialized in an in-process LRU bounded by their
+bytes, report bodies vary too much for a count to bound the memory used, and,
+when a bucket is set, in S3 objects shared by every container. Keys include
+the user conf id so that users never read details fetched with someone else's
+key.
+"""
+import json
+from typing import Optional, Tuple
+
+import botocore
+from trustar import Report
+
+from core.aws import MISSING_OBJECT_CODES, get_client
+from core.cache import TTLCache
+from core.config import REPORT_DETAILS_BUCKET, REPORT_DETAILS_CACHE_BYTES
+from core.logs import get_logger
+
+logger = get_logger(__name__)
+
+
+class ReportDetailsCache:
+    def __init__(
+        self, maxbytes: int, bucket: str = None, prefix: str = "report-details"
+    ):
+        self._local = TTLCache(maxbytes, sizeof=len)
+        self.bucket = bucket
+        self.prefix = prefix
+
+    @staticmethod
+    def key(user_conf_id: str, report) -> Optional[Tuple]:
+        """None for reports that can't tell whether they changed"""
+        if not report.id or report.updated is None:
+            return None
+        return user_conf_id, report.id, report.updated
+
+    def _object_key(self, key: Tuple) -> str:
+        return "/".join((self.prefix, *map(str, key))) + ".json"
+
+    def get(self, key: Tuple) -> Optional[Report]:
+        body = self._local.get(key)
+        if body is None and self.bucket:
+            try:
+                response = get_client("s3").get_object(
+                    Bucket=self.bucket, Key=self._object_key(key)
+                )
+                body = response["Body"].read()
+            except botocore.exceptions.ClientError as ex:
+                if ex.response["Error"]["Code"] not in MISSING_OBJECT_CODES:
+                    logger.warning(f"Unable to read cached report details: {ex}")
+                return None
+            self._local.set(key, body)
+        return Report.from_dict(json.loads(body)) if body is not None else None
+
+    def set(self, key: Tuple, details: Report) -> None:
+        body = json.dumps(details.to_dict()).encode()
+        self._local.set(key, body)
+        if not self.bucket:
+            return
+        try:
+            get_client("s3").put_object(
+                Bucket=self.bucket, Key=self._object_key(key), Body=body
+            )
+        except botocore.exceptions.ClientError as ex:
+            logger.warning(f"Unable to cache report details: {ex}")
+
+    def clear(self) -> None:
+        """Clears the in-process entries only"""
+        self._local.clear()
+
+
+report_details = ReportDetailsCache(REPORT_DETAILS_CACHE_BYTES, REPORT_DETAILS_BUCKET)
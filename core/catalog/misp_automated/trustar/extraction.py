@@ -1,14 +1,34 @@
+from contextlib import closing
 from datetime import datetime, timedelta, timezone
+from functools import partial
+from itertools import chain
+from typing import Dict, Iterable, Iterator, List, Tuple
 
-from trustar import TruStar, datetime_to_millis
+from trustar import Report, datetime_to_millis
 
+from core.cache import TTLCache
+from core.checkpoints import Checkpoint
+from core.catalog.misp_automated.trustar.client import get_client
+from core.catalog.misp_automated.trustar.details import report_details
 from core.registry import Job
 from core.logs import get_logger
-from core.config import TIMEWINDOW_SIZE
-
+from core.concurrency import bounded_map, prefetch
+from core.config import (
+    ENCLAVES_CACHE_TTL,
+    EXTRACTION_MAX_IN_FLIGHT,
+    IOC_METADATA_CHUNK_SIZE,
+    PAGE_PREFETCH,
+    REGISTRY_CACHE_SIZE,
+    TIMEWINDOW_SIZE,
+)
+from core.pages import iter_pages
+from core.windows import pull_bisecting
 
 logger = get_logger(__name__)
 
+# Enclaves of each user conf, listing them is the same call on every run
+_enclaves = TTLCache(REGISTRY_CACHE_SIZE, ENCLAVES_CACHE_TTL)
+
 
 class StationExtractor:
     """
@@ -23,58 +43,78 @@ class StationExtractor:
         self._build_client()
 
     def _build_client(self):
-        ts_conf = self.job.user_conf.source_conf
-        ts_conf.update(self.job.user_conf.source_secrets)
-        self.client = TruStar(config=ts_conf)
+        user_conf = self.job.user_conf
+        self.client = get_client(
+            user_conf.id, user_conf.source_conf, user_conf.source_secrets
+        )
 
     def get_current_datetime(self):
         return datetime.now(timezone.utc)
 
-    def get_reports(self):
-        """
-        Submits a new report to TruSTAR.
-        :param report: a Report object
-        :return: None
-        """
-        to = None
-        since = None
-        results = []
-        try:
-            window = self.job.user_conf.source_conf.get("timewindow", None)
-            if window:
-                to = window["to"]
-                since = window["from"]
-            else:
-                # If there is no timewindow build one of 5 minutes or less
-                to = self.get_current_datetime()
-                since = self.job.last_run
-                if not since:
-                    since = to - self.TIME_DELTA
-                elif (to - since) > timedelta(minutes=TIMEWINDOW_SIZE):
-                    to = since + self.TIME_DELTA
-
-            reports = self.consume_all_report_pages(since, to)
-            logger.info(f"Got {len(reports)} since {since}")
-
-            # https://docs.trustar.co/api/v13/reports/get_report_details.html
-            logger.debug("Getting reports details")
-            for report in reports:
-                try:
-                    logger.debug(f"Getting details for report {report.id}")
-                    full_report = self.client.get_report_details(report.id)
-                    results.append(full_report)
-                except Exception as e:
-                    logger.warning(e)
-                    results.append(report)
-        except Exception as e:
-            logger.error(e)
-        finally:
-            return results, to
+    def get_window(self):
+        """The job's timewindow or, without one, the window since the last run"""
+        window = self.job.user_conf.source_conf.get("timewindow", None)
+        if window:
+            return window["from"], window["to"]
+        # If there is no timewindow build one of 5 minutes or less
+        to = self.get_current_datetime()
+        since = self.job.last_run
+        if not since:
+            since = to - self.TIME_DELTA
+        elif (to - since) > timedelta(minutes=TIMEWINDOW_SIZE):
+            to = since + self.TIME_DELTA
+        return since, to
+
+    def get_expected_reports(self) -> float:
+        """Reports the timewindow is expected to hold, 0 when unknown"""
+        window = self.job.user_conf.source_conf.get("timewindow") or {}
+        return window.get("expected_items", 0)
+
+    def get_report_summaries(self, since, to):
+        # Busy windows are split rather than truncated at MAX_REPORT_COUNT
+        reports = pull_bisecting(
+            self.consume_all_report_pages,
+            since,
+            to,
+            self.MAX_REPORT_COUNT,
+            expected=self.get_expected_reports(),
+        )
+        logger.info(f"Got {len(reports)} since {since}")
+        return reports
+
+    def get_max_in_flight(self) -> int:
+        """Per report calls made at once, max_in_flight in the source conf"""
+        return int(
+            self.job.user_conf.source_conf.get("max_in_flight")
+            or EXTRACTION_MAX_IN_FLIGHT
+        )
+
+    def get_report_details(self, report):
+        """Details of the report, only requested if it changed since cached"""
+        key = report_details.key(self.job.user_conf.id, report)
+        details = report_details.get(key) if key else None
+        if details is None:
+            logger.debug(f"Getting details for report {report.id}")
+            details = self.client.get_report_details(report.id)
+            if key:
+                report_details.set(key, details)
+        return details
 
     def is_report_fully_processed(self, report):
         result = self.client.get_report_status(report)
         return result["status"] == "SUBMISSION_SUCCESS"
 
+    def iter_report_pages(self, from_time, to_time=None):
+        return iter_pages(
+            lambda page: self.client.search_reports_page(
+                enclave_ids=self.job.user_conf.source_conf.get("enclave_ids"),
+                from_time=datetime_to_millis(from_time),
+                to_time=datetime_to_millis(to_time) if to_time else None,
+                page_size=100,
+                page_number=page,
+            )
+        )
+
     def consume_all_report_pages(self, from_time, to_time=None, max_report_count=None):
         logger.debug(
             f"Pulling reports from {from_time.isoformat()}"
@@ -83,35 +123,20 @@ class StationExtractor:
         if not max_report_count:
             max_report_count = self.MAX_REPORT_COUNT
         reports = []
-        page = 0
-        there_is_more = True
-        while there_is_more:
-            response = self.client.search_reports_page(
-                enclave_ids=self.job.user_conf.source_conf.get("enclave_ids"),
-                from_time=datetime_to_millis(from_time),
-                to_time=datetime_to_millis(to_time) if to_time else None,
-                page_size=100,
-                page_number=page,
-            )
-            if response.items:
-                reports.extend(response.items)
-
-            if not response.items:
-                # stop if there are no more reports
-                there_is_more = False
-                logger.debug("No more items")
-            elif len(reports) >= max_report_count:
-                # stop if we reached the maximum allowed number of reports
-                logger.debug(
-                    f"Report pull limit reached for "
-                    f"job {self.job.id} {self.job.description}"
-                )
-                there_is_more = False
-                reports = reports[:max_report_count]
-            else:
-                # ask the pagination if there are more
-                there_is_more = response.has_more_pages()
-            page += 1
+        # The next page is requested while the current one is being handled
+        with closing(
+            prefetch(self.iter_report_pages(from_time, to_time), PAGE_PREFETCH)
+        ) as pages:
+            for page in pages:
+                reports.extend(page)
+                if len(reports) >= max_report_count:
+                    # stop if we reached the maximum allowed number of reports
+                    logger.debug(
+                        f"Report pull limit reached for "
+                        f"job {self.job.id} {self.job.description}"
+                    )
+                    reports = reports[:max_report_count]
+                    break
         logger.debug(f"Pulled {len(reports)}")
         return reports
 
@@ -119,115 +144,264 @@ class StationExtractor:
         logger.debug(f"Getting tags for report {report.id}")
         return list(self.client.get_enclave_tags(report.id))
 
-    def get_indicators_for_report(self, report):
-        iocs = []
-        there_is_more = True
-        page = 0
-
+    def iter_indicator_pages(self, report):
         logger.debug(f"Getting IOCs for report {report.id}")
-        while there_is_more:
-            response = self.client.get_indicators_for_report_page(
+        return iter_pages(
+            lambda page: self.client.get_indicators_for_report_page(
                 report.id, page_number=page, page_size=1000
             )
-            if response.items:
-                iocs.extend(response.items)
-            else:
-                there_is_more = False
-                logger.debug(f"No more IOCs for report {report.id} stopping.")
-                continue
+        )
 
-            if not response.has_more_pages():
-                there_is_more = False
-                logger.debug(f"No more IOCs for report {report.id} stopping.")
-            else:
-                page += 1
+    def get_indicators_for_report(self, report):
+        iocs = []
+        for page in self.iter_indicator_pages(report):
+            iocs.extend(page)
         return iocs
 
+    def request_iocs_metadata(self, iocs: list):
+        logger.debug(f"Getting metadata for {len(iocs)} IOCs")
+        return self.client.get_indicators_metadata(iocs)
+
     def get_iocs_metadata(self, iocs: list):
-        try:
-            result = self.client.get_indicators_metadata(iocs)
-            return result
-        except Exception as e:
-            logger.warning("Failed to retrieve iocs metadata")
-            logger.warning(e)
-            return iocs
+        enricher = IndicatorEnricher(self)
+        enricher.load(iocs)
+        return enricher.enrich(iocs)
 
-    def get_enclave_iocs(self):
-        results = []
-        # Prepare enclave ids list
+    def get_enclaves(self) -> list:
+        """The user's enclaves, only the ones in enclave_ids if configured"""
+        enclaves = _enclaves.get(self.job.user_conf.id)
+        if enclaves is None:
+            # if filter out read only enclaves?
+            enclaves = list(self.client.get_user_enclaves())
+            _enclaves.set(self.job.user_conf.id, enclaves)
         enclave_ids = self.job.user_conf.source_conf.get("enclave_ids")
-        # If not available get all enclaves for the user and populate
         if not enclave_ids:
-            logger.info("No enclave ids provided. Retrieving all user enclaves ids")
-            enclaves = (
-                self.client.get_user_enclaves()
-            )  # if filter out read only enclaves?
-        else:
-            enclaves = [
-                e for e in self.client.get_user_enclaves() if e.id in enclave_ids
-            ]
+            logger.info("No enclave ids provided. Using all user enclaves ids")
+            return enclaves
+        return [e for e in enclaves if e.id in enclave_ids]
 
-        # retrieve enclave iocs
-        for enclave in enclaves:
-            try:
-                logger.info(
-                    f"Extracting IOCs from enclave {enclave.name} id {enclave.id} "
-                    f"since {self.job.last_run}"
-                )
-                indicators = list(
-                    self.client.search_indicators(
-                        enclave_ids=[enclave.id],
-                        from_time=datetime_to_millis(self.job.last_run),
-                    )
-                )
-                results.append(
-                    {
-                        "enclave": enclave.to_dict(),
-                        "iocs": [i.to_dict() for i in indicators],
-                    }
-                )
-            except Exception as ex:
+    def get_enclave_window(self, enclave) -> Tuple[datetime, datetime]:
+        """
+        The job's timewindow or, without one, the window since the enclave's
+        watermark, or since the last run for enclaves never extracted
+        """
+        window = self.job.user_conf.source_conf.get("timewindow", None)
+        if window:
+            return window["from"], window["to"]
+        since = self.job.enclave_watermarks.get(enclave.id) or self.job.last_run
+        return since, self.get_current_datetime()
+
+    def get_iocs_for_enclave(self, enclave) -> dict:
+        since, to = self.get_enclave_window(enclave)
+        logger.info(
+            f"Extracting IOCs from enclave {enclave.name} id {enclave.id} "
+            f"since {since}"
+        )
+        indicators = self.client.search_indicators(
+            enclave_ids=[enclave.id],
+            from_time=datetime_to_millis(since),
+            to_time=datetime_to_millis(to),
+        )
+        return {
+            "enclave": enclave.to_dict(),
+            "iocs": [i.to_dict() for i in indicators],
+            "to": to,
+        }
+
+    def get_enclave_iocs(self):
+        """
+        Extracts the IOCs of the enclaves concurrently. Each enclave moves its
+        own watermark, so a failing one is extracted again from where it was
+        on the next run without holding back the others.
+        """
+        enclaves = self.get_enclaves()
+        watermarked = "timewindow" not in self.job.user_conf.source_conf
+        results = []
+        outcomes = bounded_map(
+            self.get_iocs_for_enclave, enclaves, self.get_max_in_flight()
+        )
+        for enclave, outcome in zip(enclaves, outcomes):
+            if not outcome.ok:
                 logger.error(
                     f"Failed to pull iocs from from enclave {enclave.name} "
-                    f"id {enclave.id} with error {ex}"
+                    f"id {enclave.id} with error {outcome.error}"
                 )
+                if watermarked and enclave.id not in self.job.enclave_watermarks:
+                    # Pinned where it was searched from, the job's last run is
+                    # about to move past it
+                    since, _ = self.get_enclave_window(enclave)
+                    self.job.set_enclave_watermark(enclave.id, since)
+                continue
+            result = outcome.value
+            if watermarked:
+                self.job.set_enclave_watermark(enclave.id, result.pop("to"))
+            else:
+                del result["to"]
+            results.append(result)
         return results
 
 
-def pull_reports(job: Job):
+class IndicatorEnricher:
+    """
+    Adds metadata to the indicators of an extraction run. Indicators shared
+    by several reports are requested once, in chunks of chunk_size sent
+    concurrently, and kept for the rest of the run. Indicators of a failed
+    chunk are left without metadata.
+    """
+
+    def __init__(
+        self, extractor: StationExtractor, chunk_size: int = IOC_METADATA_CHUNK_SIZE
+    ):
+        self.extractor = extractor
+        self.chunk_size = chunk_size
+        self._metadata: Dict[Tuple, object] = {}
+
+    @staticmethod
+    def key(indicator) -> Tuple:
+        return indicator.value, indicator.type
+
+    def _request(self, chunk: list) -> dict:
+        results = self.extractor.request_iocs_metadata(chunk)
+        by_key = {self.key(i): i for i in results}
+        # the API may leave out the type of the indicators it returns
+        by_value = {i.value: i for i in results}
+        return {
+            self.key(i): by_key.get(self.key(i)) or by_value.get(i.value, i)
+            for i in chunk
+        }
+
+    def load(self, indicators: Iterable) -> None:
+        """Requests the metadata of the indicators not seen yet in the run"""
+        pending = {}
+        for indicator in indicators:
+            key = self.key(indicator)
+            if key not in self._metadata:
+                pending.setdefault(key, indicator)
+        pending = list(pending.values())
+        chunks = [
+            pending[start : start + self.chunk_size]
+            for start in range(0, len(pending), self.chunk_size)
+        ]
+        outcomes = bounded_map(
+            self._request, chunks, self.extractor.get_max_in_flight()
+        )
+        for chunk, outcome in zip(chunks, outcomes):
+            if outcome.ok:
+                self._metadata.update(outcome.value)
+            else:
+                logger.warning(
+                    f"Failed to retrieve metadata of {len(chunk)} iocs: "
+                    f"{outcome.error}"
+                )
+                # not requested again in the run
+                self._metadata.update((self.key(i), i) for i in chunk)
+
+    def enrich(self, indicators: list) -> list:
+        """The indicators with the metadata loaded so far"""
+        return [self._metadata.get(self.key(i), i) for i in indicators]
+
+
+def collect_report(extractor: StationExtractor, summary) -> tuple:
+    """The details, tags and indicators of a report, without metadata"""
+    try:
+        report = extractor.get_report_details(summary)
+    except Exception as e:
+        logger.warning(e)
+        report = summary
+    if extractor.is_report_fully_processed(report):
+        tags = extractor.get_enclave_tags(report)
+        indicators = extractor.get_indicators_for_report(report)
+    else:
+        tags = []
+        indicators = []
+    return report, tags, indicators
+
+
+def report_result(deeplink_base: str, report, tags: list, indicators: list) -> dict:
+    return {
+        "report": report.to_dict(),
+        "tags": [t.to_dict() for t in tags],
+        "indicators": [i.to_dict() for i in indicators],
+        "deeplink": "/".join((deeplink_base, report.id)),
+    }
+
+
+def iter_processed_reports(
+    extractor: StationExtractor,
+    reports: list,
+    deeplink_base: str,
+    enricher: IndicatorEnricher = None,
+    chunk_size: int = None,
+) -> Iterator[List[dict]]:
     """
-    Pulls all reports since last run from all enclaves
+    Yields the processed reports in chunks, each one processed concurrently
+    and its indicators enriched at once by enricher. A failing report is
+    logged and left out.
     """
+    enricher = enricher or IndicatorEnricher(extractor)
+    max_in_flight = extractor.get_max_in_flight()
+    chunk_size = chunk_size or max_in_flight * 4
+    collect = partial(collect_report, extractor)
+    for start in range(0, len(reports), chunk_size):
+        chunk = reports[start : start + chunk_size]
+        collected = []
+        # Reports are independent, their calls are only bound by the rate limit
+        for report, outcome in zip(chunk, bounded_map(collect, chunk, max_in_flight)):
+            if outcome.ok:
+                collected.append(outcome.value)
+            else:
+                logger.warning(f"While processing report {report}: {outcome.error}")
+        enricher.load(chain.from_iterable(iocs for _, _, iocs in collected))
+        yield [
+            report_result(deeplink_base, report, tags, enricher.enrich(iocs))
+            for report, tags, iocs in collected
+        ]
+
+
+def pull_reports(job: Job, checkpoint: Checkpoint = None):
+    """
+    Pulls all reports since last run from all enclaves. Reports are processed
+    lazily, as the returned iterator is consumed, one chunk ahead of it.
+    The window is listed once: deliveries after one that stopped at its
+    checkpoint only process the reports left.
+    """
+    checkpoint = checkpoint or Checkpoint()
     try:
         report_deeplink_base = job.user_conf.source_conf["report_deeplink_base"]
         report_deeplink_base = report_deeplink_base.strip("/")
         extractor = StationExtractor(job)
-        results = []
 
-        # TODO: validate that user has read access for the enclaves
-        reports, to_datetime = extractor.get_reports()
-
-        for report in reports:
-            try:
-                if extractor.is_report_fully_processed(report):
-                    tags = extractor.get_enclave_tags(report)
-                    indicators = extractor.get_indicators_for_report(report)
-                    indicators = extractor.get_iocs_metadata(indicators)
-                else:
-                    tags = []
-                    indicators = []
-                results.append(
-                    {
-                        "report": report.to_dict(),
-                        "tags": [t.to_dict() for t in tags],
-                        "indicators": [i.to_dict() for i in indicators],
-                        "deeplink": "/".join((report_deeplink_base, report.id)),
-                    }
-                )
-            except Exception as e:
-                logger.warning(f"While processing report {report}: {e}")
+        if checkpoint.resumed:
+            to_datetime = datetime.fromisoformat(checkpoint.state["to"])
+            reports = [
+                Report(id=_id, updated=updated)
+                for _id, updated in checkpoint.state["reports"]
+            ]
+            done = checkpoint.state["done"]
+        else:
+            # TODO: validate that user has read access for the enclaves
+            since, to_datetime = extractor.get_window()
+            reports = extractor.get_report_summaries(since, to_datetime)
+            done = 0
+        state = {
+            "to": to_datetime.isoformat(),
+            "reports": [[r.id, r.updated] for r in reports],
+        }
+        if reports and not checkpoint.resumed:
+            checkpoint.save({**state, "done": 0})
+        chunk_size = extractor.get_max_in_flight() * 4
+        chunks = iter_processed_reports(
+            extractor, reports[done:], report_deeplink_base, chunk_size=chunk_size
+        )
 
-        return results, to_datetime
+        def steps():
+            processed = done
+            with closing(prefetch(chunks, PAGE_PREFETCH)) as prefetched:
+                for results in prefetched:
+                    processed = min(processed + chunk_size, len(reports))
+                    yield results, {**state, "done": processed}
+
+        return checkpoint.iter_steps(steps()), to_datetime
     except Exception as ex:
         logger.error(f"Failed to extract repors for job {job.id}")
         raise ex
@@ -238,7 +412,8 @@ def pull_enclaves_iocs(job: Job):
         extractor = StationExtractor(job)
         # TODO: validate that user has read access for the enclaves
         results = extractor.get_enclave_iocs()
-        return results
+        # The watermarks set are saved along with the job's last run
+        return results, extractor.get_current_datetime()
     except Exception as ex:
         logger.error(f"Failed to extract IOCs from enclaves for job {job.id}")
         raise ex
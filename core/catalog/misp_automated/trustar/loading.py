@@ -1,6 +1,7 @@
 from requests import HTTPError
-from trustar import TruStar, Report
+from trustar import Report
 
+from core.catalog.misp_automated.trustar.client import get_client
 from core.logs import get_logger
 from core.etl import Load, Job
 
@@ -13,9 +14,10 @@ class StationLoader:
         self._build_client()
 
     def _build_client(self):
-        ts_conf = self.job.user_conf.destination_conf
-        ts_conf.update(self.job.user_conf.destination_secrets)
-        self.client = TruStar(config=ts_conf)
+        user_conf = self.job.user_conf
+        self.client = get_client(
+            user_conf.id, user_conf.destination_conf, user_conf.destination_secrets
+        )
 
     def submit_report(self, report: Report):
         """
@@ -0,0 +1,175 @@
+"""
+Resumable extractions.
+
+A Checkpoint holds where an extraction stands within its window, e.g. the
+report summaries already listed and how many of them were processed, so that
+a redelivered Extract message doesn't start the window over. Extract callables
+taking a ``checkpoint`` argument resume from ``checkpoint.state`` and yield
+their data through ``Checkpoint.iter_steps``, which stops when the invocation
+is about to run out of time. The state of a step is only saved once every item
+up to it has been queued, see core.assembly.stream_transformation_jobs, so a
+resumed extraction may repeat items but never skips any.
+"""
+import json
+import time
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import botocore
+
+from core.aws import MISSING_OBJECT_CODES, get_client
+from core.concurrency import Deadline
+from core.config import CHECKPOINT_INTERVAL_SECONDS, CHECKPOINTS_BUCKET
+from core.logs import get_logger
+
+logger = get_logger(__name__)
+
+
+class CheckpointStore:
+    """Checkpoint states as JSON objects in S3, nothing is kept without bucket"""
+
+    def __init__(self, bucket: str = None, prefix: str = "checkpoints"):
+        self.bucket = bucket or CHECKPOINTS_BUCKET
+        self.prefix = prefix
+
+    def _object_key(self, key: str) -> str:
+        return f"{self.prefix}/{key}.json"
+
+    def load(self, key: str) -> Optional[dict]:
+        if not self.bucket:
+            return None
+        try:
+            response = get_client("s3").get_object(
+                Bucket=self.bucket, Key=self._object_key(key)
+            )
+        except botocore.exceptions.ClientError as ex:
+            if ex.response["Error"]["Code"] not in MISSING_OBJECT_CODES:
+                logger.warning(f"Unable to read checkpoint {key}: {ex}")
+            return None
+        return json.loads(response["Body"].read())
+
+    def save(self, key: str, state: dict) -> None:
+        if not self.bucket:
+            return
+        get_client("s3").put_object(
+            Bucket=self.bucket,
+            Key=self._object_key(key),
+            Body=json.dumps(state, default=str).encode(),
+        )
+
+    def delete(self, key: str) -> None:
+        if not self.bucket:
+            return
+        get_client("s3").delete_object(Bucket=self.bucket, Key=self._object_key(key))
+
+
+class Checkpoint:
+    def __init__(
+        self,
+        key: str = None,
+        state: dict = None,
+        store: CheckpointStore = None,
+        deadline: Deadline = None,
+        interval: float = CHECKPOINT_INTERVAL_SECONDS,
+    ):
+        """
+        Parameters
+        ----------
+        key : str
+            identifies the extraction, None for checkpoints never persisted
+        state : dict
+            saved state the extraction resumes from
+        store : CheckpointStore
+            where the state is persisted
+        deadline : Deadline
+            when to stop extracting
+        interval : float
+            seconds between writes of committed states
+        """
+        self.key = key
+        self.state = state or {}
+        self.store = store
+        self.deadline = deadline or Deadline()
+        self.interval = interval
+        self.interrupted = False
+        self._saved_at = time.monotonic()
+        self._dirty = False
+        self._persisted = bool(state)
+        # (items yielded, state after them) not saved yet
+        self._steps: List[Tuple[int, dict]] = []
+
+    @classmethod
+    def load(
+        cls, key: str, store: CheckpointStore = None, deadline: Deadline = None
+    ) -> "Checkpoint":
+        store = store or CheckpointStore()
+        state = store.load(key)
+        if state:
+            logger.info(f"Resuming extraction from checkpoint {key}")
+        return cls(key, state, store, deadline)
+
+    @property
+    def resumed(self) -> bool:
+        return bool(self.state)
+
+    def save(self, state: dict) -> None:
+        """Saves a state with no pending items, e.g. before yielding any"""
+        self.state = state
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        if self.key and self.store:
+            self.store.save(self.key, state)
+            self._persisted = True
+
+    def flush(self) -> None:
+        """Saves the last committed state if it wasn't yet"""
+        if self._dirty:
+            self.save(self.state)
+
+    def iter_steps(self, steps: Iterable[Tuple[list, dict]]) -> Iterator:
+        """
+        Yields the items of each (items, state) step, state being where the
+        extraction stands once those items are handled. No further steps are
+        taken once the deadline expires.
+        """
+        steps = iter(steps)
+        yielded = 0
+        try:
+            while True:
+                if self.deadline.expired():
+                    logger.warning(f"Extraction {self.key} stopped at its deadline")
+                    self.interrupted = True
+                    return
+                try:
+                    items, state = next(steps)
+                except StopIteration:
+                    return
+                yield from items
+                yielded += len(items)
+                self._steps.append((yielded, state))
+        finally:
+            if hasattr(steps, "close"):
+                steps.close()
+
+    def commit(self, emitted: int) -> None:
+        """
+        Moves to the last state whose items are all among the emitted ones,
+        written at most every interval seconds
+        """
+        state = None
+        while self._steps and self._steps[0][0] <= emitted:
+            _, state = self._steps.pop(0)
+        if state is None:
+            return
+        self.state = state
+        self._dirty = True
+        if time.monotonic() - self._saved_at >= self.interval:
+            self.save(state)
+
+    def clear(self) -> None:
+        """Forgets the checkpoint of a finished extraction"""
+        self.state = {}
+        self._steps = []
+        self._dirty = False
+        if self._persisted:
+            self.store.delete(self.key)
+            self._persisted = False
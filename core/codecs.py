@@ -0,0 +1,137 @@
+"""
+Codecs used to put jobs on the wire.
+
+Plain JSON text is what every job looked like before codecs existed and it is
+still what the json codec without compression produces. Any other combination
+is wrapped in an envelope with a header naming the codec and the compression:
+
+    etla:2:<codec>:<compression>:<base64 data>
+
+Bodies compressed by the first version of the envelope (``etla:1:``) are JSON
+and are still understood.
+"""
+import base64
+import json
+from typing import Any, Union
+
+from core.compression import (
+    PAYLOAD_MARKER,
+    compress_bytes,
+    decompress_bytes,
+    decompress_payload,
+)
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional dependency
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:  # pragma: no cover - optional dependency
+    cbor2 = None
+
+ENVELOPE_MARKER = "etla:2:"
+
+
+class Codec:
+    name: str = None
+
+    def encode(self, obj: Any) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, data: bytes) -> Any:
+        raise NotImplementedError
+
+
+class JsonCodec(Codec):
+    name = "json"
+
+    def encode(self, obj: Any) -> bytes:
+        return json.dumps(obj).encode()
+
+    def decode(self, data: bytes) -> Any:
+        return json.loads(data)
+
+
+class MsgpackCodec(Codec):
+    name = "msgpack"
+
+    def encode(self, obj: Any) -> bytes:
+        if msgpack is None:
+            raise ValueError("msgpack codec requires the msgpack package")
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data: bytes) -> Any:
+        if msgpack is None:
+            raise ValueError("msgpack codec requires the msgpack package")
+        return msgpack.unpackb(data, raw=False)
+
+
+class CborCodec(Codec):
+    name = "cbor"
+
+    def encode(self, obj: Any) -> bytes:
+        if cbor2 is None:
+            raise ValueError("cbor codec requires the cbor2 package")
+        return cbor2.dumps(obj)
+
+    def decode(self, data: bytes) -> Any:
+        if cbor2 is None:
+            raise ValueError("cbor codec requires the cbor2 package")
+        return cbor2.loads(data)
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec(), MsgpackCodec(), CborCodec())}
+
+
+def get_codec(name: str) -> Codec:
+    try:
+        return CODECS[name or JsonCodec.name]
+    except KeyError:
+        raise ValueError(f"Unsupported codec '{name}'")
+
+
+def encode_payload(obj: Any, codec: str = None, compression: str = None) -> str:
+    """
+    Encodes obj with the given codec and compression
+
+    Returns
+    -------
+    str
+        Plain JSON text for the json codec without compression,
+        an envelope otherwise
+    """
+    codec_impl = get_codec(codec)
+    if codec_impl.name == JsonCodec.name and not compression:
+        return json.dumps(obj)
+    data = codec_impl.encode(obj)
+    if compression:
+        data = compress_bytes(data, compression)
+    encoded = base64.b64encode(data).decode()
+    return f"{ENVELOPE_MARKER}{codec_impl.name}:{compression or ''}:{encoded}"
+
+
+def decode_payload(body: Union[str, bytes]) -> Any:
+    """
+    Decodes anything produced by encode_payload, the etla:1 compressed bodies
+    and plain JSON
+    """
+    if isinstance(body, bytes):
+        body = body.decode()
+    if body.startswith(ENVELOPE_MARKER):
+        codec, compression, encoded = body[len(ENVELOPE_MARKER) :].split(":", 2)
+        data = base64.b64decode(encoded)
+        if compression:
+            data = decompress_bytes(data, compression)
+        return get_codec(codec).decode(data)
+    if body.startswith(PAYLOAD_MARKER):
+        return json.loads(decompress_payload(body))
+    return json.loads(body)
+
+
+def is_envelope(body: Union[str, bytes]) -> bool:
+    """True for bodies that are not plain JSON"""
+    if isinstance(body, bytes):
+        body = body.decode()
+    return body.startswith((ENVELOPE_MARKER, PAYLOAD_MARKER))
@@ -0,0 +1,70 @@
+"""
+Compression of message bodies.
+
+Compressed bodies are base64 text prefixed by a version marker and the
+algorithm used, e.g. ``etla:1:gzip:H4sIA...``, so consumers can tell them
+apart from plain JSON jobs that are still in flight.
+"""
+import base64
+import gzip
+from typing import Union
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+PAYLOAD_MARKER = "etla:1:"
+GZIP = "gzip"
+ZSTD = "zstd"
+SUPPORTED_COMPRESSIONS = (GZIP, ZSTD)
+
+
+def compress_bytes(data: bytes, compression: str) -> bytes:
+    if compression == GZIP:
+        return gzip.compress(data)
+    if compression == ZSTD:
+        if zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        return zstandard.ZstdCompressor().compress(data)
+    raise ValueError(f"Unsupported compression '{compression}'")
+
+
+def decompress_bytes(data: bytes, compression: str) -> bytes:
+    if compression == GZIP:
+        return gzip.decompress(data)
+    if compression == ZSTD:
+        if zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f"Unsupported compression '{compression}'")
+
+
+def is_compressed(body: Union[str, bytes]) -> bool:
+    if isinstance(body, bytes):
+        return body.startswith(PAYLOAD_MARKER.encode())
+    return body.startswith(PAYLOAD_MARKER)
+
+
+def compress_payload(payload: str, compression: str = None) -> str:
+    """
+    Compresses the payload with the given algorithm. Payloads are returned
+    untouched when no compression is requested.
+    """
+    if not compression:
+        return payload
+    compressed = compress_bytes(payload.encode(), compression)
+    encoded = base64.b64encode(compressed).decode()
+    return f"{PAYLOAD_MARKER}{compression}:{encoded}"
+
+
+def decompress_payload(body: Union[str, bytes]) -> str:
+    """
+    Reverts compress_payload. Bodies without the marker are returned as text.
+    """
+    if isinstance(body, bytes):
+        body = body.decode()
+    if not is_compressed(body):
+        return body
+    compression, encoded = body[len(PAYLOAD_MARKER) :].split(":", 1)
+    return decompress_bytes(base64.b64decode(encoded), compression).decode()
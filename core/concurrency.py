@@ -0,0 +1,125 @@
+"""
+Bounded concurrency helpers for I/O bound work inside a Lambda invocation.
+"""
+import contextvars
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Iterator, List, Optional
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    """
+    Tells when there isn't enough invocation time left to start more work.
+    Without a Lambda context it never expires.
+    """
+
+    def __init__(self, context=None, reserve_ms: int = 0):
+        self._remaining = getattr(context, "get_remaining_time_in_millis", None)
+        self.reserve_ms = reserve_ms
+
+    def remaining_ms(self) -> Optional[float]:
+        return self._remaining() if self._remaining else None
+
+    def expired(self) -> bool:
+        remaining = self.remaining_ms()
+        return remaining is not None and remaining < self.reserve_ms
+
+    def check(self) -> None:
+        if self.expired():
+            raise DeadlineExceeded(f"Less than {self.reserve_ms}ms left")
+
+
+@dataclass
+class Outcome:
+    value: Any = None
+    error: Optional[BaseException] = None
+    seconds: float = 0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def _call(fn: Callable, item: Any) -> Outcome:
+    start = time.perf_counter()
+    try:
+        return Outcome(value=fn(item), seconds=time.perf_counter() - start)
+    except Exception as ex:
+        return Outcome(error=ex, seconds=time.perf_counter() - start)
+
+
+def bounded_map(fn: Callable, items: Iterable, max_workers: int) -> List[Outcome]:
+    """
+    Calls fn on every item with at most max_workers threads. Outcomes keep
+    the order of items and carry either the value or the error of each call.
+    Every call runs in a copy of the caller's context so context variables,
+    e.g. the stage being recorded by core.metrics, are visible in threads.
+    """
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [_call(fn, item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as pool:
+        futures = [
+            pool.submit(contextvars.copy_context().run, _call, fn, item)
+            for item in items
+        ]
+        return [future.result() for future in futures]
+
+
+_END = object()
+
+
+def prefetch(iterable: Iterable, depth: int = 1) -> Iterator:
+    """
+    Iterates iterable on a background thread keeping up to depth items ready
+    ahead of the consumer, so fetching the next page overlaps with processing
+    the current one. Errors are raised to the consumer, and closing the
+    returned generator stops the background thread. A depth of 0 doesn't
+    prefetch.
+    """
+    if depth <= 0:
+        yield from iterable
+        return
+
+    ready: queue.Queue = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def put(entry) -> bool:
+        while not stopped.is_set():
+            try:
+                ready.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((_END, None))
+        except Exception as ex:
+            put((_END, ex))
+
+    thread = threading.Thread(
+        target=contextvars.copy_context().run, args=(produce,), daemon=True
+    )
+    thread.start()
+    try:
+        while True:
+            item, error = ready.get()
+            if error is not None:
+                raise error
+            if item is _END:
+                return
+            yield item
+    finally:
+        stopped.set()
@@ -20,8 +20,73 @@ try:
     TRANSFORM_JOBS_QUEUE = os.getenv("TRANSFORM_JOBS_QUEUE", None)
     LOAD_JOBS_QUEUE = os.getenv("LOAD_JOBS_QUEUE", None)
     BIG_PAYLOADS_BUCKET = os.getenv("BIG_PAYLOADS_BUCKET", None)
+    # Messages bigger than this (in bytes) are sent through BIG_PAYLOADS_BUCKET
+    LARGE_PAYLOAD_THRESHOLD = int(os.getenv("LARGE_PAYLOAD_THRESHOLD", "262144"))
+    # gzip or zstd, leave empty to send uncompressed messages
+    PAYLOAD_COMPRESSION = os.getenv("PAYLOAD_COMPRESSION", None)
+    # json, msgpack (needs msgpack) or cbor (needs cbor2)
+    JOB_CODEC = os.getenv("JOB_CODEC", "json")
+    # Extraction checkpoints, not persisted without a bucket
+    CHECKPOINTS_BUCKET = os.getenv("CHECKPOINTS_BUCKET", BIG_PAYLOADS_BUCKET)
+    # Seconds between checkpoint writes while extracting
+    CHECKPOINT_INTERVAL_SECONDS = float(os.getenv("CHECKPOINT_INTERVAL_SECONDS", "30"))
+    # Extractions stop at a checkpoint with less than this invocation time left
+    EXTRACTION_TIME_RESERVE_MS = int(os.getenv("EXTRACTION_TIME_RESERVE_MS", "60000"))
+
+    # Resolve the catalog callables of every template at Lambda init
+    PREWARM_CALLABLES = os.getenv("PREWARM_CALLABLES", "false").lower() == "true"
+
+    # Transform and Load jobs are split to stay under these limits
+    PARTITION_MAX_ITEMS = int(os.getenv("PARTITION_MAX_ITEMS", "500"))
+    PARTITION_MAX_BYTES = int(os.getenv("PARTITION_MAX_BYTES", "200000"))
+
+    # Extractions up to this size in bytes are transformed and loaded in the
+    # same invocation. 0 disables it, templates can override it
+    FUSE_THRESHOLD = int(os.getenv("FUSE_THRESHOLD", "0"))
+
+    # Templates and UserConfs are cached this many seconds, 0 disables it.
+    # It bounds how long edits to them take to be seen by running lambdas
+    REGISTRY_CACHE_TTL = int(os.getenv("REGISTRY_CACHE_TTL", "300"))
+    REGISTRY_CACHE_SIZE = int(os.getenv("REGISTRY_CACHE_SIZE", "256"))
+    # Seconds UserConf secrets are kept in memory, 0 reads them every time
+    SECRETS_CACHE_TTL = int(os.getenv("SECRETS_CACHE_TTL", "0"))
+
+    METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", "ETLAssembly")
 
     HISTORY_MESSAGES_RATE = int(os.getenv("HISTORY_MESSAGES_RATE", "3"))
+    # Windows extracted at once by the history lambda, 1 is sequential
+    HISTORY_WORKERS = int(os.getenv("HISTORY_WORKERS", "1"))
+    # No new windows are started with less than this invocation time left
+    HISTORY_TIME_RESERVE_MS = int(os.getenv("HISTORY_TIME_RESERVE_MS", "60000"))
+    # New jobs are backfilled this many days in windows of this many minutes
+    BACKFILL_DAYS = int(os.getenv("BACKFILL_DAYS", "30"))
+    BACKFILL_WINDOW_MINUTES = int(os.getenv("BACKFILL_WINDOW_MINUTES", "15"))
+    # Seconds a backfill is leased to an invocation with no Lambda context
+    BACKFILL_LEASE_SECONDS = int(os.getenv("BACKFILL_LEASE_SECONDS", "900"))
+    # Per report source calls made at once by extractors
+    EXTRACTION_MAX_IN_FLIGHT = int(os.getenv("EXTRACTION_MAX_IN_FLIGHT", "8"))
+    # Seconds the enclaves of a TruSTAR user are kept between extractions
+    ENCLAVES_CACHE_TTL = int(os.getenv("ENCLAVES_CACHE_TTL", "900"))
+    # Bytes of report details kept in process and, if set, in this bucket
+    REPORT_DETAILS_CACHE_BYTES = int(
+        os.getenv("REPORT_DETAILS_CACHE_BYTES", str(32 * 1024 * 1024))
+    )
+    REPORT_DETAILS_BUCKET = os.getenv("REPORT_DETAILS_BUCKET", None)
+    # Seconds pooled TruSTAR clients are reused for
+    TRUSTAR_CLIENT_TTL = int(os.getenv("TRUSTAR_CLIENT_TTL", "3600"))
+    # Indicators sent per TruSTAR metadata request, the API takes up to 1000
+    IOC_METADATA_CHUNK_SIZE = int(os.getenv("IOC_METADATA_CHUNK_SIZE", "1000"))
+    # Retries of throttled or unavailable source and destination requests
+    HTTP_MAX_ATTEMPTS = int(os.getenv("HTTP_MAX_ATTEMPTS", "5"))
+    HTTP_BACKOFF_SECONDS = float(os.getenv("HTTP_BACKOFF_SECONDS", "0.5"))
+    # Longer Retry-After waits fail the request instead
+    HTTP_MAX_WAIT_SECONDS = float(os.getenv("HTTP_MAX_WAIT_SECONDS", "60"))
+    # Pages fetched ahead of the one being processed, 0 disables prefetching
+    PAGE_PREFETCH = int(os.getenv("PAGE_PREFETCH", "1"))
+    # Adaptive windows: bounds and the number of items a window should have
+    WINDOW_MIN_MINUTES = int(os.getenv("WINDOW_MIN_MINUTES", "1"))
+    WINDOW_MAX_MINUTES = int(os.getenv("WINDOW_MAX_MINUTES", "1440"))
+    WINDOW_TARGET_ITEMS = int(os.getenv("WINDOW_TARGET_ITEMS", "200"))
     TIMEWINDOW_SIZE = int(os.getenv("TIMEWINDOW_SIZE", "3"))  # in minutes
 except KeyError as k:
     raise Exception(f"Missing {k} environment variable")
@@ -1,10 +1,11 @@
 import json
+import random
+import time
 
-from dataclasses import dataclass
-
-import boto3
+from dataclasses import dataclass, field
 
 import core.config as config
+from core.aws import get_resource
 from core.logs import get_logger
 
 logger = get_logger("database")
@@ -16,6 +17,7 @@ class TableDefinition:
     attribute_deffinition: list
     provisioned_throughput: dict
     key_schema: list
+    global_secondary_indexes: list = field(default_factory=list)
 
 
 def get_dynamo_connection(
@@ -23,7 +25,7 @@ def get_dynamo_connection(
 ):
     try:
         logger.debug("Connecting to DynamoDB")
-        dynamodb = boto3.resource("dynamodb", region, endpoint_url=endpoint_url)
+        dynamodb = get_resource("dynamodb", region, endpoint_url=endpoint_url)
         logger.debug("Connected to DynamoDB")
         return dynamodb
     except Exception as ex:
@@ -31,15 +33,78 @@ def get_dynamo_connection(
         raise ex
 
 
+# DynamoDB hard limit of keys per BatchGetItem
+BATCH_GET_MAX_KEYS = 100
+
+
+def batch_get_items(request_items: dict, max_attempts: int = 5) -> dict:
+    """
+    BatchGetItem wrapper that splits requests in chunks of 100 keys and
+    retries UnprocessedKeys with jittered exponential backoff.
+
+    Parameters
+    ----------
+    request_items : dict
+        same as BatchGetItem RequestItems, {table_name: {"Keys": [...], ...}}
+
+    Returns
+    -------
+    dict
+        The retrieved items by table name
+    """
+    dynamodb = get_dynamo_connection()
+    results: dict = {table_name: [] for table_name in request_items}
+    chunks = []
+    chunk: dict = {}
+    chunk_size = 0
+    for table_name, table_request in request_items.items():
+        for key in table_request["Keys"]:
+            if chunk_size == BATCH_GET_MAX_KEYS:
+                chunks.append(chunk)
+                chunk = {}
+                chunk_size = 0
+            chunk.setdefault(table_name, dict(table_request, Keys=[]))["Keys"].append(
+                key
+            )
+            chunk_size += 1
+    if chunk:
+        chunks.append(chunk)
+
+    for pending in chunks:
+        attempt = 0
+        while pending:
+            attempt += 1
+            response = dynamodb.batch_get_item(RequestItems=pending)
+            for table_name, items in response.get("Responses", {}).items():
+                results[table_name].extend(items)
+            pending = response.get("UnprocessedKeys") or {}
+            if pending:
+                if attempt >= max_attempts:
+                    raise Exception(
+                        f"Unable to get {pending} after {max_attempts} attempts"
+                    )
+                logger.debug(f"Retrying unprocessed keys, attempt {attempt}")
+                time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+    return results
+
+
 def create_table(table_definition: TableDefinition):
     try:
         dynamodb = get_dynamo_connection()
         logger.debug(f"Creating {table_definition.name} table")
+        indexes = {}
+        if table_definition.global_secondary_indexes:
+            throughput = table_definition.provisioned_throughput
+            indexes["GlobalSecondaryIndexes"] = [
+                dict(index, ProvisionedThroughput=throughput)
+                for index in table_definition.global_secondary_indexes
+            ]
         table = dynamodb.create_table(
             TableName=table_definition.name,
             KeySchema=table_definition.key_schema,
             AttributeDefinitions=table_definition.attribute_deffinition,
             ProvisionedThroughput=table_definition.provisioned_throughput,
+            **indexes,
         )
         waiter = table.meta.client.get_waiter("table_exists")
         waiter.wait(TableName=table_definition.name)
@@ -111,9 +176,22 @@ UserConfTable = TableDefinition(
     provisioned_throughput={"ReadCapacityUnits": 5, "WriteCapacityUnits": 5},
 )
 
+# Sparse index of the jobs with an active backfill, only they set the key
+ACTIVE_BACKFILL_INDEX = "ActiveBackfillIndex"
+
 JobTable = TableDefinition(
     name=config.JOB_TABLE,
     key_schema=[{"AttributeName": "id", "KeyType": "HASH"}],  # Partition key
-    attribute_deffinition=[{"AttributeName": "id", "AttributeType": "S"}],
+    attribute_deffinition=[
+        {"AttributeName": "id", "AttributeType": "S"},
+        {"AttributeName": "active_backfill", "AttributeType": "S"},
+    ],
     provisioned_throughput={"ReadCapacityUnits": 5, "WriteCapacityUnits": 5},
+    global_secondary_indexes=[
+        {
+            "IndexName": ACTIVE_BACKFILL_INDEX,
+            "KeySchema": [{"AttributeName": "active_backfill", "KeyType": "HASH"}],
+            "Projection": {"ProjectionType": "ALL"},
+        }
+    ],
 )
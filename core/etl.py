@@ -1,13 +1,22 @@
 from abc import ABC, abstractmethod
-import importlib
 import json
-from datetime import datetime, timedelta, timezone
+import random
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
 from queue import Empty, Queue
-from typing import Union, List
-
-import boto3
-import sqs_extended_client  # noqa: F401
-
+from typing import Any, Union, List
+
+import botocore
+
+from core import metrics
+from core.backfill import Backfill
+from core.aws import get_client, get_extended_sqs_client, get_resource
+from core.callables import resolve_callable, takes_argument
+from core.checkpoints import Checkpoint
+from core.concurrency import Deadline
+from core.codecs import decode_payload, encode_payload, is_envelope
+from core.config import BACKFILL_DAYS, BACKFILL_WINDOW_MINUTES
 from core.registry import Job
 from core.logs import get_logger
 
@@ -38,15 +47,23 @@ class BaseJob:
         """Invoques the configured callable for this job with the provided parameters"""
         return self._job_callable(**self._callable_arguments)
 
-    def serialize(self):
-        """Serializes this job to json string
+    def serialize(self, codec: str = None, compression: str = None):
+        """Serializes this job to json string or to an envelope when a codec
+        other than json or a compression is requested
+
+        Parameters
+        ----------
+        codec : str
+            json, msgpack or cbor. Defaults to json
+        compression : str
+            gzip or zstd, None for no compression
 
         Returns
         -------
-        bytes
-            bytes string representation of this job
+        str
+            string representation of this job
         """
-        serialized = json.dumps(self.as_dict())
+        serialized = encode_payload(self.as_dict(), codec, compression)
         return serialized
 
     def as_dict(self):
@@ -58,14 +75,14 @@ class BaseJob:
 
     @classmethod
     def deserialize(cls, bytestream: str) -> "Job":
-        """Deserializes the provided json_string
+        """Deserializes the provided json string or envelope
 
         Returns
         -------
         Job
             A Job object
         """
-        deserialized = json.loads(bytestream)
+        deserialized = decode_payload(bytestream)
         pythonified = cls.from_dict(deserialized)
         return pythonified
 
@@ -75,13 +92,8 @@ class BaseJob:
         return cls(*args, **kwargs)
 
     def _load_job_callable(self, callable_path: str):
-        """Imports the module and gets the callable from it"""
-        # importlib.invalidate_caches()
-        # TODO: sanitization of the code is critical here. What are we loading?
-        exploded_path = ["core", "catalog"]
-        exploded_path.extend(callable_path.split("."))  # misp.extraction.pull_feeds
-        module = importlib.import_module(".".join(exploded_path[:-1]))
-        self._job_callable = getattr(module, exploded_path[-1])
+        """Gets the callable from the process wide registry"""
+        self._job_callable = resolve_callable(callable_path)
 
 
 class Extract(BaseJob):
@@ -101,6 +113,34 @@ class Extract(BaseJob):
         )
         self.job = job
 
+    def run(self, checkpoint: Checkpoint = None):
+        """
+        Callables taking a checkpoint argument are given checkpoint, the
+        others run as usual
+        """
+        if checkpoint is not None and takes_argument(self._job_callable, "checkpoint"):
+            return self._job_callable(checkpoint=checkpoint, **self._callable_arguments)
+        return super().run()
+
+    def checkpoint_key(self) -> str:
+        """The same for every delivery of this job and window"""
+        window = self.job.user_conf.source_conf.get("timewindow")
+        if window:
+            return (
+                f"{self.job.id}/"
+                f"{window['from'].isoformat()}_{window['to'].isoformat()}"
+            )
+        return f"{self.job.id}/{self.job.last_run.isoformat()}"
+
+    def open_checkpoint(self, deadline: Deadline = None) -> Checkpoint:
+        """
+        The persisted checkpoint of callables taking one, an in-memory one
+        that is never read nor written otherwise
+        """
+        if not takes_argument(self._job_callable, "checkpoint"):
+            return Checkpoint(deadline=deadline)
+        return Checkpoint.load(self.checkpoint_key(), deadline=deadline)
+
     def update_extraction_datetime(self, extraction_datetime: datetime):
         if self.job.last_run < extraction_datetime:
             self.job.last_run = extraction_datetime
@@ -112,6 +152,7 @@ class Extract(BaseJob):
     @classmethod
     def from_dict(cls, source_dict):
         job = Job.from_dict(source_dict["job"])
+        Job.resolve([job])
         return cls(job)
 
 
@@ -144,6 +185,7 @@ class HistoryExtract(Extract):
     @classmethod
     def from_dict(cls, source_dict):
         job = Job.from_dict(source_dict["job"])
+        Job.resolve([job])
         window = {
             "from": datetime.fromisoformat(source_dict["window"]["from"]),
             "to": datetime.fromisoformat(source_dict["window"]["to"]),
@@ -223,44 +265,246 @@ class AbstractQueue(ABC):
     def get(self) -> Union[Extract, Transform, Load]:
         raise NotImplementedError
 
+    @abstractmethod
+    def get_many(self, n: int) -> List[Union[Extract, Transform, Load]]:
+        raise NotImplementedError
+
 
 class InMemoryQueue(AbstractQueue):
-    def __init__(self, job_type: Union[Extract, Transform, Load, HistoryExtract]):
+    def __init__(
+        self,
+        job_type: Union[Extract, Transform, Load, HistoryExtract],
+        codec: str = None,
+        compression: str = None,
+    ):
         self._q: Queue = Queue()
         self.job_type = job_type
+        self.codec = codec
+        self.compression = compression
 
     def put(self, jobs: List[Union[Extract, Transform, Load, HistoryExtract]]):
         for j in jobs:
-            self._q.put(j.serialize(), block=False)
+            serialized = j.serialize(self.codec, self.compression)
+            self._q.put(serialized, block=False)
+            metrics.add(metrics.QUEUE_HOPS)
+            metrics.add(metrics.PAYLOAD_BYTES, len(serialized.encode()))
 
     def get(self) -> Union[Extract, Transform, Load, HistoryExtract]:
         return self.job_type.deserialize(self._q.get(block=False))
 
+    def get_many(
+        self, n: int = 10, wait_seconds: int = 0
+    ) -> List[Union[Extract, Transform, Load, HistoryExtract]]:
+        jobs = []
+        while len(jobs) < n:
+            try:
+                jobs.append(self.get())
+            except Empty:
+                break
+        return jobs
+
+
+@dataclass
+class PutResult:
+    """Outcome of queueing a single job"""
+
+    job: Any
+    message_id: str = None
+    error: str = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class QueuePutError(Exception):
+    """Some jobs couldn't be queued, failed holds their PutResults"""
+
+    def __init__(self, failed: List[PutResult]):
+        self.failed = failed
+        super().__init__(
+            f"{len(failed)} jobs couldn't be queued: "
+            + "; ".join(f"{r.job.job.id}: {r.error}" for r in failed)
+        )
+
 
 class SqsQueue(AbstractQueue):
     MESSAGE_POINTER_CLASS = "com.amazon.sqs.javamessaging.MessageS3Pointer"
+    # SQS hard limits for SendMessageBatch
+    MAX_BATCH_ENTRIES = 10
+    MAX_BATCH_BYTES = 262144
+    # SQS hard limit for a single message
+    MAX_MESSAGE_BYTES = 262144
+    # Upper bound for the body the extended client sends instead of the payload
+    S3_POINTER_SIZE = 512
+    MAX_SEND_ATTEMPTS = 3
+    # SQS hard limit for ReceiveMessage and DeleteMessageBatch
+    MAX_RECEIVE_MESSAGES = 10
+    MAX_WAIT_SECONDS = 20
 
     def __init__(
         self,
         queue_url: str,
         job_type: Union[Extract, Transform, Load, HistoryExtract],
         large_payload_bucket: str = None,
+        large_payload_threshold: int = 262144,
+        compression: str = None,
+        codec: str = None,
     ):
+        """
+        Parameters
+        ----------
+        queue_url : str
+            URL of the SQS queue
+        job_type :
+            Job class used to deserialize the messages
+        large_payload_bucket : str
+            S3 bucket for messages that don't fit in SQS
+        large_payload_threshold : int
+            messages bigger than this amount of bytes go through the bucket
+        compression : str
+            gzip or zstd to compress message bodies, None to send them as is
+        codec : str
+            json, msgpack or cbor, see core.codecs. Defaults to json
+        """
+        if large_payload_bucket and large_payload_threshold > self.MAX_MESSAGE_BYTES:
+            raise ValueError(
+                f"large_payload_threshold can't be over {self.MAX_MESSAGE_BYTES} "
+                f"bytes, the SQS message size limit, got {large_payload_threshold}"
+            )
         self.queue_url = queue_url
-        self.sqs = boto3.client("sqs")
-        self.job_type = job_type
+        # Pooled clients are shared, only the extended ones have a bucket set
         if large_payload_bucket:
-            self.sqs.large_payload_support = large_payload_bucket
-            self.sqs.always_through_s3 = True
+            self.sqs = get_extended_sqs_client(
+                large_payload_bucket, large_payload_threshold
+            )
+        else:
+            self.sqs = get_client("sqs")
+        self.job_type = job_type
+        self.compression = compression
+        self.codec = codec
 
-    def put(self, jobs: List[Union[Extract, Transform, Load, HistoryExtract]]):
-        # Send message to SQS queue
-        for job in jobs:
-            serialized_job = job.serialize()
-            response = self.sqs.send_message(
-                QueueUrl=self.queue_url, MessageBody=serialized_job
+    def put(
+        self, jobs: List[Union[Extract, Transform, Load, HistoryExtract]]
+    ) -> List[PutResult]:
+        """
+        Sends the jobs to the SQS queue using SendMessageBatch.
+
+        Entries are packed up to MAX_BATCH_ENTRIES per call without exceeding
+        MAX_BATCH_BYTES. Entries that fail for reasons other than a sender fault
+        are retried up to MAX_SEND_ATTEMPTS times, with jittered exponential
+        backoff.
+
+        Returns
+        -------
+        list
+            A PutResult per job, in the same order as the provided jobs
+
+        Raises
+        ------
+        QueuePutError
+            with the results of the jobs that couldn't be queued, so that
+            stages don't move past data that never made it to the queue
+        """
+        results = [PutResult(job=job) for job in jobs]
+        pending = []
+        for index, job in enumerate(jobs):
+            try:
+                serialized = job.serialize(self.codec, self.compression)
+                pending.append((str(index), serialized))
+            except Exception as ex:
+                logger.error(f"Unable to serialize {job.job.id}: {ex}")
+                results[index].error = str(ex)
+
+        attempt = 0
+        while pending and attempt < self.MAX_SEND_ATTEMPTS:
+            attempt += 1
+            retryable = []
+            for batch in self.pack_batches(pending):
+                retryable.extend(self._send_batch(batch, results))
+            pending = retryable
+            if pending:
+                logger.warning(
+                    f"{len(pending)} messages failed to be queued "
+                    f"on attempt {attempt} of {self.MAX_SEND_ATTEMPTS}"
+                )
+                if attempt < self.MAX_SEND_ATTEMPTS:
+                    time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+        failed = [result for result in results if not result.ok]
+        if failed:
+            raise QueuePutError(failed)
+        return results
+
+    def pack_batches(self, entries: List[tuple]) -> List[List[tuple]]:
+        """
+        Groups (entry_id, body) tuples in batches that honour the
+        SendMessageBatch entries and size limits
+        """
+        batches = []
+        batch: List[tuple] = []
+        batch_size = 0
+        for entry in entries:
+            entry_size = self.message_size(entry[1])
+            if batch and (
+                len(batch) >= self.MAX_BATCH_ENTRIES
+                or batch_size + entry_size > self.MAX_BATCH_BYTES
+            ):
+                batches.append(batch)
+                batch = []
+                batch_size = 0
+            batch.append(entry)
+            batch_size += entry_size
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def message_size(self, message_body: str) -> int:
+        """
+        Size in bytes the message will take in the batch request. When the
+        payload is going to be offloaded to S3 only the pointer is sent.
+        """
+        size = len(message_body.encode())
+        offloads = getattr(self.sqs, "large_payload_support", None) and (
+            getattr(self.sqs, "always_through_s3", False)
+            or size > getattr(self.sqs, "message_size_threshold", size)
+        )
+        return self.S3_POINTER_SIZE if offloads else size
+
+    def _send_batch(self, batch: List[tuple], results: List[PutResult]) -> list:
+        """
+        Sends a single batch and records the outcome of each entry in results.
+        Returns the entries worth retrying.
+        """
+        try:
+            response = self.sqs.send_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{"Id": _id, "MessageBody": body} for _id, body in batch],
+            )
+        except botocore.exceptions.ClientError as ex:
+            logger.warning(f"SendMessageBatch failed: {ex}")
+            for _id, _ in batch:
+                results[int(_id)].error = str(ex)
+            return batch
+
+        bodies = dict(batch)
+        for success in response.get("Successful", []):
+            result = results[int(success["Id"])]
+            result.message_id = success["MessageId"]
+            result.error = None
+            metrics.add(metrics.QUEUE_HOPS)
+            metrics.add(metrics.PAYLOAD_BYTES, len(bodies[success["Id"]].encode()))
+            logger.debug(
+                f"Queued {result.job.job.id} with MessageId {result.message_id}"
             )
-            logger.debug(f"Queued {job.job.id} with MessageId {response['MessageId']}")
+
+        retryable = []
+        for failure in response.get("Failed", []):
+            result = results[int(failure["Id"])]
+            result.error = f"{failure.get('Code')}: {failure.get('Message', '')}"
+            logger.warning(f"Failed to queue {result.job.job.id}: {result.error}")
+            if not failure.get("SenderFault"):
+                retryable.append((failure["Id"], bodies[failure["Id"]]))
+        return retryable
 
     def get(self) -> Union[Extract, Transform, Load, HistoryExtract]:
         response = self.get_raw()
@@ -272,6 +516,8 @@ class SqsQueue(AbstractQueue):
         return job
 
     def build_job(self, message_body):
+        if is_envelope(message_body):
+            return self.job_type.deserialize(message_body)
         try:
             deserialized_message = json.loads(message_body)
         except json.decoder.JSONDecodeError:
@@ -296,7 +542,7 @@ class SqsQueue(AbstractQueue):
         Retrieves the configuration file from the specified bucket,
         parses the JSON to a list of dicts
         """
-        s3 = boto3.resource("s3")
+        s3 = get_resource("s3")
         bucket = s3.Bucket(bucket_name)
         obj = bucket.Object(key=object_key)
         logger.debug(f"Getting {bucket}/{obj}")
@@ -304,10 +550,44 @@ class SqsQueue(AbstractQueue):
         lines: bytes = response["Body"].read()
         return lines
 
-    def get_raw(self) -> dict:
+    def get_many(
+        self, n: int = 10, wait_seconds: int = 0
+    ) -> List[Union[Extract, Transform, Load, HistoryExtract]]:
+        """
+        Receives up to n jobs, long polling up to wait_seconds on each receive.
+        Messages that were turned into jobs are deleted with DeleteMessageBatch,
+        the ones that failed to deserialize are left for redelivery.
+
+        Returns
+        -------
+        list
+            The received jobs, empty if the queue had nothing to offer
+        """
+        jobs = []
+        receipt_handles = []
+        while len(jobs) < n:
+            max_messages = min(n - len(jobs), self.MAX_RECEIVE_MESSAGES)
+            try:
+                response = self.get_raw(max_messages, wait_seconds)
+            except Empty:
+                break
+            for message in response["Messages"]:
+                try:
+                    jobs.append(self.build_job(message["Body"]))
+                    receipt_handles.append(message["ReceiptHandle"])
+                except Exception as ex:
+                    logger.error(f"Unable to build job from {message['MessageId']}")
+                    logger.exception(ex)
+            if len(response["Messages"]) < max_messages:
+                break
+        self.delete_many(receipt_handles)
+        return jobs
+
+    def get_raw(self, max_messages: int = 1, wait_seconds: int = 0) -> dict:
         response = self.sqs.receive_message(
             QueueUrl=self.queue_url,
-            MaxNumberOfMessages=1,
+            MaxNumberOfMessages=max_messages,
+            WaitTimeSeconds=min(wait_seconds, self.MAX_WAIT_SECONDS),
             MessageAttributeNames=["All"],
             AttributeNames=["ALL"],
         )
@@ -324,40 +604,53 @@ class SqsQueue(AbstractQueue):
         except Exception as ex:
             logger.warning(ex)
 
+    def delete_many(self, receipt_handles: List[str]) -> List[str]:
+        """
+        Deletes messages using DeleteMessageBatch, 10 at a time.
+
+        Returns
+        -------
+        list
+            Receipt handles that could not be deleted
+        """
+        failed = []
+        for start in range(0, len(receipt_handles), self.MAX_RECEIVE_MESSAGES):
+            chunk = receipt_handles[start : start + self.MAX_RECEIVE_MESSAGES]
+            try:
+                response = self.sqs.delete_message_batch(
+                    QueueUrl=self.queue_url,
+                    Entries=[
+                        {"Id": str(i), "ReceiptHandle": handle}
+                        for i, handle in enumerate(chunk)
+                    ],
+                )
+            except Exception as ex:
+                logger.warning(ex)
+                failed.extend(chunk)
+                continue
+            for failure in response.get("Failed", []):
+                logger.warning(
+                    f"Failed to delete message: {failure.get('Code')} "
+                    f"{failure.get('Message', '')}"
+                )
+                failed.append(chunk[int(failure["Id"])])
+        return failed
+
 
 class HistoricalIngestHandler:
-    def __init__(self, job_id: str, queues) -> None:
-        now = datetime.now(tz=timezone.utc)
-        self.now = now
-        self.since = now - timedelta(days=30)
+    """
+    Starts the backfill of a new job. Windows aren't queued, the history
+    lambda walks the persisted cursor instead (see core.backfill).
+    """
+
+    def __init__(self, job_id: str, queues=None) -> None:
+        # queues is kept for callers of the former queue based backfill
+        self.now = datetime.now(tz=timezone.utc)
         self.job = Job.get(job_id)
-        self.extraction_queue = queues.history
 
     def schedule_jobs(self):
-        time_windows = self.create_windows()
-        jobs = self.create_extraction_jobs(time_windows)
-        self.queue_jobs(jobs)
-
-    def create_windows(self):
-        windows = []
-        generate_more = True
-        last_datetime = self.now
-        while generate_more and last_datetime > self.since:
-            right = last_datetime
-            left = last_datetime - timedelta(minutes=15)
-            if self.since > left:
-                left = self.since
-                generate_more = False
-            last_datetime = left
-            windows.append({"from": left, "to": right})
-        return windows
-
-    def create_extraction_jobs(self, timewindows):
-        jobs = []
-        for window in timewindows:
-            extraction = HistoryExtract(self.job, window)
-            jobs.append(extraction)
-        return jobs
-
-    def queue_jobs(self, jobs):
-        self.extraction_queue.put(jobs)
+        self.job.backfill = Backfill.start(
+            BACKFILL_DAYS, BACKFILL_WINDOW_MINUTES, now=self.now
+        )
+        if not self.job.save_backfill():
+            logger.error(f"Unable to start the backfill of job {self.job.id}")
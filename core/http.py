@@ -0,0 +1,164 @@
+"""
+Shared HTTP layer for source and destination clients.
+
+Sessions built by throttled_session send every request through a
+ThrottledAdapter, which paces requests with the token bucket of the API key,
+retries throttled and unavailable responses honouring Retry-After, or the
+waitTime of TruSTAR 429 bodies, with jittered exponential backoff, and counts
+calls, retries and throttled responses in the stage being recorded by
+core.metrics.
+"""
+import hashlib
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from core import metrics
+from core.config import HTTP_BACKOFF_SECONDS, HTTP_MAX_ATTEMPTS, HTTP_MAX_WAIT_SECONDS
+from core.logs import get_logger
+from core.throttling import TokenBucket, bucket_from_conf
+
+logger = get_logger(__name__)
+
+THROTTLED_STATUSES = frozenset({429, 503})
+# Only retried for methods that can safely be repeated, unlike 429 these may
+# come after the request was processed
+UNAVAILABLE_STATUSES = frozenset({502, 503, 504})
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+
+
+def retry_after(response: requests.Response) -> Optional[float]:
+    """Seconds asked by the Retry-After header, either seconds or a date"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+def wait_time(response: requests.Response) -> Optional[float]:
+    """
+    Seconds asked by a 429 body, TruSTAR sends {"waitTime": <milliseconds>}
+    instead of a Retry-After header
+    """
+    if response.status_code != 429:
+        return None
+    try:
+        wait = response.json().get("waitTime")
+    except (ValueError, AttributeError):
+        return None
+    try:
+        return max(float(wait), 0) / 1000 if wait is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class ThrottledAdapter(HTTPAdapter):
+    def __init__(
+        self,
+        bucket: TokenBucket = None,
+        max_attempts: int = HTTP_MAX_ATTEMPTS,
+        backoff: float = HTTP_BACKOFF_SECONDS,
+        max_wait: float = HTTP_MAX_WAIT_SECONDS,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.bucket = bucket
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_wait = max_wait
+
+    def _delay(self, attempt: int, response: requests.Response = None) -> float:
+        asked = None
+        if response is not None:
+            asked = retry_after(response)
+            if asked is None:
+                asked = wait_time(response)
+        if asked is not None:
+            return asked
+        # full jitter
+        return random.uniform(0, self.backoff * 2 ** (attempt - 1))
+
+    def _retryable(self, request, response) -> bool:
+        if response.status_code == 429:
+            return True
+        return (
+            response.status_code in UNAVAILABLE_STATUSES
+            and request.method in IDEMPOTENT_METHODS
+        )
+
+    def send(self, request, **kwargs):
+        attempt = 0
+        while True:
+            attempt += 1
+            if self.bucket is not None:
+                self.bucket.acquire()
+            metrics.add(metrics.API_CALLS)
+            try:
+                response = super().send(request, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                if (
+                    attempt >= self.max_attempts
+                    or request.method not in IDEMPOTENT_METHODS
+                ):
+                    raise
+                delay = self._delay(attempt)
+                logger.debug(f"{request.method} {request.url} failed: {ex}")
+            else:
+                if response.status_code in THROTTLED_STATUSES:
+                    metrics.add(metrics.API_THROTTLED)
+                if attempt >= self.max_attempts or not self._retryable(
+                    request, response
+                ):
+                    return response
+                delay = self._delay(attempt, response)
+                if delay > self.max_wait:
+                    logger.warning(
+                        f"{request.method} {request.url} asked to wait {delay}s, "
+                        f"more than {self.max_wait}s"
+                    )
+                    return response
+                logger.debug(
+                    f"{request.method} {request.url} got {response.status_code}"
+                )
+                response.close()
+            metrics.add(metrics.API_RETRIES)
+            logger.debug(f"Retrying in {delay:.3f}s, attempt {attempt}")
+            time.sleep(delay)
+
+
+def bucket_key(api_key: str) -> str:
+    """Buckets are per API key, without keeping the key itself around"""
+    return hashlib.sha256(str(api_key).encode()).hexdigest()
+
+
+def throttled_session(
+    api_key: str, conf: dict, session: requests.Session = None
+) -> requests.Session:
+    """
+    Mounts a ThrottledAdapter on session, a new one if None. The pacing of
+    the API key comes from conf as {"rate_limit": {"rate": ..., "burst": ...}}
+    and, like in the TruSTAR SDK, max_wait_time caps the asked waits.
+    """
+    session = session or requests.Session()
+    adapter = ThrottledAdapter(
+        bucket=bucket_from_conf(bucket_key(api_key), conf),
+        max_wait=float((conf or {}).get("max_wait_time") or HTTP_MAX_WAIT_SECONDS),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
@@ -14,15 +14,23 @@ logging_config = dict(
                 '"level":"%(levelname)s",'
                 '"message":"%(message)s"}'
             )
-        }
+        },
+        # Metrics are already JSON documents (CloudWatch EMF)
+        "emf": {"format": "%(message)s"},
     },
     handlers={
         "h": {
             "class": "logging.StreamHandler",
             "formatter": "f",
             "level": logging.DEBUG,
-        }
+        },
+        "emf": {
+            "class": "logging.StreamHandler",
+            "formatter": "emf",
+            "level": logging.INFO,
+        },
     },
+    loggers={"metrics": {"handlers": ["emf"], "level": "INFO", "propagate": False}},
     root={"handlers": ["h"], "level": config.LOGLEVEL},
 )
 
@@ -31,3 +39,7 @@ dictConfig(logging_config)
 
 def get_logger(name=None):
     return logging.getLogger(name or __name__)
+
+
+def get_metrics_logger():
+    return logging.getLogger("metrics")
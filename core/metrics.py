@@ -0,0 +1,118 @@
+"""
+Per stage instrumentation.
+
+Stages run inside record_stage, which times them and collects counters added
+through add() by any code running in that stage, including the catalog
+callables. When the stage ends its metrics are logged as a CloudWatch Embedded
+Metric Format document and kept in memory for inspection.
+"""
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+from core import config
+from core.logs import get_metrics_logger
+
+metrics_logger = get_metrics_logger()
+
+ITEMS = "items"
+PAYLOAD_BYTES = "payload_bytes"
+QUEUE_HOPS = "queue_hops"
+API_CALLS = "api_calls"
+API_RETRIES = "api_retries"
+API_THROTTLED = "api_throttled"
+
+# Metric name and unit for each StageMetrics field
+EMF_METRICS = {
+    "duration": ("Duration", "Milliseconds"),
+    ITEMS: ("Items", "Count"),
+    PAYLOAD_BYTES: ("PayloadBytes", "Bytes"),
+    QUEUE_HOPS: ("QueueHops", "Count"),
+    API_CALLS: ("ApiCalls", "Count"),
+    API_RETRIES: ("ApiRetries", "Count"),
+    API_THROTTLED: ("ApiThrottled", "Count"),
+}
+
+
+@dataclass
+class StageMetrics:
+    stage: str
+    job_id: str
+    duration: float = 0
+    items: int = 0
+    payload_bytes: int = 0
+    queue_hops: int = 0
+    api_calls: int = 0
+    api_retries: int = 0
+    api_throttled: int = 0
+
+    def to_emf(self) -> dict:
+        document = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": config.METRICS_NAMESPACE,
+                        "Dimensions": [["Stage"]],
+                        "Metrics": [
+                            {"Name": name, "Unit": unit}
+                            for name, unit in EMF_METRICS.values()
+                        ],
+                    }
+                ],
+            },
+            "Stage": self.stage,
+            "JobId": self.job_id,
+        }
+        for field, (name, _) in EMF_METRICS.items():
+            document[name] = getattr(self, field)
+        return document
+
+
+_current: "ContextVar[Optional[StageMetrics]]" = ContextVar(
+    "current_stage_metrics", default=None
+)
+_lock = threading.Lock()
+_recorded: deque = deque(maxlen=1000)
+
+
+@contextmanager
+def record_stage(stage: str, job_id: str):
+    """Times the stage and collects the counters added while it runs"""
+    metrics = StageMetrics(stage=stage, job_id=job_id)
+    token = _current.set(metrics)
+    start = time.perf_counter()
+    try:
+        yield metrics
+    finally:
+        metrics.duration = round((time.perf_counter() - start) * 1000, 3)
+        _current.reset(token)
+        _recorded.append(metrics)
+        metrics_logger.info(json.dumps(metrics.to_emf()))
+
+
+def add(name: str, value: int = 1) -> None:
+    """Adds value to the counter of the stage being recorded, if any"""
+    metrics = _current.get()
+    if metrics is None:
+        return
+    with _lock:
+        setattr(metrics, name, getattr(metrics, name) + value)
+
+
+def current() -> Optional[StageMetrics]:
+    return _current.get()
+
+
+def get_recorded() -> list:
+    """Metrics of the last recorded stages, oldest first"""
+    return [StageMetrics(**asdict(m)) for m in _recorded]
+
+
+def clear_recorded() -> None:
+    _recorded.clear()
@@ -0,0 +1,26 @@
+"""
+Lazy iteration over paginated APIs.
+"""
+from typing import Any, Callable, Iterator
+
+from core.logs import get_logger
+
+logger = get_logger(__name__)
+
+
+def iter_pages(fetch_page: Callable[[int], Any], first_page: int = 0) -> Iterator[list]:
+    """
+    Yields the items of each page returned by fetch_page(page_number), until
+    a page comes empty or says there are no more pages. Pages are only
+    fetched as they are consumed.
+    """
+    page_number = first_page
+    while True:
+        page = fetch_page(page_number)
+        if not page.items:
+            logger.debug("No more items")
+            return
+        yield page.items
+        if not page.has_more_pages():
+            return
+        page_number += 1
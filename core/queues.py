@@ -1,4 +1,6 @@
 from dataclasses import dataclass
+from functools import lru_cache
+
 from core import config
 from core.etl import (
     HistoryExtract,
@@ -26,33 +28,65 @@ class InMemoryQueues:
     history: InMemoryQueue
 
 
+@lru_cache(maxsize=None)
 def get_sqs_queues():
+    """
+    Queues are built once per container and reused across warm invocations
+    """
     extract_jobs = SqsQueue(
         queue_url=config.EXTRACT_JOBS_QUEUE,
         job_type=HistoryExtract,
         large_payload_bucket=config.BIG_PAYLOADS_BUCKET,
+        large_payload_threshold=config.LARGE_PAYLOAD_THRESHOLD,
+        compression=config.PAYLOAD_COMPRESSION,
+        codec=config.JOB_CODEC,
     )
     transform_jobs = SqsQueue(
         queue_url=config.TRANSFORM_JOBS_QUEUE,
         job_type=Transform,
         large_payload_bucket=config.BIG_PAYLOADS_BUCKET,
+        large_payload_threshold=config.LARGE_PAYLOAD_THRESHOLD,
+        compression=config.PAYLOAD_COMPRESSION,
+        codec=config.JOB_CODEC,
     )
     load_jobs = SqsQueue(
         queue_url=config.LOAD_JOBS_QUEUE,
         job_type=Load,
         large_payload_bucket=config.BIG_PAYLOADS_BUCKET,
+        large_payload_threshold=config.LARGE_PAYLOAD_THRESHOLD,
+        compression=config.PAYLOAD_COMPRESSION,
+        codec=config.JOB_CODEC,
     )
     history_jobs = SqsQueue(
         queue_url=config.HISTORY_JOBS_QUEUE,
         job_type=HistoryExtract,
         large_payload_bucket=config.BIG_PAYLOADS_BUCKET,
+        large_payload_threshold=config.LARGE_PAYLOAD_THRESHOLD,
+        compression=config.PAYLOAD_COMPRESSION,
+        codec=config.JOB_CODEC,
     )
     return SqsQueues(extract_jobs, transform_jobs, load_jobs, history_jobs)
 
 
 def get_in_memory_queues():
-    extract_jobs = InMemoryQueue(job_type=HistoryExtract)
-    transform_jobs = InMemoryQueue(job_type=Transform)
-    load_jobs = InMemoryQueue(job_type=Load)
-    history_jobs = InMemoryQueue(job_type=HistoryExtract)
+    extract_jobs = InMemoryQueue(
+        job_type=HistoryExtract,
+        codec=config.JOB_CODEC,
+        compression=config.PAYLOAD_COMPRESSION,
+    )
+    transform_jobs = InMemoryQueue(
+        job_type=Transform,
+        codec=config.JOB_CODEC,
+        compression=config.PAYLOAD_COMPRESSION,
+    )
+    load_jobs = InMemoryQueue(
+        job_type=Load,
+        codec=config.JOB_CODEC,
+        compression=config.PAYLOAD_COMPRESSION,
+    )
+    history_jobs = InMemoryQueue(
+        job_type=HistoryExtract,
+        codec=config.JOB_CODEC,
+        compression=config.PAYLOAD_COMPRESSION,
+    )
     return InMemoryQueues(extract_jobs, transform_jobs, load_jobs, history_jobs)
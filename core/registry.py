@@ -1,19 +1,54 @@
-from typing import Union
+import copy
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Union
 from datetime import datetime, timezone
 
-from core.database import TemplateTable, UserConfTable, JobTable, get_table
+import botocore
+
+from core import config
+from core.backfill import ACTIVE, Backfill
+from core.cache import TTLCache
+from core.database import (
+    ACTIVE_BACKFILL_INDEX,
+    TemplateTable,
+    UserConfTable,
+    JobTable,
+    batch_get_items,
+    get_table,
+)
 from core.logs import get_logger
 
 logger = get_logger(__name__)
 
+# Jobs whose save is deferred to the end of the current coalesced_saves block
+_pending_saves: "ContextVar[dict]" = ContextVar("pending_saves", default=None)
+
+
+def _zero_secrets(secrets):
+    if isinstance(secrets, dict):
+        for key in secrets:
+            secrets[key] = None
+        secrets.clear()
+
 
 class ActiveRecordMixin:
     _table = None
+    # Read-through cache of items, None for classes that are always read.
+    # Nothing invalidates it across containers, edits are seen once the
+    # cached item expires, after REGISTRY_CACHE_TTL seconds at most
+    _cache: TTLCache = None
+    # Attributes never kept in the cache
+    _cache_exclude: tuple = ()
 
     @classmethod
     def _setup_table(cls):
         cls._table = get_table(cls.table_definition)
 
+    @classmethod
+    def _from_item(cls, item):
+        return item
+
     @classmethod
     def _get_by_id(cls, _id):
         logger.debug(f"getting by id {_id}")
@@ -21,13 +56,68 @@ class ActiveRecordMixin:
         if "Item" not in response:
             raise ValueError(f"No record found with id '{_id}' in {cls._table.name}")
         item = response["Item"]
-        return item
+        cls._remember(item)
+        return cls._from_item(item)
+
+    @classmethod
+    def _remember(cls, item):
+        if cls._cache is not None:
+            cls._cache.set(
+                item["id"],
+                {k: v for k, v in item.items() if k not in cls._cache_exclude},
+            )
+
+    @classmethod
+    def _batch_request(cls, ids):
+        """The RequestItems entry of a BatchGetItem for the given ids"""
+        return {"Keys": [{"id": _id} for _id in ids]}
+
+    @classmethod
+    def _get_cached(cls, _id):
+        if cls._cache is None:
+            return None
+        item = cls._cache.get(_id)
+        if item is None:
+            return None
+        logger.debug(f"got {_id} from cache")
+        # Callers are free to mutate what they get
+        return cls._from_item(copy.deepcopy(item))
+
+    @classmethod
+    def invalidate(cls, _id=None):
+        """Drops _id, or everything when _id is None, from the cache"""
+        if cls._cache is None:
+            return
+        if _id is None:
+            cls._cache.clear()
+        else:
+            cls._cache.invalidate(_id)
+
+    @classmethod
+    def all(cls, **scan_kwargs):
+        """Scans the whole table, scan_kwargs are passed along to every scan"""
+        try:
+            cls._setup_table()
+            response = cls._table.scan(**scan_kwargs)
+            items = response["Items"]
+            while "LastEvaluatedKey" in response:
+                response = cls._table.scan(
+                    ExclusiveStartKey=response["LastEvaluatedKey"], **scan_kwargs
+                )
+                items.extend(response["Items"])
+            return [cls._from_item(item) for item in items]
+        except Exception as ex:
+            logger.error(f"{ex}")
+            raise
 
     @classmethod
     def get(cls, _id=None):
         if not any((_id,)):
             raise ValueError("No query lookups provided")
         try:
+            cached = cls._get_cached(_id)
+            if cached is not None:
+                return cached
             cls._setup_table()
             if _id:
                 return cls._get_by_id(_id)
@@ -38,21 +128,29 @@ class ActiveRecordMixin:
 
 class Template(ActiveRecordMixin):
     table_definition = TemplateTable
+    _cache = TTLCache(config.REGISTRY_CACHE_SIZE, config.REGISTRY_CACHE_TTL)
 
-    def __init__(self, _id, extract, transform, load):
+    def __init__(self, _id, extract, transform, load, fuse_threshold=None):
+        """
+        fuse_threshold: extracted payloads up to this many bytes are
+        transformed and loaded inline. None uses config.FUSE_THRESHOLD
+        """
         self.extract = extract
         self.transform = transform
         self.load = load
         self.id = _id
+        self.fuse_threshold = fuse_threshold
 
     @classmethod
-    def _get_by_id(cls, _id):
-        item = super()._get_by_id(_id)
+    def _from_item(cls, item):
         return cls(
             _id=item["id"],
             extract=item["extract"],
             transform=item["transform"],
             load=item["load"],
+            fuse_threshold=int(item["fuse_threshold"])
+            if item.get("fuse_threshold") is not None
+            else None,
         )
 
 
@@ -63,6 +161,11 @@ class UserConf(ActiveRecordMixin):
     """
 
     table_definition = UserConfTable
+    _cache = TTLCache(config.REGISTRY_CACHE_SIZE, config.REGISTRY_CACHE_TTL)
+    _cache_exclude = ("source_secrets", "destination_secrets")
+    _secrets_cache = TTLCache(
+        config.REGISTRY_CACHE_SIZE, config.SECRETS_CACHE_TTL, on_evict=_zero_secrets
+    )
 
     def __init__(
         self,
@@ -117,23 +220,58 @@ class UserConf(ActiveRecordMixin):
 
     @property
     def source_secrets(self):
-        # We will retrieve from database everytime...
-        # I don't want this to linger in memory too much time
-        response = self._table.get_item(Key={"id": self._id})
-        item = response["Item"]
-        return item.get("source_secrets")
+        return self._get_secrets("source_secrets")
 
     @property
     def destination_secrets(self):
-        # We will retrieve from database everytime...
+        return self._get_secrets("destination_secrets")
+
+    @classmethod
+    def _batch_request(cls, ids):
+        # Everything but the secrets
+        attributes = (
+            "id",
+            "source_conf",
+            "destination_conf",
+            "trustar_user_id",
+            "created_at",
+            "updated_at",
+        )
+        return {
+            "Keys": [{"id": _id} for _id in ids],
+            "ProjectionExpression": ", ".join(f"#a{i}" for i in range(len(attributes))),
+            "ExpressionAttributeNames": {
+                f"#a{i}": attribute for i, attribute in enumerate(attributes)
+            },
+        }
+
+    def _get_secrets(self, attribute):
+        # We will retrieve from database everytime unless SECRETS_CACHE_TTL
+        # is set, and then only for a few seconds.
         # I don't want this to linger in memory too much time
-        response = self._table.get_item(Key={"id": self._id})
-        item = response["Item"]
-        return item.get("destination_secrets")
+        key = (self._id, attribute)
+        secrets = self._secrets_cache.get(key)
+        if secrets is None:
+            if self._table is None:
+                self._setup_table()
+            response = self._table.get_item(
+                Key={"id": self._id},
+                ProjectionExpression="#secrets",
+                ExpressionAttributeNames={"#secrets": attribute},
+            )
+            secrets = response["Item"].get(attribute)
+            if secrets is not None:
+                self._secrets_cache.set(key, secrets)
+        # Callers get their own copy so zeroing the cache doesn't affect them
+        return dict(secrets) if secrets is not None else None
 
     @classmethod
-    def _get_by_id(cls, _id):
-        item = super()._get_by_id(_id)
+    def clear_secrets(cls):
+        """Zeroes and drops every cached secret. Call it when done with a job"""
+        cls._secrets_cache.clear()
+
+    @classmethod
+    def _from_item(cls, item):
         return cls(
             _id=item.get("id"),
             source_conf=item.get("source_conf"),
@@ -155,6 +293,8 @@ class Job(ActiveRecordMixin):
         last_run: Union[str, datetime],  # TODO: this can be None cause never ran
         name: str,
         description: str,
+        backfill: Backfill = None,
+        enclave_watermarks: Dict[str, Union[str, datetime]] = None,
     ):
         if not all((_id, user_conf, template)):
             raise ValueError("Arguments can't be None")
@@ -168,6 +308,15 @@ class Job(ActiveRecordMixin):
         self._user_conf = user_conf
         self.name = name
         self.description = description
+        self.backfill = backfill
+        # Per enclave extraction progress, see save_enclave_watermark
+        self.enclave_watermarks: Dict[str, datetime] = {
+            enclave_id: datetime.fromisoformat(watermark)
+            if isinstance(watermark, str)
+            else watermark
+            for enclave_id, watermark in (enclave_watermarks or {}).items()
+        }
+        self._pending_watermarks: Dict[str, datetime] = {}
         if last_run and isinstance(last_run, str):
             self._last_run = datetime.fromisoformat(last_run)
         elif last_run and isinstance(last_run, datetime):
@@ -189,6 +338,10 @@ class Job(ActiveRecordMixin):
             "last_run": self.last_run.isoformat(),
             "name": self.name,
             "description": self.description,
+            "enclave_watermarks": {
+                enclave_id: watermark.isoformat()
+                for enclave_id, watermark in self.enclave_watermarks.items()
+            },
         }
 
     @classmethod
@@ -237,8 +390,7 @@ class Job(ActiveRecordMixin):
         self._last_run = new_datetime
 
     @classmethod
-    def _get_by_id(cls, _id):
-        item = super()._get_by_id(_id)
+    def _from_item(cls, item):
         return cls(
             _id=item.get("id"),
             template=item.get("template"),
@@ -248,7 +400,118 @@ class Job(ActiveRecordMixin):
             else None,
             name=item.get("name", ""),
             description=item.get("description", ""),
+            backfill=Backfill.from_item(item["backfill"])
+            if item.get("backfill")
+            else None,
+            enclave_watermarks=item.get("enclave_watermarks"),
+        )
+
+    @classmethod
+    def with_active_backfill(cls) -> List["Job"]:
+        """
+        Scans the sparse index of active backfills, which only holds the jobs
+        whose backfill is active, instead of the whole table
+        """
+        return cls.all(IndexName=ACTIVE_BACKFILL_INDEX)
+
+    @classmethod
+    def get_many(cls, ids: List[str]) -> List["Job"]:
+        """
+        Gets the jobs with their templates and user confs resolved using
+        one BatchGetItem for the jobs and another one for whatever templates
+        and user confs are not cached. Unknown ids are skipped.
+        """
+        response = batch_get_items(
+            {cls.table_definition.name: cls._batch_request(list(dict.fromkeys(ids)))}
         )
+        items = {i["id"]: i for i in response[cls.table_definition.name]}
+        jobs = [cls._from_item(items[_id]) for _id in ids if _id in items]
+        cls.resolve(jobs)
+        return jobs
+
+    @classmethod
+    def get_resolved(
+        cls, _id: str, template_id: str = None, user_conf_id: str = None
+    ) -> "Job":
+        """
+        Gets a job with its template and user conf resolved. When the template
+        and user conf ids are known everything comes in a single BatchGetItem.
+        """
+        if not (template_id and user_conf_id):
+            jobs = cls.get_many([_id])
+        else:
+            job_table = cls.table_definition.name
+            template = Template._get_cached(template_id)
+            user_conf = UserConf._get_cached(user_conf_id)
+            request = {job_table: cls._batch_request([_id])}
+            if template is None:
+                request[Template.table_definition.name] = Template._batch_request(
+                    [template_id]
+                )
+            if user_conf is None:
+                request[UserConf.table_definition.name] = UserConf._batch_request(
+                    [user_conf_id]
+                )
+            response = batch_get_items(request)
+            jobs = [cls._from_item(item) for item in response[job_table]]
+            cls._attach(jobs, response)
+            cls.resolve(jobs)
+        if not jobs:
+            raise ValueError(
+                f"No record found with id '{_id}' in {cls.table_definition.name}"
+            )
+        return jobs[0]
+
+    @classmethod
+    def resolve(cls, jobs: List["Job"]) -> List["Job"]:
+        """
+        Replaces template and user conf ids with their objects in a single
+        BatchGetItem for all the ones that are not cached
+        """
+        template_ids = set()
+        user_conf_ids = set()
+        for job in jobs:
+            if isinstance(job._template, str):
+                template = Template._get_cached(job._template)
+                if template is None:
+                    template_ids.add(job._template)
+                else:
+                    job._template = template
+            if isinstance(job._user_conf, str):
+                user_conf = UserConf._get_cached(job._user_conf)
+                if user_conf is None:
+                    user_conf_ids.add(job._user_conf)
+                else:
+                    job._user_conf = user_conf
+        request = {}
+        if template_ids:
+            request[Template.table_definition.name] = Template._batch_request(
+                sorted(template_ids)
+            )
+        if user_conf_ids:
+            request[UserConf.table_definition.name] = UserConf._batch_request(
+                sorted(user_conf_ids)
+            )
+        if request:
+            cls._attach(jobs, batch_get_items(request))
+        return jobs
+
+    @classmethod
+    def _attach(cls, jobs: List["Job"], response: dict):
+        """Sets templates and user confs from a batch_get_items response"""
+        templates = {}
+        for item in response.get(Template.table_definition.name, []):
+            Template._remember(item)
+            templates[item["id"]] = item
+        user_confs = {}
+        for item in response.get(UserConf.table_definition.name, []):
+            UserConf._remember(item)
+            user_confs[item["id"]] = item
+        for job in jobs:
+            if isinstance(job._template, str) and job._template in templates:
+                job._template = Template._from_item(templates[job._template])
+            if isinstance(job._user_conf, str) and job._user_conf in user_confs:
+                job._user_conf = UserConf._from_item(user_confs[job._user_conf])
 
     def save(self):
         # TODO: abstract this method
@@ -258,13 +521,233 @@ class Job(ActiveRecordMixin):
         Probably Job is the right one
         What about storing run info for each step? A table for run summaries?
         """
+        pending = _pending_saves.get()
+        if pending is not None:
+            queued = pending.get(self.id)
+            if queued is None or queued.last_run < self.last_run:
+                if queued is not None:
+                    self._merge_watermarks(queued)
+                pending[self.id] = self
+            else:
+                queued._merge_watermarks(self)
+            return False
+
         if self._table is None:
             self._setup_table()
 
-        results = self._table.update_item(
-            Key={"id": self.id},
-            UpdateExpression="SET last_run = :last_run",
-            ExpressionAttributeValues={":last_run": self.last_run.isoformat()},
-            ReturnValues="UPDATED_NEW",
+        # Always stored as UTC so the condition can compare strings
+        last_run = self.last_run.astimezone(timezone.utc).isoformat()
+        try:
+            results = self._table.update_item(
+                Key={"id": self.id},
+                UpdateExpression="SET last_run = :last_run",
+                ConditionExpression=(
+                    "attribute_exists(id) AND "
+                    "(attribute_not_exists(last_run) OR last_run < :last_run)"
+                ),
+                ExpressionAttributeValues={":last_run": last_run},
+                ReturnValues="UPDATED_NEW",
+            )
+        except self._table.meta.client.exceptions.ConditionalCheckFailedException:
+            logger.info(f"Job {self.id} last_run is already at or past {last_run}")
+            saved = False
+        else:
+            logger.debug(f"Updated job {self.id} with values {results}")
+            saved = True
+        self._save_pending_watermarks()
+        return saved
+
+    def save_backfill(self, expected: Backfill = None) -> bool:
+        """
+        Writes the backfill. With expected, the write only happens if the
+        stored backfill is still that one and active: concurrent workers and
+        pause/resize calls win over a stale cursor.
+        """
+        if self._table is None:
+            self._setup_table()
+        condition = "attribute_exists(id)"
+        names = None
+        values = {":backfill": self.backfill.to_item()}
+        update = "SET backfill = :backfill"
+        # Keeps the job in the active backfill index while it's active
+        if self.backfill.active:
+            update += ", active_backfill = :id"
+            values[":id"] = self.id
+        else:
+            update += " REMOVE active_backfill"
+        if expected is not None:
+            # cursor and state are DynamoDB reserved words
+            condition += (
+                " AND backfill.#cursor = :cursor AND backfill.#state = :active"
+                " AND backfill.window_minutes = :window_minutes"
+            )
+            names = {"#cursor": "cursor", "#state": "state"}
+            values.update(
+                {
+                    ":cursor": expected.cursor.isoformat(),
+                    ":active": ACTIVE,
+                    ":window_minutes": expected.window_minutes,
+                }
+            )
+        return self._conditional_update(
+            UpdateExpression=update,
+            ConditionExpression=condition,
+            ExpressionAttributeValues=values,
+            **({"ExpressionAttributeNames": names} if names else {}),
         )
+
+    def update_backfill(self, expected_state: str = None, **changes) -> bool:
+        """Sets some backfill attributes, e.g. state or window_minutes"""
+        if self._table is None:
+            self._setup_table()
+        names = {f"#{k}": k for k in changes}
+        values = {f":{k}": v for k, v in changes.items()}
+        condition = "attribute_exists(backfill)"
+        if expected_state is not None:
+            names["#expected_state"] = "state"
+            values[":expected_state"] = expected_state
+            condition += " AND backfill.#expected_state = :expected_state"
+        update = "SET " + ", ".join(f"backfill.#{k} = :{k}" for k in changes)
+        if changes.get("state") == ACTIVE:
+            update += ", active_backfill = :id"
+            values[":id"] = self.id
+        elif "state" in changes:
+            update += " REMOVE active_backfill"
+        updated = self._conditional_update(
+            UpdateExpression=update,
+            ConditionExpression=condition,
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+        )
+        if updated and self.backfill is not None:
+            for attribute, value in changes.items():
+                setattr(self.backfill, attribute, value)
+        return updated
+
+    def lease_backfill(self, until: datetime, now: datetime = None) -> bool:
+        """
+        Takes the active backfill for this invocation until the given time,
+        False if it isn't active or another invocation holds it. Leases expire
+        on their own so a crashed invocation doesn't hold the backfill.
+        """
+        if self._table is None:
+            self._setup_table()
+        now = now or datetime.now(timezone.utc)
+        leased = self._conditional_update(
+            UpdateExpression="SET backfill.leased_until = :until",
+            ConditionExpression=(
+                "backfill.#state = :active AND ("
+                "attribute_not_exists(backfill.leased_until)"
+                " OR backfill.leased_until < :now)"
+            ),
+            ExpressionAttributeNames={"#state": "state"},
+            ExpressionAttributeValues={
+                ":until": until.isoformat(),
+                ":now": now.isoformat(),
+                ":active": ACTIVE,
+            },
+        )
+        if leased:
+            self.backfill.leased_until = until
+        return leased
+
+    def release_backfill(self) -> bool:
+        """Gives the lease back, unless it expired and was taken since"""
+        if self._table is None:
+            self._setup_table()
+        leased_until = self.backfill.leased_until
+        if leased_until is None:
+            return False
+        self.backfill.leased_until = None
+        return self._conditional_update(
+            UpdateExpression="REMOVE backfill.leased_until",
+            ConditionExpression="backfill.leased_until = :until",
+            ExpressionAttributeValues={":until": leased_until.isoformat()},
+        )
+
+    def set_enclave_watermark(self, enclave_id: str, watermark: datetime) -> None:
+        """
+        Records the progress of an enclave, written on the next save so it
+        doesn't get ahead of the extracted data being queued
+        """
+        current = self._pending_watermarks.get(enclave_id)
+        if current is None or current < watermark:
+            self._pending_watermarks[enclave_id] = watermark
+            self.enclave_watermarks[enclave_id] = watermark
+
+    def _merge_watermarks(self, other: "Job") -> None:
+        for enclave_id, watermark in other._pending_watermarks.items():
+            self.set_enclave_watermark(enclave_id, watermark)
+
+    def _save_pending_watermarks(self) -> None:
+        for enclave_id, watermark in list(self._pending_watermarks.items()):
+            self.save_enclave_watermark(enclave_id, watermark)
+            del self._pending_watermarks[enclave_id]
+
+    def save_enclave_watermark(self, enclave_id: str, watermark: datetime) -> bool:
+        """
+        Moves the watermark of an enclave forward, never back, so that each
+        enclave resumes from its own progress whatever happens to the others
+        """
+        if self._table is None:
+            self._setup_table()
+        update = dict(
+            UpdateExpression="SET enclave_watermarks.#enclave = :watermark",
+            ConditionExpression=(
+                "attribute_not_exists(enclave_watermarks.#enclave)"
+                " OR enclave_watermarks.#enclave < :watermark"
+            ),
+            ExpressionAttributeNames={"#enclave": enclave_id},
+            # Always stored as UTC so the condition can compare strings
+            ExpressionAttributeValues={
+                ":watermark": watermark.astimezone(timezone.utc).isoformat()
+            },
+        )
+        try:
+            updated = self._conditional_update(**update)
+        except botocore.exceptions.ClientError as ex:
+            if ex.response["Error"]["Code"] != "ValidationException":
+                raise
+            # The first watermark of the job also creates the map
+            created = self._conditional_update(
+                UpdateExpression=(
+                    "SET enclave_watermarks = if_not_exists(enclave_watermarks, :empty)"
+                ),
+                ConditionExpression="attribute_exists(id)",
+                ExpressionAttributeValues={":empty": {}},
+            )
+            updated = created and self._conditional_update(**update)
+        if updated:
+            self.enclave_watermarks[enclave_id] = watermark
+        return updated
+
+    def _conditional_update(self, **update_kwargs) -> bool:
+        try:
+            results = self._table.update_item(
+                Key={"id": self.id}, ReturnValues="UPDATED_NEW", **update_kwargs
+            )
+        except self._table.meta.client.exceptions.ConditionalCheckFailedException:
+            logger.info(f"Job {self.id} changed, not updated")
+            return False
         logger.debug(f"Updated job {self.id} with values {results}")
+        return True
+
+
+@contextmanager
+def coalesced_saves():
+    """
+    Defers Job.save calls made inside the block and writes once per job, with
+    the most recent last_run, on exit. A crash before the exit only means the
+    deferred windows are extracted again.
+    """
+    pending: dict = {}
+    token = _pending_saves.set(pending)
+    try:
+        yield pending
+    finally:
+        _pending_saves.reset(token)
+        for job in pending.values():
+            try:
+                job.save()
+            except Exception as ex:
+                logger.error(f"Unable to save job {job.id}: {ex}")
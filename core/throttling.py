@@ -0,0 +1,80 @@
+"""
+Client side rate limiting of calls to sources and destinations.
+
+Each API key gets a TokenBucket shared by every thread of the process, the
+HTTP layer in core.http takes a token before each request. That is the only
+place calls are paced: extractors and loaders don't take tokens themselves,
+their clients send every request through core.http.throttled_session.
+"""
+import threading
+import time
+from typing import Dict, Optional
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket: rate tokens per second up to capacity
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.capacity = capacity if capacity else max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def acquire(self, tokens: float = 1) -> float:
+        """Blocks until tokens are available, returns the seconds waited"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+_buckets: Dict[str, TokenBucket] = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(key: str, rate: float, capacity: float = None) -> TokenBucket:
+    """The process wide bucket for key, replaced if its limits changed"""
+    with _buckets_lock:
+        bucket = _buckets.get(key)
+        if bucket is None or (bucket.rate, bucket.capacity) != (
+            rate,
+            capacity if capacity else max(rate, 1),
+        ):
+            bucket = TokenBucket(rate, capacity)
+            _buckets[key] = bucket
+        return bucket
+
+
+def bucket_from_conf(key: str, conf: dict) -> Optional[TokenBucket]:
+    """
+    Bucket configured in a source or destination conf as
+    {"rate_limit": {"rate": <requests per second>, "burst": <requests>}}
+    """
+    rate_limit = (conf or {}).get("rate_limit")
+    if not rate_limit or not rate_limit.get("rate"):
+        return None
+    return get_bucket(
+        key, float(rate_limit["rate"]), float(rate_limit.get("burst") or 0)
+    )
+
+
+def clear_buckets() -> None:
+    with _buckets_lock:
+        _buckets.clear()
@@ -0,0 +1,146 @@
+"""
+Adaptive extraction windows.
+
+Sources cap how much a single query returns (TruSTAR's 10,000 reports, MISP's
+page limit) so a fixed window either truncates busy periods or wastes
+invocations on quiet ones. Windows that hit a cap are bisected until their
+results fit and the WindowPlanner sizes the next window out of the number of
+items the previous one had. Windows expected to hit a cap are split before
+being pulled at all, so the capped results aren't downloaded just to be
+thrown away.
+"""
+
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable, Iterator, List, Tuple
+
+from core.config import WINDOW_MAX_MINUTES, WINDOW_MIN_MINUTES, WINDOW_TARGET_ITEMS
+from core.logs import get_logger
+
+logger = get_logger(__name__)
+
+# Smallest step of the sources' time filters, TruSTAR takes milliseconds
+RESOLUTION = timedelta(milliseconds=1)
+
+
+@dataclass
+class WindowPlanner:
+    min_minutes: int = WINDOW_MIN_MINUTES
+    max_minutes: int = WINDOW_MAX_MINUTES
+    target_items: int = WINDOW_TARGET_ITEMS
+
+    @staticmethod
+    def expected_items(minutes: float, last_minutes: float, last_items: int) -> float:
+        """Items a window is expected to hold at the pace of the last one"""
+        return last_items * minutes / last_minutes if last_minutes else 0
+
+    def next_minutes(self, minutes: int, items: int) -> int:
+        """
+        Doubles windows with less than half the target items and halves the
+        ones with more than twice the target.
+        """
+        if items < self.target_items / 2:
+            minutes *= 2
+        elif items > self.target_items * 2:
+            minutes //= 2
+        return min(max(minutes, self.min_minutes), self.max_minutes)
+
+
+def bisect(
+    since: datetime, to: datetime, resolution: timedelta = RESOLUTION
+) -> Tuple[dict, dict]:
+    """
+    Halves of a window that don't overlap: sources take both bounds
+    inclusively, so the first half ends one resolution step before the
+    middle, where the second one starts.
+    """
+    middle = since + (to - since) / 2 // resolution * resolution
+    return {"from": since, "to": middle - resolution}, {"from": middle, "to": to}
+
+
+def iter_bisecting(
+    pull: Callable[[datetime, datetime], List],
+    since: datetime,
+    to: datetime,
+    cap: int,
+    min_window: timedelta = timedelta(minutes=WINDOW_MIN_MINUTES),
+    resolution: timedelta = RESOLUTION,
+    expected: float = 0,
+) -> Iterator[Tuple[dict, List]]:
+    """
+    Calls pull(since, to) and, when it returns cap or more results, pulls
+    both halves of the window instead. Windows expected to hold cap or more
+    items, as planned by the caller or as many as the half before them had,
+    are halved without being pulled first. Windows that can't be halved
+    without going below min_window are returned truncated. Yields each window
+    pulled in full with its results, oldest first.
+    """
+    splittable = (to - since) / 2 >= min_window
+    if splittable and expected >= cap:
+        logger.debug(
+            f"Window {since.isoformat()} - {to.isoformat()} expected to reach {cap}"
+        )
+        yield from _iter_halves(
+            pull, since, to, cap, min_window, resolution, expected / 2
+        )
+        return
+    results = pull(since, to)
+    if len(results) < cap:
+        yield {"from": since, "to": to}, results
+        return
+    if not splittable:
+        logger.warning(
+            f"Window {since.isoformat()} - {to.isoformat()} reached the cap "
+            f"of {cap} results and can't be split further"
+        )
+        yield {"from": since, "to": to}, results
+        return
+    logger.debug(f"Window {since.isoformat()} - {to.isoformat()} reached {cap}")
+    yield from _iter_halves(pull, since, to, cap, min_window, resolution, 0)
+
+
+def _iter_halves(
+    pull: Callable[[datetime, datetime], List],
+    since: datetime,
+    to: datetime,
+    cap: int,
+    min_window: timedelta,
+    resolution: timedelta,
+    expected: float,
+) -> Iterator[Tuple[dict, List]]:
+    first, second = bisect(since, to, resolution)
+    counted = 0
+    for window, results in iter_bisecting(
+        pull, first["from"], first["to"], cap, min_window, resolution, expected
+    ):
+        counted += len(results)
+        yield window, results
+    # Busy periods tend to go on, the first half tells about the second one
+    yield from iter_bisecting(
+        pull,
+        second["from"],
+        second["to"],
+        cap,
+        min_window,
+        resolution,
+        max(expected, counted),
+    )
+
+
+def pull_bisecting(
+    pull: Callable[[datetime, datetime], List],
+    since: datetime,
+    to: datetime,
+    cap: int,
+    min_window: timedelta = timedelta(minutes=WINDOW_MIN_MINUTES),
+    resolution: timedelta = RESOLUTION,
+    expected: float = 0,
+) -> List:
+    """The results of every window of iter_bisecting"""
+    return [
+        result
+        for _, results in iter_bisecting(
+            pull, since, to, cap, min_window, resolution, expected
+        )
+        for result in results
+    ]
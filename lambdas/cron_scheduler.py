@@ -1,15 +1,14 @@
 import json
 
 
-import boto3
 import botocore
 
 from enum import Enum
 
 from core import config
+from core.aws import get_client
 from core.logs import get_logger
 from core.registry import Job
-from core.queues import get_sqs_queues
 from core.etl import HistoricalIngestHandler
 
 
@@ -22,19 +21,26 @@ class DynamoEvent(Enum):
     REMOVE = "REMOVE"
 
 
+# Job attributes written by the pipeline itself, they don't affect schedules
+IGNORED_ATTRIBUTES = frozenset(
+    {"last_run", "backfill", "active_backfill", "enclave_watermarks"}
+)
+
+
 def lambda_handler(event, context):
     # Build a job object
     logger.debug(f"Handling event {event}")
     logger.debug(context)
     # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/cw-example-events.html
-    events = boto3.client("events")
-    lambdas = boto3.client("lambda")
+    events = get_client("events")
+    lambdas = get_client("lambda")
     handlers = {
         DynamoEvent.INSERT.value: handle_insert,
         DynamoEvent.MODIFY.value: handle_modify,
         DynamoEvent.REMOVE.value: handle_remove,
     }
-    for record in event.get("Records", []):
+    records = event.get("Records", [])
+    for record in collapse_records(records):
         try:
             handlers[record["eventName"]](record, events, lambdas)
         except Exception as e:
@@ -42,10 +48,51 @@ def lambda_handler(event, context):
             logger.exception(e)
 
 
+def is_schedule_change(record) -> bool:
+    """
+    False for MODIFY records whose only changes are in IGNORED_ATTRIBUTES.
+    Records without both images (KEYS_ONLY streams) are always a change.
+    """
+    if record.get("eventName") != DynamoEvent.MODIFY.value:
+        return True
+    images = record.get("dynamodb", {})
+    if "NewImage" not in images or "OldImage" not in images:
+        return True
+
+    def relevant(image):
+        return {k: v for k, v in image.items() if k not in IGNORED_ATTRIBUTES}
+
+    return relevant(images["NewImage"]) != relevant(images["OldImage"])
+
+
+def collapse_records(records) -> list:
+    """
+    Drops records that don't change a schedule and keeps a single record per
+    job id. Handlers read the Job again so the latest record is enough, except
+    that an INSERT followed by MODIFYs is still handled as an INSERT.
+    """
+    latest = {}
+    for record in records:
+        if not is_schedule_change(record):
+            logger.debug(f"Skipping record {record.get('eventID')}: no changes")
+            continue
+        job_id = record["dynamodb"]["Keys"]["id"]["S"]
+        # pop to keep the dict in order of the latest record per job
+        previous = latest.pop(job_id, None)
+        if (
+            previous is not None
+            and previous["eventName"] == DynamoEvent.INSERT.value
+            and record["eventName"] == DynamoEvent.MODIFY.value
+        ):
+            record = previous
+        latest[job_id] = record
+    return list(latest.values())
+
+
 def handle_insert(record, events, lambdas):
     job_id = record["dynamodb"]["Keys"]["id"]["S"]
     handler = DynamoInsertHandler()
-    history_handler = HistoricalIngestHandler(job_id, get_sqs_queues())
+    history_handler = HistoricalIngestHandler(job_id)
     handler(record, events, lambdas)
     history_handler.schedule_jobs()
 
@@ -1,21 +1,49 @@
-from core.etl import Extract
+from core.etl import Extract, QueuePutError
 from core.assembly import extraction_stage
+from core.callables import prewarm_templates
+from core.concurrency import Deadline, DeadlineExceeded
+from core.config import EXTRACTION_TIME_RESERVE_MS, PREWARM_CALLABLES
 from core.logs import get_logger
 from core.queues import get_sqs_queues
+from core.registry import UserConf, coalesced_saves
 
 logger = get_logger(__name__)
 
+if PREWARM_CALLABLES:
+    prewarm_templates()
+
 
 def lambda_handler(event, context):
     logger.debug(event)
     logger.debug(context)
     queues = get_sqs_queues()
-    for record in event["Records"]:
-        try:
-            serialized_job = record["body"]
-            job: Extract = queues.extract.build_job(serialized_job)
-            extraction_stage(job, queues.transform)
-            queues.extract.delete_message(record["receiptHandle"])
-        except Exception as e:
-            logger.error(record)
-            logger.exception(e)
+    deadline = Deadline(context, EXTRACTION_TIME_RESERVE_MS)
+    # Records reported back as failed stay in the queue and are redelivered,
+    # see ReportBatchItemFailures in template.yaml
+    failures = []
+    # One watermark write per job instead of one per window
+    with coalesced_saves():
+        for position, record in enumerate(event["Records"]):
+            try:
+                serialized_job = record["body"]
+                job: Extract = queues.extract.build_job(serialized_job)
+                extraction_stage(job, queues.transform, deadline=deadline)
+                queues.extract.delete_message(record["receiptHandle"])
+            except DeadlineExceeded as e:
+                # Redelivered, the interrupted one resumes from its checkpoint
+                logger.warning(e)
+                failures.extend(
+                    {"itemIdentifier": r["messageId"]}
+                    for r in event["Records"][position:]
+                )
+                break
+            except QueuePutError as e:
+                # Its last_run didn't move, the redelivery extracts it again
+                logger.error(e)
+                failures.append({"itemIdentifier": record["messageId"]})
+            except Exception as e:
+                logger.error(record)
+                logger.exception(e)
+    # Don't let secrets outlive the invocation
+    UserConf.clear_secrets()
+    return {"batchItemFailures": failures}
@@ -1,24 +1,155 @@
-from queue import Empty
+import copy
+from dataclasses import replace
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from typing import List
+
 from core.etl import HistoryExtract
 from core.assembly import extraction_stage
+from core.callables import prewarm_templates
 from core.logs import get_logger
 from core.queues import get_sqs_queues
-from core.config import HISTORY_MESSAGES_RATE
+from core.registry import Job, UserConf
+from core.concurrency import Deadline, bounded_map
+from core.config import (
+    BACKFILL_LEASE_SECONDS,
+    HISTORY_MESSAGES_RATE,
+    HISTORY_TIME_RESERVE_MS,
+    HISTORY_WORKERS,
+    PREWARM_CALLABLES,
+)
+from core.windows import WindowPlanner
 
 logger = get_logger(__name__)
 
+if PREWARM_CALLABLES:
+    prewarm_templates()
+
 
 def lambda_handler(event, context):
     logger.debug(event)
     logger.debug(context)
     queues = get_sqs_queues()
-    for _ in range(HISTORY_MESSAGES_RATE):
+    deadline = Deadline(context, HISTORY_TIME_RESERVE_MS)
+    # Windows queued before backfill cursors existed
+    jobs: List[HistoryExtract] = queues.history.get_many(HISTORY_MESSAGES_RATE)
+    for job in jobs:
         try:
-            job: HistoryExtract = queues.history.get()
             logger.debug(f"Job ID: {job.job.id} - window {job.window}")
             extraction_stage(job, queues.transform, is_historical=True)
-        except Empty:
-            logger.info("No Historical data to ingest")
+        except Exception as e:
+            logger.error(e)
+
+    backfilling = Job.resolve(Job.with_active_backfill())
+    if not jobs and not backfilling:
+        logger.info("No Historical data to ingest")
+    for job in backfilling:
+        if deadline.expired():
+            logger.info("Not enough time left for more backfill windows")
             break
+        try:
+            advance_backfill(
+                job,
+                queues.transform,
+                HISTORY_MESSAGES_RATE,
+                workers=HISTORY_WORKERS,
+                deadline=deadline,
+            )
         except Exception as e:
             logger.error(e)
+    # Don't let secrets outlive the invocation
+    UserConf.clear_secrets()
+
+
+def extract_window(job: Job, queue, deadline: Deadline, window: dict) -> int:
+    deadline.check()
+    logger.debug(f"Job ID: {job.id} - backfill window {window}")
+    # Every window gets its own copy, HistoryExtract sets the window in it
+    return extraction_stage(
+        HistoryExtract(copy.deepcopy(job), window),
+        queue,
+        is_historical=True,
+        deadline=deadline,
+    )
+
+
+def advance_backfill(
+    job: Job,
+    queue,
+    max_windows: int,
+    planner: WindowPlanner = None,
+    workers: int = 1,
+    deadline: Deadline = None,
+) -> int:
+    """
+    Extracts up to max_windows windows of the job's backfill, workers of them
+    at a time, moving the cursor after each batch over the windows that
+    succeeded without a gap. Stops as soon as a window fails, time runs
+    short or the cursor can't be moved, which means the backfill was paused,
+    resized or advanced by someone else.
+    The backfill is leased for the rest of the invocation first, nothing is
+    extracted while an overlapping invocation holds it.
+    Window sizes follow the planner so quiet periods take fewer windows.
+    """
+    planner = planner or WindowPlanner()
+    deadline = deadline or Deadline()
+    remaining_ms = deadline.remaining_ms()
+    lease = remaining_ms / 1000 if remaining_ms is not None else BACKFILL_LEASE_SECONDS
+    if not job.lease_backfill(datetime.now(timezone.utc) + timedelta(seconds=lease)):
+        logger.info(f"Backfill of job {job.id} is held by another invocation")
+        return 0
+    try:
+        return _advance_leased_backfill(
+            job, queue, max_windows, planner, workers, deadline
+        )
+    finally:
+        job.release_backfill()
+
+
+def _advance_leased_backfill(
+    job: Job,
+    queue,
+    max_windows: int,
+    planner: WindowPlanner,
+    workers: int,
+    deadline: Deadline,
+) -> int:
+    extracted = 0
+    # Minutes and items of the last extracted window
+    last = (0, 0)
+    while extracted < max_windows and not deadline.expired():
+        windows = job.backfill.next_windows(min(workers, max_windows - extracted))
+        if not windows:
+            break
+        for window in windows:
+            # Lets the extractors split busy windows before pulling them
+            window["expected_items"] = planner.expected_items(minutes(window), *last)
+        outcomes = bounded_map(
+            partial(extract_window, job, queue, deadline), windows, workers
+        )
+        expected = replace(job.backfill)
+        for window, outcome in zip(windows, outcomes):
+            if not outcome.ok:
+                logger.warning(
+                    f"Job ID: {job.id} - backfill window {window} failed: "
+                    f"{outcome.error}"
+                )
+                break
+            job.backfill.advance(window)
+            job.backfill.window_minutes = planner.next_minutes(
+                job.backfill.window_minutes, outcome.value
+            )
+            last = (minutes(window), outcome.value)
+            extracted += 1
+        if job.backfill == expected:
+            break
+        if not job.save_backfill(expected=expected):
+            logger.info(f"Backfill of job {job.id} changed, stopping")
+            break
+        if not all(outcome.ok for outcome in outcomes):
+            break
+    return extracted
+
+
+def minutes(window: dict) -> float:
+    return (window["to"] - window["from"]) / timedelta(minutes=1)
@@ -1,10 +1,16 @@
 from core.etl import Load
 from core.assembly import loading_stage
+from core.callables import prewarm_templates
+from core.config import PREWARM_CALLABLES
 from core.logs import get_logger
 from core.queues import get_sqs_queues
+from core.registry import UserConf
 
 logger = get_logger(__name__)
 
+if PREWARM_CALLABLES:
+    prewarm_templates()
+
 
 def lambda_handler(event, context):
     logger.debug(event)
@@ -19,3 +25,5 @@ def lambda_handler(event, context):
         except Exception as e:
             logger.error(record)
             logger.exception(e)
+    # Don't let secrets outlive the invocation
+    UserConf.clear_secrets()
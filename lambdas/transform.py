@@ -1,21 +1,33 @@
-from core.etl import Transform
+from core.etl import QueuePutError, Transform
 from core.assembly import transformation_stage
+from core.callables import prewarm_templates
+from core.config import PREWARM_CALLABLES
 from core.logs import get_logger
 from core.queues import get_sqs_queues
 
 logger = get_logger(__name__)
 
+if PREWARM_CALLABLES:
+    prewarm_templates()
+
 
 def lambda_handler(event, context):
     logger.debug(event)
     logger.debug(context)
     queues = get_sqs_queues()
+    # Records reported back as failed stay in the queue and are redelivered,
+    # see ReportBatchItemFailures in template.yaml
+    failures = []
     for record in event["Records"]:
         try:
             serialized_job = record["body"]
             job: Transform = queues.transform.build_job(serialized_job)
             transformation_stage(job, queues.load)
             queues.transform.delete_message(record["receiptHandle"])
+        except QueuePutError as e:
+            logger.error(e)
+            failures.append({"itemIdentifier": record["messageId"]})
         except Exception as e:
             logger.error(record)
             logger.exception(e)
+    return {"batchItemFailures": failures}
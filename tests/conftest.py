@@ -2,7 +2,7 @@ import pytest
 
 import os
 
-from moto import mock_dynamodb2
+from moto import mock_dynamodb2, mock_sqs
 
 import core.config as config
 
@@ -14,11 +14,13 @@ def aws_credentials():
     os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
     os.environ["AWS_SECURITY_TOKEN"] = "testing"
     os.environ["AWS_SESSION_TOKEN"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
 
 
 @pytest.fixture(scope="function")
 def dynamo(aws_credentials):
     with mock_dynamodb2():
+        from core.registry import Template, UserConf
         from core.database import (
             create_tables,
             load_fixtures,
@@ -30,9 +32,21 @@ def dynamo(aws_credentials):
         tables = [TemplateTable, JobTable, UserConfTable]
         create_tables(tables)
         load_fixtures(tables, config.FIXTURE_PATH)
+        Template.invalidate()
+        UserConf.invalidate()
         yield
 
 
+@pytest.fixture(scope="function")
+def sqs_queue_url(aws_credentials):
+    import boto3
+
+    with mock_sqs():
+        sqs = boto3.client("sqs", region_name="us-east-1")
+        response = sqs.create_queue(QueueName="etl-assembly-test")
+        yield response["QueueUrl"]
+
+
 @pytest.fixture(scope="function")
 def job(mocker, dynamo):
     from core.registry import Job, Template, UserConf
@@ -1,5 +1,9 @@
 import pytest
-from lambdas.cron_scheduler import lambda_handler, HistoricalIngestHandler
+from lambdas.cron_scheduler import (
+    lambda_handler,
+    collapse_records,
+    HistoricalIngestHandler,
+)
 from core.queues import get_in_memory_queues
 
 
@@ -13,6 +17,46 @@ def test_historical_ingest_handler(trustar_extraction_job, mocker):
     assert queues.extract
 
 
+def stream_record(event_name, job_id, old_image=None, new_image=None):
+    record = {
+        "eventName": event_name,
+        "dynamodb": {"Keys": {"id": {"S": job_id}}},
+    }
+    if old_image is not None:
+        record["dynamodb"]["OldImage"] = old_image
+    if new_image is not None:
+        record["dynamodb"]["NewImage"] = new_image
+    return record
+
+
+def test_last_run_only_modifications_are_skipped():
+    image = {"id": {"S": "jobid"}, "user_conf": {"S": "confid"}}
+    last_run_only = stream_record(
+        "MODIFY",
+        "jobid",
+        dict(image, last_run={"S": "2020-08-20T18:00:00+00:00"}),
+        dict(image, last_run={"S": "2020-08-20T18:15:00+00:00"}),
+    )
+    renamed = stream_record(
+        "MODIFY", "otherjobid", image, dict(image, name={"S": "renamed"})
+    )
+    keys_only = stream_record("MODIFY", "keysonlyjobid")
+
+    assert collapse_records([last_run_only, renamed, keys_only]) == [
+        renamed,
+        keys_only,
+    ]
+
+
+def test_records_are_deduped_per_job():
+    insert = stream_record("INSERT", "jobid")
+    modify = stream_record("MODIFY", "jobid")
+    remove = stream_record("REMOVE", "otherjobid")
+
+    assert collapse_records([insert, remove, modify, modify]) == [remove, insert]
+    assert collapse_records([modify, remove, modify]) == [remove, modify]
+
+
 @pytest.mark.skip(reason="no way of currently testing this")
 def test_remove_dynamo_event():
     mock_event = {
@@ -61,3 +61,45 @@ def test_perform_extraction_job():
     }
 
     lambda_handler(mock_event, None)
+
+
+def test_interrupted_extractions_are_reported_for_redelivery(mocker):
+    from core.concurrency import DeadlineExceeded
+
+    queues = mocker.patch("lambdas.extraction.get_sqs_queues").return_value
+    extraction_stage = mocker.patch(
+        "lambdas.extraction.extraction_stage",
+        side_effect=[None, DeadlineExceeded("no time left")],
+    )
+    records = [
+        {"messageId": str(i), "receiptHandle": f"handle-{i}", "body": "{}"}
+        for i in range(3)
+    ]
+
+    response = lambda_handler({"Records": records}, None)
+
+    assert response == {
+        "batchItemFailures": [{"itemIdentifier": "1"}, {"itemIdentifier": "2"}]
+    }
+    assert extraction_stage.call_count == 2
+    queues.extract.delete_message.assert_called_once_with("handle-0")
+
+
+def test_extractions_that_could_not_be_queued_are_redelivered(mocker):
+    from core.etl import PutResult, QueuePutError
+
+    queues = mocker.patch("lambdas.extraction.get_sqs_queues").return_value
+    failed = PutResult(job=mocker.MagicMock(), error="InternalError")
+    mocker.patch(
+        "lambdas.extraction.extraction_stage",
+        side_effect=[QueuePutError([failed]), None],
+    )
+    records = [
+        {"messageId": str(i), "receiptHandle": f"handle-{i}", "body": "{}"}
+        for i in range(2)
+    ]
+
+    response = lambda_handler({"Records": records}, None)
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "0"}]}
+    queues.extract.delete_message.assert_called_once_with("handle-1")
@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta, timezone
+
+from core.backfill import Backfill
+from core.queues import get_in_memory_queues
+from lambdas.historical_extraction import advance_backfill
+
+JOB_ID = "7f9010e3-f1b9-408a-8fbf-85fe20f8fd34"
+NOW = datetime(2020, 9, 1, tzinfo=timezone.utc)
+
+
+def test_backfill_cursor_advances_per_window(dynamo, mocker):
+    from core.registry import Job
+
+    extraction_stage = mocker.patch(
+        "lambdas.historical_extraction.extraction_stage", return_value=0
+    )
+    mocker.patch("lambdas.historical_extraction.HistoryExtract")
+    job = Job.get(JOB_ID)
+    job.backfill = Backfill.start(days=1, window_minutes=60, now=NOW)
+    job.save_backfill()
+    job = Job.get(JOB_ID)
+
+    extracted = advance_backfill(job, get_in_memory_queues().transform, 3)
+
+    assert extracted == 3
+    assert extraction_stage.call_count == 3
+    # quiet windows double in size: 60, 120 and 240 minutes
+    assert Job.get(JOB_ID).backfill.cursor == datetime(
+        2020, 8, 31, 17, tzinfo=timezone.utc
+    )
+    assert Job.get(JOB_ID).backfill.window_minutes == 480
+
+
+def test_cursor_stops_at_the_first_failed_window(dynamo, mocker):
+    from core.registry import Job
+    from core.windows import WindowPlanner
+
+    def extraction_stage(extract, queue, is_historical, deadline=None):
+        if extract.window["to"] == datetime(2020, 8, 31, 22, tzinfo=timezone.utc):
+            raise Exception("source unavailable")
+        return 200
+
+    mocker.patch(
+        "lambdas.historical_extraction.extraction_stage", side_effect=extraction_stage
+    )
+    mocker.patch(
+        "lambdas.historical_extraction.HistoryExtract",
+        side_effect=lambda job, window: mocker.MagicMock(window=window),
+    )
+    job = Job.get(JOB_ID)
+    job.backfill = Backfill.start(days=1, window_minutes=60, now=NOW)
+    job.save_backfill()
+    job = Job.get(JOB_ID)
+
+    extracted = advance_backfill(
+        job,
+        get_in_memory_queues().transform,
+        4,
+        planner=WindowPlanner(target_items=200),
+        workers=4,
+    )
+
+    assert extracted == 2
+    assert Job.get(JOB_ID).backfill.cursor == datetime(
+        2020, 8, 31, 22, tzinfo=timezone.utc
+    )
+
+
+def test_leased_backfills_are_left_to_their_invocation(dynamo, mocker):
+    from core.registry import Job
+
+    extraction_stage = mocker.patch(
+        "lambdas.historical_extraction.extraction_stage", return_value=0
+    )
+    mocker.patch("lambdas.historical_extraction.HistoryExtract")
+    job = Job.get(JOB_ID)
+    job.backfill = Backfill.start(days=1, window_minutes=60, now=NOW)
+    job.save_backfill()
+    running = Job.get(JOB_ID)
+    assert running.lease_backfill(datetime.now(timezone.utc) + timedelta(minutes=15))
+
+    assert advance_backfill(Job.get(JOB_ID), get_in_memory_queues().transform, 3) == 0
+    assert not extraction_stage.called
+
+    running.release_backfill()
+    assert advance_backfill(Job.get(JOB_ID), get_in_memory_queues().transform, 3) == 3
+    assert Job.get(JOB_ID).backfill.leased_until is None
@@ -43,3 +43,125 @@ def test_loading_stage(job):
 
     load = Load(job, ["foo", "bar", "baz"])
     loading_stage(load_job=load)
+
+
+def test_partition_data_by_items_and_bytes():
+    from core.assembly import partition_data
+
+    assert [len(p) for p in partition_data(list(range(25)), max_items=10)] == [
+        10,
+        10,
+        5,
+    ]
+    big = ["x" * 100] * 5
+    assert [len(p) for p in partition_data(big, max_bytes=250)] == [2, 2, 1]
+    assert partition_data({"not": "a list"}) == [{"not": "a list"}]
+
+
+def test_transformation_and_loading_jobs_are_partitioned(job):
+    from core.assembly import create_transformation_job, create_loading_job
+    from core.etl import Extract, Transform
+
+    extract_job = Extract(job)
+    transform_jobs = create_transformation_job(
+        extract_job, [{"foo": i} for i in range(10)], partition_items=4
+    )
+    assert [len(j.extracted_data) for j in transform_jobs] == [4, 4, 2]
+
+    load_jobs = create_loading_job(
+        Transform(job, ["foo"]), ["bar"] * 7, partition_items=5
+    )
+    assert [len(j.transformed_data) for j in load_jobs] == [5, 2]
+
+
+def test_small_extractions_are_fused(job, mocker):
+    from queue import Empty
+
+    from core import assembly
+    from core.etl import InMemoryQueue, Extract, Transform
+
+    job.template.fuse_threshold = 1024
+    run_loading_job = mocker.spy(assembly, "run_loading_job")
+    queue = InMemoryQueue(job_type=Transform)
+
+    assembly.extraction_stage(extract_job=Extract.build(job=job), queue=queue)
+
+    assert run_loading_job.call_count == 1
+    with pytest.raises(Empty):
+        queue.get()
+
+
+def test_big_extractions_are_not_fused(job, mocker):
+    from core import assembly
+    from core.etl import Extract
+
+    job.template.fuse_threshold = 1
+
+    assert not assembly.should_fuse(Extract.build(job=job), [{"foo": 1}])
+
+
+def test_small_lazy_extractions_are_fused(job, mocker):
+    from core import assembly
+    from core.etl import Extract
+
+    job.template.fuse_threshold = 64
+    extract_job = Extract.build(job=job)
+
+    assert assembly.collect_if_fusable(extract_job, iter([{"foo": 1}])) == [{"foo": 1}]
+    big = assembly.collect_if_fusable(extract_job, iter([{"foo": i} for i in range(9)]))
+    assert not isinstance(big, list)
+    assert list(big) == [{"foo": i} for i in range(9)]
+
+
+def test_lazy_extractions_are_partitioned_as_produced(job):
+    from core.assembly import stream_transformation_jobs
+    from core.etl import Extract
+    from core.queues import get_in_memory_queues
+
+    queues = get_in_memory_queues()
+    queued_while_extracting = []
+
+    def extracted():
+        for i in range(5):
+            queued_while_extracting.append(queues.transform._q.qsize())
+            yield {"i": i}
+
+    items = stream_transformation_jobs(
+        Extract(job), extracted(), queues.transform, partition_items=2
+    )
+
+    assert items == 5
+    assert queued_while_extracting == [0, 0, 1, 1, 2]
+    assert queues.transform._q.qsize() == 3
+
+
+def test_extraction_stage_counts_lazy_extractions(job, mocker):
+    from core.assembly import extraction_stage
+    from core.etl import Extract
+    from core.queues import get_in_memory_queues
+
+    mocker.patch(
+        "core.assembly.run_extraction_job",
+        return_value=(iter([{"i": i} for i in range(3)]), None),
+    )
+
+    items = extraction_stage(
+        Extract(job), get_in_memory_queues().transform, is_historical=True
+    )
+
+    assert items == 3
+
+
+def test_last_run_stays_when_transform_jobs_are_not_queued(job, mocker):
+    from core.assembly import extraction_stage
+    from core.etl import Extract, PutResult, QueuePutError
+
+    queue = mocker.MagicMock()
+    queue.put.side_effect = QueuePutError([PutResult(job=mocker.MagicMock())])
+    last_run = job.last_run
+
+    with pytest.raises(QueuePutError):
+        extraction_stage(Extract.build(job=job), queue)
+
+    assert job.last_run == last_run
+    assert not job.save.called
@@ -0,0 +1,26 @@
+import threading
+
+from core.aws import clear_pool, get_client, get_resource
+
+
+def test_clients_are_pooled_by_service_region_and_endpoint(aws_credentials):
+    clear_pool()
+    sqs = get_client("sqs", "us-east-1")
+
+    assert get_client("sqs", "us-east-1") is sqs
+    assert get_client("sqs", "us-east-2") is not sqs
+    assert get_client("sqs", "us-east-1", "http://localhost:4566") is not sqs
+
+
+def test_resources_are_pooled_per_thread(aws_credentials):
+    clear_pool()
+    dynamodb = get_resource("dynamodb", "us-east-1")
+    other_thread = []
+    thread = threading.Thread(
+        target=lambda: other_thread.append(get_resource("dynamodb", "us-east-1"))
+    )
+    thread.start()
+    thread.join()
+
+    assert get_resource("dynamodb", "us-east-1") is dynamodb
+    assert other_thread[0] is not dynamodb
@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta, timezone
+
+from core import backfill
+from core.backfill import Backfill
+
+JOB_ID = "7f9010e3-f1b9-408a-8fbf-85fe20f8fd34"
+NOW = datetime(2020, 9, 1, tzinfo=timezone.utc)
+
+
+def test_cursor_walks_back_to_since():
+    cursor = Backfill.start(days=1, window_minutes=600, now=NOW)
+
+    windows = []
+    window = cursor.next_window()
+    while window:
+        windows.append(window)
+        cursor.advance(window)
+        window = cursor.next_window()
+
+    assert windows[0] == {"from": NOW - timedelta(hours=10), "to": NOW}
+    assert windows[-1] == {
+        "from": NOW - timedelta(days=1),
+        "to": NOW - timedelta(hours=20),
+    }
+    assert len(windows) == 3
+    assert cursor.state == backfill.DONE
+
+
+def test_backfill_round_trips_through_the_job_table(dynamo):
+    from core.registry import Job
+
+    job = Job.get(JOB_ID)
+    job.backfill = Backfill.start(days=30, window_minutes=15, now=NOW)
+
+    assert job.save_backfill()
+    assert Job.get(JOB_ID).backfill == job.backfill
+    assert [j.id for j in Job.with_active_backfill()] == [JOB_ID]
+
+
+def test_stale_cursors_are_not_saved(dynamo):
+    from dataclasses import replace
+    from core.registry import Job
+
+    job = Job.get(JOB_ID)
+    job.backfill = Backfill.start(days=30, window_minutes=15, now=NOW)
+    job.save_backfill()
+    other_worker = Job.get(JOB_ID)
+    expected = replace(job.backfill)
+
+    job.backfill.advance(job.backfill.next_window())
+    other_worker.backfill.advance(other_worker.backfill.next_window())
+
+    assert job.save_backfill(expected=expected)
+    assert not other_worker.save_backfill(expected=expected)
+
+
+def test_paused_and_resized_backfills_stop_workers(dynamo):
+    from dataclasses import replace
+    from core.registry import Job
+
+    job = Job.get(JOB_ID)
+    job.backfill = Backfill.start(days=30, window_minutes=15, now=NOW)
+    job.save_backfill()
+    worker = Job.get(JOB_ID)
+    expected = replace(worker.backfill)
+    worker.backfill.advance(worker.backfill.next_window())
+
+    assert backfill.pause(job)
+    assert not backfill.pause(job)
+    assert Job.with_active_backfill() == []
+    assert not worker.save_backfill(expected=expected)
+    assert backfill.resume(job)
+    assert [j.id for j in Job.with_active_backfill()] == [JOB_ID]
+    assert backfill.resize(job, 60)
+    assert not worker.save_backfill(expected=expected)
+    assert Job.get(JOB_ID).backfill == replace(expected, window_minutes=60)
+
+
+def test_backfills_are_leased_to_one_invocation(dynamo):
+    from core.registry import Job
+
+    job = Job.get(JOB_ID)
+    job.backfill = Backfill.start(days=30, window_minutes=15, now=NOW)
+    job.save_backfill()
+    first, second = Job.get(JOB_ID), Job.get(JOB_ID)
+
+    assert first.lease_backfill(NOW + timedelta(minutes=15), now=NOW)
+    assert not second.lease_backfill(NOW + timedelta(minutes=15), now=NOW)
+    # expired leases can be taken over
+    later = NOW + timedelta(minutes=20)
+    assert second.lease_backfill(later + timedelta(minutes=15), now=later)
+    assert not first.release_backfill()
+    assert second.release_backfill()
+    assert first.lease_backfill(NOW + timedelta(minutes=15), now=NOW)
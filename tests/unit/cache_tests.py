@@ -0,0 +1,39 @@
+from core.cache import TTLCache
+
+
+def test_entries_expire(mocker):
+    clock = mocker.patch("core.cache.time.monotonic", return_value=100)
+    cache = TTLCache(maxsize=10, ttl=5)
+    cache.set("a", 1)
+
+    assert cache.get("a") == 1
+    clock.return_value = 105
+    assert cache.get("a") is None
+
+
+def test_least_recently_used_are_evicted():
+    evicted = []
+    cache = TTLCache(maxsize=2, on_evict=evicted.append)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert evicted == [2]
+
+
+def test_sized_caches_are_bounded_by_the_size_of_their_values():
+    cache = TTLCache(maxsize=10, sizeof=len)
+    cache.set("a", b"1234")
+    cache.set("b", b"123456")
+    cache.set("c", b"12")
+
+    assert cache.get("a") is None
+    assert cache.get("b") == b"123456"
+    assert cache.size == 8
+    # values bigger than the whole cache aren't kept
+    cache.set("d", b"12345678901")
+    assert cache.get("d") is None
+    assert cache.size == 8
@@ -0,0 +1,29 @@
+import core.callables
+from core.callables import clear_callables, prewarm, prewarm_templates, resolve_callable
+
+
+def test_callables_are_imported_once(mocker):
+    from core.catalog import testing
+
+    clear_callables()
+    import_module = mocker.spy(core.callables.importlib, "import_module")
+
+    first = resolve_callable("testing.do_something")
+    second = resolve_callable("testing.do_something")
+
+    assert first is second is testing.do_something
+    assert import_module.call_count == 1
+
+
+def test_prewarm_reports_unresolvable_paths():
+    clear_callables()
+
+    assert prewarm(["testing.do_something", "testing.does_not_exist"]) == [
+        "testing.does_not_exist"
+    ]
+
+
+def test_prewarm_templates(dynamo):
+    clear_callables()
+
+    assert prewarm_templates() == []
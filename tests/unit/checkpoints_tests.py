@@ -0,0 +1,129 @@
+import io
+import json
+from datetime import datetime, timezone
+
+import pytest
+from botocore.exceptions import ClientError
+
+from core.checkpoints import Checkpoint
+from core.concurrency import DeadlineExceeded
+
+
+@pytest.fixture
+def s3_objects(mocker):
+    objects = {}
+
+    def get_object(Bucket, Key):
+        if Key not in objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        return {"Body": io.BytesIO(objects[Key])}
+
+    s3 = mocker.MagicMock()
+    s3.get_object.side_effect = get_object
+    s3.put_object.side_effect = lambda Bucket, Key, Body: objects.update({Key: Body})
+    s3.delete_object.side_effect = lambda Bucket, Key: objects.pop(Key)
+    mocker.patch("core.checkpoints.get_client", return_value=s3)
+    mocker.patch("core.checkpoints.CHECKPOINTS_BUCKET", "checkpoints")
+    return objects
+
+
+def test_states_are_committed_once_their_items_are_emitted(mocker):
+    store = mocker.MagicMock()
+    checkpoint = Checkpoint("key", store=store, interval=0)
+    items = checkpoint.iter_steps([([1, 2], {"done": 1}), ([3], {"done": 2})])
+
+    assert [next(items), next(items), next(items)] == [1, 2, 3]
+    checkpoint.commit(2)
+    checkpoint.commit(3)
+    assert list(items) == []
+    checkpoint.commit(3)
+
+    assert [c[0] for c in store.save.call_args_list] == [
+        ("key", {"done": 1}),
+        ("key", {"done": 2}),
+    ]
+
+
+def test_interrupted_extractions_resume_from_their_checkpoint(job, mocker, s3_objects):
+    from core.assembly import extraction_stage
+    from core.etl import Extract
+    from core.queues import get_in_memory_queues
+
+    def run_extraction_job(extract_job, checkpoint):
+        start = checkpoint.state.get("done", 0)
+        steps = (([{"i": i}], {"done": i + 1}) for i in range(start, 6))
+        return checkpoint.iter_steps(steps), datetime.now(timezone.utc)
+
+    mocker.patch("core.assembly.run_extraction_job", side_effect=run_extraction_job)
+    mocker.patch("core.etl.takes_argument", return_value=True)
+    mocker.patch("core.registry.Template.get", return_value=job.template)
+    queue = get_in_memory_queues().transform
+    deadline = mocker.MagicMock()
+    deadline.expired.side_effect = [False, False, False, True]
+
+    with pytest.raises(DeadlineExceeded):
+        extraction_stage(Extract(job), queue, deadline=deadline)
+
+    assert [json.loads(body) for body in s3_objects.values()] == [{"done": 3}]
+    assert queue.get().extracted_data == [{"i": i} for i in range(3)]
+    assert not job.save.called
+
+    assert extraction_stage(Extract(job), queue) == 3
+
+    assert queue.get().extracted_data == [{"i": i} for i in range(3, 6)]
+    assert s3_objects == {}
+    assert job.save.called
+
+
+def test_partitions_not_queued_are_not_committed(job, mocker, s3_objects):
+    from core import assembly
+    from core.assembly import extraction_stage
+    from core.etl import Extract, PutResult, QueuePutError
+
+    def run_extraction_job(extract_job, checkpoint):
+        steps = (([{"i": i}], {"done": i + 1}) for i in range(4))
+        return checkpoint.iter_steps(steps), datetime.now(timezone.utc)
+
+    mocker.patch("core.assembly.run_extraction_job", side_effect=run_extraction_job)
+    mocker.patch("core.etl.takes_argument", return_value=True)
+    # two items per partition
+    mocker.patch.object(
+        assembly.stream_transformation_jobs, "__defaults__", (2, 262144, None)
+    )
+    queue = mocker.MagicMock()
+    queue.put.side_effect = [None, QueuePutError([PutResult(job=mocker.MagicMock())])]
+
+    with pytest.raises(QueuePutError):
+        extraction_stage(
+            Extract(job),
+            queue,
+            deadline=mocker.MagicMock(**{"expired.return_value": False}),
+        )
+
+    # the first partition's last step completes once the next item is read
+    assert [json.loads(body) for body in s3_objects.values()] == [{"done": 1}]
+
+
+def test_extractions_without_checkpoints_dont_read_them(job, mocker):
+    from core.etl import Extract
+
+    store = mocker.patch("core.checkpoints.CheckpointStore")
+
+    checkpoint = Extract(job).open_checkpoint()
+    checkpoint.clear()
+    checkpoint.flush()
+
+    assert checkpoint.key is None
+    assert not store.called
+
+
+def test_checkpoints_missing_without_list_permission_are_quiet(mocker, s3_objects):
+    from core.checkpoints import CheckpointStore, logger
+
+    mocker.patch("core.checkpoints.get_client").return_value.get_object.side_effect = (
+        ClientError({"Error": {"Code": "AccessDenied"}}, "GetObject")
+    )
+    warning = mocker.spy(logger, "warning")
+
+    assert CheckpointStore().load("key") is None
+    assert not warning.called
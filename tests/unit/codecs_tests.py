@@ -0,0 +1,38 @@
+import json
+
+import pytest
+
+from core.codecs import decode_payload, encode_payload, is_envelope
+from core.compression import compress_payload
+
+PAYLOAD = {"job": {"_id": "jobid"}, "extracted_data": [{"foo": 1}, "bar", None]}
+
+
+def test_json_without_compression_stays_plain_json():
+    encoded = encode_payload(PAYLOAD)
+
+    assert not is_envelope(encoded)
+    assert json.loads(encoded) == PAYLOAD
+
+
+@pytest.mark.parametrize("compression", [None, "gzip"])
+@pytest.mark.parametrize("codec", ["json", "msgpack", "cbor"])
+def test_codecs_round_trip(codec, compression):
+    pytest.importorskip({"json": "json", "msgpack": "msgpack", "cbor": "cbor2"}[codec])
+
+    encoded = encode_payload(PAYLOAD, codec, compression)
+
+    assert decode_payload(encoded) == PAYLOAD
+    assert decode_payload(encoded.encode()) == PAYLOAD
+
+
+def test_decodes_first_version_compressed_bodies():
+    legacy = compress_payload(json.dumps(PAYLOAD), "gzip")
+
+    assert is_envelope(legacy)
+    assert decode_payload(legacy) == PAYLOAD
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        encode_payload(PAYLOAD, "pickle")
@@ -0,0 +1,77 @@
+import time
+from contextvars import ContextVar
+
+import pytest
+
+from core.concurrency import Deadline, DeadlineExceeded, bounded_map
+
+request_id: ContextVar = ContextVar("request_id", default=None)
+
+
+def test_outcomes_keep_the_order_and_errors_of_items():
+    def work(n):
+        time.sleep(0.01 * (5 - n))
+        if n == 2:
+            raise ValueError(n)
+        return n * 10
+
+    outcomes = bounded_map(work, range(5), max_workers=5)
+
+    assert [o.value for o in outcomes] == [0, 10, None, 30, 40]
+    assert [o.ok for o in outcomes] == [True, True, False, True, True]
+    assert isinstance(outcomes[2].error, ValueError)
+
+
+def test_calls_see_the_callers_context():
+    request_id.set("abc")
+
+    outcomes = bounded_map(lambda _: request_id.get(), range(3), max_workers=3)
+
+    assert [o.value for o in outcomes] == ["abc"] * 3
+
+
+def test_deadline_follows_the_lambda_context(mocker):
+    context = mocker.MagicMock()
+    context.get_remaining_time_in_millis.return_value = 5000
+    deadline = Deadline(context, reserve_ms=10000)
+
+    assert deadline.expired()
+    with pytest.raises(DeadlineExceeded):
+        deadline.check()
+    assert not Deadline().expired()
+
+
+def test_prefetch_keeps_order_and_raises_errors():
+    from core.concurrency import prefetch
+
+    def pages():
+        yield from ([1], [2], [3])
+        raise ValueError("page 4")
+
+    consumed = []
+    with pytest.raises(ValueError):
+        for item in prefetch(pages(), depth=2):
+            consumed.append(item)
+
+    assert consumed == [[1], [2], [3]]
+
+
+def test_closing_prefetch_stops_fetching():
+    import itertools
+    from core.concurrency import prefetch
+
+    fetched = []
+
+    def pages():
+        for n in itertools.count():
+            fetched.append(n)
+            yield n
+
+    prefetched = prefetch(pages(), depth=1)
+    assert next(prefetched) == 0
+    prefetched.close()
+    time.sleep(0.3)
+    stopped_at = len(fetched)
+    time.sleep(0.3)
+
+    assert len(fetched) == stopped_at <= 3
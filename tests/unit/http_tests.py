@@ -0,0 +1,97 @@
+import io
+
+import pytest
+import requests
+
+from core import metrics
+from core.http import ThrottledAdapter, retry_after, throttled_session
+
+
+def response(status, headers=None, body=b""):
+    r = requests.Response()
+    r.status_code = status
+    r.headers.update(headers or {})
+    r.raw = io.BytesIO(body)
+    return r
+
+
+@pytest.fixture
+def sleep(mocker):
+    return mocker.patch("core.http.time.sleep")
+
+
+def send(mocker, adapter, method, responses):
+    base_send = mocker.patch(
+        "requests.adapters.HTTPAdapter.send", side_effect=responses
+    )
+    request = requests.Request(method, "https://api.example.com/x").prepare()
+    return adapter.send(request), base_send
+
+
+def test_throttled_responses_are_retried_after_the_asked_delay(mocker, sleep):
+    adapter = ThrottledAdapter(max_attempts=3)
+
+    with metrics.record_stage("extraction", "jobid") as stage_metrics:
+        result, base_send = send(
+            mocker,
+            adapter,
+            "GET",
+            [response(429, {"Retry-After": "2"}), response(503), response(200)],
+        )
+
+    assert result.status_code == 200
+    assert base_send.call_count == 3
+    assert sleep.call_args_list[0] == mocker.call(2.0)
+    assert sleep.call_args_list[1][0][0] <= adapter.backoff * 2
+    assert (stage_metrics.api_calls, stage_metrics.api_retries) == (3, 2)
+    assert stage_metrics.api_throttled == 2
+
+
+def test_trustar_429_bodies_set_the_delay(mocker, sleep):
+    adapter = ThrottledAdapter(max_attempts=3)
+    throttled = response(429, body=b'{"waitTime": 12000, "message": "slow down"}')
+
+    result, base_send = send(mocker, adapter, "POST", [throttled, response(200)])
+
+    assert result.status_code == 200
+    assert sleep.call_args_list == [mocker.call(12.0)]
+
+
+def test_unavailable_responses_are_only_retried_for_idempotent_methods(
+    mocker, sleep
+):
+    adapter = ThrottledAdapter(max_attempts=3)
+
+    result, base_send = send(mocker, adapter, "POST", [response(502)])
+    assert result.status_code == 502
+    result, base_send = send(mocker, adapter, "POST", [response(503)])
+    assert result.status_code == 503
+    result, base_send = send(mocker, adapter, "GET", [response(502), response(200)])
+    assert result.status_code == 200
+
+
+def test_waits_longer_than_the_maximum_return_the_response(mocker, sleep):
+    adapter = ThrottledAdapter(max_wait=10)
+
+    result, base_send = send(
+        mocker, adapter, "GET", [response(429, {"Retry-After": "120"})]
+    )
+
+    assert result.status_code == 429
+    sleep.assert_not_called()
+
+
+def test_retry_after_accepts_http_dates():
+    assert retry_after(response(429, {"Retry-After": "3"})) == 3
+    assert retry_after(response(429, {"Retry-After": "Wed, 21 Oct 2015 07:28:00"})) == 0
+    assert retry_after(response(429)) is None
+
+
+def test_sessions_are_paced_per_api_key():
+    conf = {"rate_limit": {"rate": 10}}
+
+    first = throttled_session("key", conf).get_adapter("https://api.example.com")
+    second = throttled_session("key", conf).get_adapter("https://api.example.com")
+
+    assert first.bucket is second.bucket
+    assert first.bucket.rate == 10
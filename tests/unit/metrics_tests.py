@@ -0,0 +1,41 @@
+import json
+
+from core import metrics
+
+
+def test_record_stage_collects_counters_and_emits_emf(caplog):
+    metrics.clear_recorded()
+
+    with caplog.at_level("INFO", logger="metrics"):
+        with metrics.record_stage("extraction", "jobid") as stage_metrics:
+            stage_metrics.items = 3
+            metrics.add(metrics.API_CALLS)
+            metrics.add(metrics.API_CALLS, 2)
+    metrics.add(metrics.API_CALLS)  # outside any stage, ignored
+
+    recorded = metrics.get_recorded()
+    assert len(recorded) == 1
+    assert recorded[0].items == 3
+    assert recorded[0].api_calls == 3
+    assert recorded[0].duration >= 0
+
+    document = json.loads(caplog.records[-1].getMessage())
+    assert document["Stage"] == "extraction"
+    assert document["ApiCalls"] == 3
+    assert document["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == [["Stage"]]
+
+
+def test_transformation_stage_is_instrumented(job, mocker):
+    from core.assembly import transformation_stage
+    from core.etl import InMemoryQueue, Transform, Load
+
+    metrics.clear_recorded()
+    queue = InMemoryQueue(job_type=Load)
+
+    transformation_stage(Transform(job, ["foo", "bar"]), queue)
+
+    (recorded,) = metrics.get_recorded()
+    assert recorded.stage == "transformation"
+    assert recorded.items == 2
+    assert recorded.queue_hops == 1
+    assert recorded.payload_bytes > 0
@@ -0,0 +1,33 @@
+from trustar.models.numbered_page import NumberedPage
+
+from core.pages import iter_pages
+
+
+def page(number, items, has_next):
+    return NumberedPage(
+        items=items,
+        page_number=number,
+        page_size=2,
+        total_elements=5,
+        has_next=has_next,
+    )
+
+
+def test_pages_are_fetched_as_they_are_consumed(mocker):
+    fetch_page = mocker.MagicMock(
+        side_effect=[page(0, [1, 2], True), page(1, [3, 4], True), page(2, [], False)]
+    )
+
+    pages = iter_pages(fetch_page)
+
+    assert fetch_page.call_count == 0
+    assert next(pages) == [1, 2]
+    assert fetch_page.call_count == 1
+    assert list(pages) == [[3, 4]]
+    assert fetch_page.call_count == 3
+
+
+def test_pages_stop_when_there_are_no_more():
+    pages = iter_pages(lambda number: page(number, [number], number < 1))
+
+    assert list(pages) == [[0], [1]]
@@ -0,0 +1,142 @@
+import pytest
+
+from core.etl import QueuePutError, SqsQueue, Load
+
+
+def test_sqs_put_batches_jobs(job, sqs_queue_url, mocker):
+    queue = SqsQueue(sqs_queue_url, job_type=Load)
+    spy = mocker.spy(queue.sqs, "send_message_batch")
+    jobs = [Load(job, [{"foo": i}]) for i in range(25)]
+
+    results = queue.put(jobs)
+
+    assert spy.call_count == 3
+    assert [r.job for r in results] == jobs
+    assert all(r.ok and r.message_id for r in results)
+
+
+def test_sqs_pack_batches_honours_size_limit(job, sqs_queue_url):
+    queue = SqsQueue(sqs_queue_url, job_type=Load)
+    body = "x" * 100000
+    entries = [(str(i), body) for i in range(5)]
+
+    batches = queue.pack_batches(entries)
+
+    assert [len(b) for b in batches] == [2, 2, 1]
+
+
+def test_sqs_put_retries_only_failed_entries(job, sqs_queue_url, mocker):
+    sleep = mocker.patch("core.etl.time.sleep")
+    queue = SqsQueue(sqs_queue_url, job_type=Load)
+    jobs = [Load(job, [{"foo": i}]) for i in range(3)]
+    mocker.patch.object(
+        queue.sqs,
+        "send_message_batch",
+        side_effect=[
+            {
+                "Successful": [{"Id": "0", "MessageId": "a"}],
+                "Failed": [
+                    {"Id": "1", "SenderFault": False, "Code": "InternalError"},
+                    {"Id": "2", "SenderFault": True, "Code": "InvalidMessage"},
+                ],
+            },
+            {"Successful": [{"Id": "1", "MessageId": "b"}], "Failed": []},
+        ],
+    )
+
+    with pytest.raises(QueuePutError) as raised:
+        queue.put(jobs)
+
+    assert queue.sqs.send_message_batch.call_count == 2
+    assert sleep.call_count == 1
+    retried = queue.sqs.send_message_batch.call_args_list[1][1]["Entries"]
+    assert [e["Id"] for e in retried] == ["1"]
+    assert [r.job for r in raised.value.failed] == [jobs[2]]
+    assert "InvalidMessage" in str(raised.value)
+
+
+def test_sqs_get_many_receives_and_deletes_in_batches(job, sqs_queue_url, mocker):
+    queue = SqsQueue(sqs_queue_url, job_type=Load)
+    queue.put([Load(job, [{"foo": i}]) for i in range(15)])
+    mocker.patch("core.registry.Template.get", return_value=job.template)
+    delete_spy = mocker.spy(queue.sqs, "delete_message_batch")
+
+    jobs = queue.get_many(15)
+
+    assert len(jobs) == 15
+    assert all(isinstance(j, Load) for j in jobs)
+    assert delete_spy.call_count == 2
+    assert queue.get_many(10) == []
+
+
+def test_in_memory_get_many(job, mocker):
+    from core.etl import InMemoryQueue
+
+    mocker.patch("core.registry.Template.get", return_value=job.template)
+
+    queue = InMemoryQueue(job_type=Load)
+    queue.put([Load(job, [{"foo": i}]) for i in range(3)])
+
+    assert len(queue.get_many(2)) == 2
+    assert len(queue.get_many(2)) == 1
+    assert queue.get_many(2) == []
+
+
+def test_sqs_offloads_only_payloads_over_threshold(job, sqs_queue_url, mocker):
+    from moto import mock_s3
+    import boto3
+
+    with mock_s3():
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket="payloads")
+        queue = SqsQueue(
+            sqs_queue_url,
+            job_type=Load,
+            large_payload_bucket="payloads",
+            large_payload_threshold=1024,
+        )
+        queue.put([Load(job, ["small"]), Load(job, ["x" * 2048])])
+
+        offloaded = s3.list_objects_v2(Bucket="payloads").get("Contents", [])
+
+    assert len(offloaded) == 1
+    assert offloaded[0]["Size"] > 2048
+
+
+def test_sqs_compressed_bodies_round_trip(job, sqs_queue_url, mocker):
+    from core.codecs import is_envelope
+
+    mocker.patch("core.registry.Template.get", return_value=job.template)
+    queue = SqsQueue(sqs_queue_url, job_type=Load, compression="gzip")
+    queue.put([Load(job, ["foo", "bar"])])
+
+    message = queue.get_raw()["Messages"][0]
+    assert is_envelope(message["Body"])
+    assert queue.build_job(message["Body"]).transformed_data == ["foo", "bar"]
+
+
+def test_queues_dont_share_their_extended_client_settings(sqs_queue_url):
+    from core.aws import get_client
+
+    offloading = SqsQueue(
+        sqs_queue_url,
+        job_type=Load,
+        large_payload_bucket="payloads",
+        large_payload_threshold=1024,
+    )
+    plain = SqsQueue(sqs_queue_url, job_type=Load)
+
+    assert offloading.sqs.large_payload_support == "payloads"
+    assert offloading.sqs.message_size_threshold == 1024
+    assert plain.sqs is get_client("sqs")
+    assert getattr(plain.sqs, "large_payload_support", None) is None
+
+
+def test_thresholds_over_the_sqs_limit_are_rejected(sqs_queue_url):
+    with pytest.raises(ValueError, match="262144"):
+        SqsQueue(
+            sqs_queue_url,
+            job_type=Load,
+            large_payload_bucket="payloads",
+            large_payload_threshold=300000,
+        )
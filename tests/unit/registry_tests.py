@@ -6,3 +6,190 @@ from core.registry import Job
 def test_non_existant_job_configuration(dynamo):
     with pytest.raises(ValueError):
         Job.get(_id="this does not exists")
+
+
+def test_all_templates(dynamo):
+    from core.registry import Template
+
+    templates = Template.all()
+
+    assert len(templates) == 3
+    assert all(isinstance(t, Template) for t in templates)
+
+
+def test_templates_and_user_confs_are_cached(dynamo, mocker):
+    from core.registry import Template, UserConf
+
+    template_id = "5b132e9d-4d85-4845-804a-c54deb2bafa6"
+    user_conf_id = "2a87d9ac-e242-454d-9407-e5601ceb0519"
+    template = Template.get(template_id)
+    user_conf = UserConf.get(user_conf_id)
+    get_item = mocker.spy(Template._table, "get_item")
+
+    cached_template = Template.get(template_id)
+    cached_user_conf = UserConf.get(user_conf_id)
+    cached_user_conf.source_conf["timewindow"] = "mutated"
+
+    assert get_item.call_count == 0
+    assert cached_template.extract == template.extract
+    assert cached_user_conf is not user_conf
+    assert "timewindow" not in UserConf.get(user_conf_id).source_conf
+    assert "source_secrets" not in UserConf._cache.get(user_conf_id)
+
+
+def test_secrets_are_read_with_a_projection(dynamo, mocker):
+    from core.registry import UserConf
+
+    user_conf = UserConf.get("2a87d9ac-e242-454d-9407-e5601ceb0519")
+    get_item = mocker.spy(UserConf._table, "get_item")
+
+    secrets = user_conf.source_secrets
+
+    assert secrets == {"key": "moreseeecrecy"}
+    assert get_item.call_args[1]["ProjectionExpression"] == "#secrets"
+
+
+def test_secrets_cache_is_zeroed_when_cleared(dynamo, mocker):
+    from core.registry import UserConf
+    from core.cache import TTLCache
+    from core.registry import _zero_secrets
+
+    mocker.patch.object(
+        UserConf, "_secrets_cache", TTLCache(10, 5, on_evict=_zero_secrets)
+    )
+    user_conf = UserConf.get("2a87d9ac-e242-454d-9407-e5601ceb0519")
+    get_item = mocker.spy(UserConf._table, "get_item")
+
+    user_conf.source_secrets
+    user_conf.source_secrets
+    cached = UserConf._secrets_cache.get((user_conf.id, "source_secrets"))
+    UserConf.clear_secrets()
+
+    assert get_item.call_count == 1
+    assert cached == {}
+    assert len(UserConf._secrets_cache) == 0
+
+
+def test_jobs_are_resolved_in_batches(dynamo, mocker):
+    from core import database
+    from core.registry import Template, UserConf
+
+    batch_get_items = mocker.spy(database, "batch_get_items")
+    mocker.patch("core.registry.batch_get_items", batch_get_items)
+    ids = [
+        "7f9010e3-f1b9-408a-8fbf-85fe20f8fd34",
+        "6c7e83fd-9c22-45ff-829d-59c887917c6f",
+        "cbac3537-1917-446c-9232-8a027ad99139",
+        "this does not exists",
+    ]
+
+    jobs = Job.get_many(ids)
+
+    assert [j.id for j in jobs] == ids[:3]
+    assert batch_get_items.call_count == 2
+    assert all(isinstance(j._template, Template) for j in jobs)
+    assert all(isinstance(j._user_conf, UserConf) for j in jobs)
+    assert jobs[1].user_conf is not jobs[2].user_conf
+    assert "source_secrets" not in UserConf._cache.get(jobs[0].user_conf.id)
+
+
+def test_resolved_job_is_a_single_round_trip(dynamo, mocker):
+    from core import database
+
+    batch_get_items = mocker.spy(database, "batch_get_items")
+    mocker.patch("core.registry.batch_get_items", batch_get_items)
+
+    job = Job.get_resolved(
+        "7f9010e3-f1b9-408a-8fbf-85fe20f8fd34",
+        template_id="5b132e9d-4d85-4845-804a-c54deb2bafa6",
+        user_conf_id="2a87d9ac-e242-454d-9407-e5601ceb0519",
+    )
+
+    assert batch_get_items.call_count == 1
+    assert job.template.id == "5b132e9d-4d85-4845-804a-c54deb2bafa6"
+    assert job.user_conf.source_secrets == {"key": "moreseeecrecy"}
+    with pytest.raises(ValueError):
+        Job.get_resolved("this does not exists")
+
+
+def test_batch_get_items_retries_unprocessed_keys(mocker):
+    from core import database
+
+    connection = mocker.MagicMock()
+    connection.batch_get_item.side_effect = [
+        {
+            "Responses": {"table": [{"id": "1"}]},
+            "UnprocessedKeys": {"table": {"Keys": [{"id": "2"}]}},
+        },
+        {"Responses": {"table": [{"id": "2"}]}},
+    ]
+    mocker.patch.object(database, "get_dynamo_connection", return_value=connection)
+    mocker.patch("core.database.time.sleep")
+
+    items = database.batch_get_items({"table": {"Keys": [{"id": "1"}, {"id": "2"}]}})
+
+    assert items == {"table": [{"id": "1"}, {"id": "2"}]}
+    assert connection.batch_get_item.call_count == 2
+
+
+def test_save_never_moves_last_run_backwards(dynamo):
+    from datetime import datetime, timedelta, timezone
+
+    job_id = "7f9010e3-f1b9-408a-8fbf-85fe20f8fd34"
+    ahead = Job.get(job_id)
+    behind = Job.get(job_id)
+    now = datetime.now(timezone.utc)
+    ahead.last_run = now
+    behind.last_run = now - timedelta(minutes=5)
+
+    assert ahead.save()
+    assert not behind.save()
+    assert Job.get(job_id).last_run == now
+
+
+def test_coalesced_saves_write_the_latest_watermark_once(dynamo, mocker):
+    from datetime import datetime, timedelta, timezone
+    from core.registry import coalesced_saves
+
+    job_id = "7f9010e3-f1b9-408a-8fbf-85fe20f8fd34"
+    Job._setup_table()
+    mocker.patch.object(Job, "_setup_table")
+    update_item = mocker.spy(Job._table, "update_item")
+    now = datetime.now(timezone.utc)
+
+    with coalesced_saves():
+        for minutes in (3, 1, 2):
+            job = Job.get(job_id)
+            job.last_run = now - timedelta(minutes=minutes)
+            job.save()
+        assert update_item.call_count == 0
+
+    assert update_item.call_count == 1
+    assert Job.get(job_id).last_run == now - timedelta(minutes=1)
+
+
+def test_enclave_watermarks_are_saved_with_the_job(dynamo):
+    from datetime import datetime, timedelta, timezone
+    from core.registry import coalesced_saves
+
+    job_id = "7f9010e3-f1b9-408a-8fbf-85fe20f8fd34"
+    now = datetime.now(timezone.utc)
+
+    with coalesced_saves():
+        first = Job.get(job_id)
+        first.last_run = now
+        first.set_enclave_watermark("a", now)
+        first.save()
+        second = Job.get(job_id)
+        second.last_run = now - timedelta(minutes=1)
+        second.set_enclave_watermark("b", now - timedelta(minutes=1))
+        second.save()
+
+    assert Job.get(job_id).enclave_watermarks == {
+        "a": now,
+        "b": now - timedelta(minutes=1),
+    }
+    job = Job.get(job_id)
+    assert not job.save_enclave_watermark("a", now - timedelta(minutes=5))
+    assert Job.get(job_id).enclave_watermarks["a"] == now
+    assert Job.from_dict(job.to_dict()).enclave_watermarks == job.enclave_watermarks
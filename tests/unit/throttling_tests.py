@@ -0,0 +1,26 @@
+from core import throttling
+from core.throttling import TokenBucket
+
+
+def test_bucket_paces_calls_over_its_capacity(mocker):
+    now = [100.0]
+    clock = mocker.patch("core.throttling.time")
+    clock.monotonic.side_effect = lambda: now[0]
+    clock.sleep.side_effect = lambda seconds: now.__setitem__(0, now[0] + seconds)
+    bucket = TokenBucket(rate=2, capacity=2)
+
+    waits = [bucket.acquire() for _ in range(3)]
+
+    assert waits == [0, 0, 0.5]
+    clock.sleep.assert_called_once_with(0.5)
+
+
+def test_bucket_comes_from_the_conf():
+    throttling.clear_buckets()
+    conf = {"rate_limit": {"rate": 5, "burst": 10}}
+
+    bucket = throttling.bucket_from_conf("key", conf)
+
+    assert (bucket.rate, bucket.capacity) == (5, 10)
+    assert throttling.bucket_from_conf("key", conf) is bucket
+    assert throttling.bucket_from_conf("key", {}) is None
@@ -1,28 +1,21 @@
 from datetime import datetime, timedelta, timezone
 
 import pytest
+from trustar import datetime_to_millis
 from trustar.models.numbered_page import NumberedPage
 
+from core.etl import Extract
 from core.catalog.misp_automated.trustar.extraction import (
+    IndicatorEnricher,
     StationExtractor,
+    pull_enclaves_iocs,
     pull_reports,
 )
 
 
-def test_get_reports_30_days_time_window(trustar_extraction_job, mocker):
-    from trustar.models import NumberedPage
-
-    trustar_extraction_job.last_run = datetime(2020, 8, 1, 0, 0, 0, 0, timezone.utc)
-    mocker.patch(
-        "trustar.TruStar.search_reports_page",
-        return_value=NumberedPage(
-            items=[i for i in range(0, 100)],
-            page_number=0,
-            page_size=100,
-            total_elements=50000,
-            has_next=True,
-        ),
-    )
+def test_windows_after_a_long_pause_are_capped(trustar_extraction_job, mocker):
+    last_run = datetime(2020, 8, 1, 0, 0, 0, 0, timezone.utc)
+    trustar_extraction_job.last_run = last_run
     mocker.patch(
         (
             "core.catalog.misp_automated.trustar"
@@ -31,13 +24,11 @@ def test_get_reports_30_days_time_window(trustar_extraction_job, mocker):
         return_value=datetime(2020, 8, 31, 23, 59, 59, 0, timezone.utc),
     )
     extractor = StationExtractor(trustar_extraction_job)
-    reports = extractor.get_reports()
-    assert len(reports) == 10000
 
+    assert extractor.get_window() == (last_run, last_run + StationExtractor.TIME_DELTA)
 
-def test_get_reports_30_minutes_time_window(trustar_extraction_job, mocker):
-    from trustar.models import NumberedPage
 
+def test_get_report_summaries_of_a_quiet_window(trustar_extraction_job, mocker):
     trustar_extraction_job.last_run = datetime(2020, 8, 31, 23, 10, 59, 0, timezone.utc)
     mocker.patch(
         "trustar.TruStar.search_reports_page",
@@ -57,7 +48,7 @@ def test_get_reports_30_minutes_time_window(trustar_extraction_job, mocker):
         return_value=datetime(2020, 8, 31, 23, 40, 59, 0, timezone.utc),
     )
     extractor = StationExtractor(trustar_extraction_job)
-    reports = extractor.get_reports()
+    reports = extractor.get_report_summaries(*extractor.get_window())
     assert len(reports) == 24
 
 
@@ -74,23 +65,228 @@ def test_pull_reports(trustar_extraction_job, mocker):
     assert len(results) <= 10
 
 
-def test_pull_reports_with_timewindow(trustar_extraction_job, mocker):
+def test_busy_timewindows_are_split_rather_than_truncated(
+    trustar_extraction_job, mocker
+):
     to = datetime(2020, 10, 30, 23, 59, 59, 0, timezone.utc)
     since = to - timedelta(minutes=15)
     trustar_extraction_job.user_conf.source_conf["timewindow"] = {
         "from": since,
         "to": to,
     }
-    mocker.patch(
-        "trustar.TruStar.search_reports_page",
-        return_value=NumberedPage(
+
+    def search_reports_page(from_time, to_time, page_number, **kwargs):
+        busy = to_time - from_time == datetime_to_millis(to) - datetime_to_millis(since)
+        return NumberedPage(
             items=[i for i in range(0, 100)],
-            page_number=0,
+            page_number=page_number,
             page_size=100,
-            total_elements=50000,
-            has_next=True,
-        ),
+            total_elements=50000 if busy else 100,
+            has_next=busy,
+        )
+
+    mocker.patch("trustar.TruStar.search_reports_page", side_effect=search_reports_page)
+    extractor = StationExtractor(trustar_extraction_job)
+
+    assert extractor.get_window() == (since, to)
+    assert len(extractor.get_report_summaries(since, to)) == 200
+
+
+def test_pull_reports_keeps_order_and_isolates_errors(trustar_extraction_job, mocker):
+    extractor = "core.catalog.misp_automated.trustar.extraction.StationExtractor"
+    reports = [mocker.MagicMock(id=str(i)) for i in range(20)]
+    for report in reports:
+        report.to_dict.return_value = {"id": report.id}
+    to = datetime(2020, 10, 30, tzinfo=timezone.utc)
+    mocker.patch(f"{extractor}.get_window", return_value=(to - timedelta(1), to))
+    mocker.patch(f"{extractor}.get_report_summaries", return_value=reports)
+    mocker.patch(f"{extractor}.get_report_details", side_effect=lambda r: r)
+    mocker.patch(f"{extractor}.is_report_fully_processed", return_value=True)
+    mocker.patch(f"{extractor}.get_enclave_tags", return_value=[])
+    mocker.patch(
+        f"{extractor}.get_indicators_for_report",
+        side_effect=lambda r: 1 / 0 if r.id == "7" else [],
     )
+    mocker.patch(f"{extractor}.request_iocs_metadata", return_value=[])
+    trustar_extraction_job.user_conf.source_conf["max_in_flight"] = 4
+
+    results, _ = pull_reports(trustar_extraction_job)
+
+    assert [r["report"]["id"] for r in results] == [str(i) for i in range(20) if i != 7]
+
+
+def test_indicator_metadata_is_deduped_chunked_and_cached(
+    trustar_extraction_job, mocker
+):
+    from trustar import Indicator
+
+    requested = []
+
+    def metadata(iocs):
+        requested.append([i.value for i in iocs])
+        if "bad.com" in requested[-1]:
+            raise ValueError("boom")
+        return [Indicator(value=i.value, type=None, sightings=3) for i in iocs]
+
     extractor = StationExtractor(trustar_extraction_job)
-    reports = extractor.get_reports()
-    assert len(reports) <= StationExtractor.MAX_REPORT_COUNT
+    mocker.patch.object(extractor, "request_iocs_metadata", side_effect=metadata)
+    enricher = IndicatorEnricher(extractor, chunk_size=2)
+    first = [Indicator(value=v, type="URL") for v in ("a.com", "b.com", "c.com")]
+    second = [Indicator(value=v, type="URL") for v in ("b.com", "bad.com")]
+
+    enricher.load(first + second)
+    enricher.load(first)
+
+    assert sorted(requested) == [["a.com", "b.com"], ["c.com", "bad.com"]]
+    assert [i.sightings for i in enricher.enrich(first)] == [3, 3, None]
+    assert enricher.enrich(second)[1] is second[1]
+
+
+def test_enclaves_resume_from_their_own_watermark(trustar_extraction_job, mocker):
+    from trustar import EnclavePermissions, Indicator
+
+    from core.catalog.misp_automated.trustar import extraction
+
+    extraction._enclaves.clear()
+    enclave_ids = trustar_extraction_job.user_conf.source_conf["enclave_ids"]
+    enclaves = [EnclavePermissions(id=i, name=i) for i in enclave_ids + ["other"]]
+    get_user_enclaves = mocker.patch(
+        "trustar.TruStar.get_user_enclaves", return_value=enclaves
+    )
+    last_run = trustar_extraction_job.last_run
+    watermark = last_run + timedelta(minutes=1)
+    trustar_extraction_job.enclave_watermarks[enclave_ids[1]] = watermark
+    searched = []
+
+    def search_indicators(**kwargs):
+        enclave_id = kwargs["enclave_ids"][0]
+        assert enclave_id != "other"
+        searched.append((enclave_id, kwargs["from_time"]))
+        if enclave_id == enclave_ids[0]:
+            raise ValueError("boom")
+        return [Indicator(value="a.com", type="URL")]
+
+    mocker.patch("trustar.TruStar.search_indicators", side_effect=search_indicators)
+
+    results, to = pull_enclaves_iocs(trustar_extraction_job)
+    Extract(trustar_extraction_job).update_extraction_datetime(to)
+    searched.clear()
+    pull_enclaves_iocs(trustar_extraction_job)
+    searched = dict(searched)
+
+    assert [r["enclave"]["id"] for r in results] == enclave_ids[1:]
+    assert trustar_extraction_job.last_run == to
+    assert searched[enclave_ids[1]] > datetime_to_millis(watermark)
+    # the failing enclave is still searched from the first run's last run
+    assert searched[enclave_ids[0]] == datetime_to_millis(last_run)
+    assert trustar_extraction_job.enclave_watermarks[enclave_ids[0]] == last_run
+    assert get_user_enclaves.call_count == 1
+
+
+def test_trustar_calls_go_through_the_throttled_session(mocker):
+    from core.catalog.misp_automated.trustar.client import build_client
+
+    client = build_client({"user_api_key": "key", "user_api_secret": "secret"})
+    mocker.patch.object(client._client, "_get_token", return_value="token")
+    request = mocker.patch.object(client._client.session, "request")
+    request.return_value.status_code = 200
+
+    client._client.request("GET", "reports")
+
+    assert request.call_args[1]["url"].endswith("/reports")
+    adapter = client._client.session.get_adapter("https://api.trustar.co")
+    assert adapter.__class__.__name__ == "ThrottledAdapter"
+
+
+def test_clients_are_pooled_without_writing_secrets_to_the_conf(
+    trustar_extraction_job,
+):
+    from core.catalog.misp_automated.trustar.client import clear_clients
+
+    clear_clients()
+    source_conf = trustar_extraction_job.user_conf.source_conf
+    before = dict(source_conf)
+
+    first = StationExtractor(trustar_extraction_job)
+    source_conf["timewindow"] = {"from": "a", "to": "b"}
+    second = StationExtractor(trustar_extraction_job)
+    source_conf["max_in_flight"] = 2
+    third = StationExtractor(trustar_extraction_job)
+
+    assert first.client is second.client
+    assert third.client is not first.client
+    assert "api_key" not in source_conf
+    assert {k: source_conf[k] for k in before} == before
+
+
+def test_expired_tokens_are_refreshed_once_through_the_session(mocker):
+    from core.catalog.misp_automated.trustar.client import build_client
+
+    client = build_client({"user_api_key": "key", "user_api_secret": "secret"})
+    api_client = client._client
+    post = mocker.patch.object(api_client.session, "post")
+    post.return_value.status_code = 200
+    post.return_value.json.return_value = {"access_token": "new"}
+    api_client.token = "expired"
+
+    api_client._refresh_token()
+
+    assert api_client.token == "new"
+    assert post.call_args[0][0] == api_client.auth
+    # another thread refreshes the token while this one waits for the lock
+    lock = mocker.MagicMock()
+    lock.__enter__.side_effect = lambda *_: setattr(api_client, "token", "newer")
+    api_client._token_lock = lock
+
+    api_client._refresh_token()
+
+    assert api_client.token == "newer"
+    assert post.call_count == 1
+
+
+def test_unchanged_report_details_are_not_requested_again(
+    trustar_extraction_job, mocker
+):
+    import io
+
+    from botocore.exceptions import ClientError
+    from trustar import Report
+
+    from core.catalog.misp_automated.trustar.details import report_details
+
+    objects = {}
+
+    def get_object(Bucket, Key):
+        if Key not in objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        return {"Body": io.BytesIO(objects[Key])}
+
+    s3 = mocker.MagicMock()
+    s3.get_object.side_effect = get_object
+    s3.put_object.side_effect = lambda Bucket, Key, Body: objects.update({Key: Body})
+    mocker.patch(
+        "core.catalog.misp_automated.trustar.details.get_client", return_value=s3
+    )
+    mocker.patch.object(report_details, "bucket", "details")
+    details = mocker.patch(
+        "trustar.TruStar.get_report_details",
+        side_effect=lambda _id: Report(id=_id, body="details", updated=1),
+    )
+    report_details.clear()
+    extractor = StationExtractor(trustar_extraction_job)
+
+    extractor.get_report_details(Report(id="a", updated=1))
+    extractor.get_report_details(Report(id="a", updated=1))
+    # a fresh container only has the bucket
+    report_details.clear()
+    cached = extractor.get_report_details(Report(id="a", updated=1))
+    extractor.get_report_details(Report(id="a", updated=2))
+    extractor.get_report_details(Report(id="b"))
+    extractor.get_report_details(Report(id="b"))
+
+    assert cached.body == "details"
+    assert [c[0][0] for c in details.call_args_list] == ["a", "a", "b", "b"]
+    assert list(objects) == [
+        "report-details/userconfid/a/1.json",
+        "report-details/userconfid/a/2.json",
+    ]
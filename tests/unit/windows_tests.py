@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta, timezone
+
+from core.windows import RESOLUTION, WindowPlanner, bisect, pull_bisecting
+
+SINCE = datetime(2020, 9, 1, tzinfo=timezone.utc)
+
+
+def test_planner_widens_quiet_windows_and_shrinks_busy_ones():
+    planner = WindowPlanner(min_minutes=1, max_minutes=60, target_items=100)
+
+    assert planner.next_minutes(15, 0) == 30
+    assert planner.next_minutes(15, 100) == 15
+    assert planner.next_minutes(15, 1000) == 7
+    assert planner.next_minutes(40, 0) == 60
+    assert planner.next_minutes(1, 1000) == 1
+
+
+def test_windows_reaching_the_cap_are_bisected():
+    # one item per minute, windows include both of their bounds
+    items = [SINCE + timedelta(minutes=i) for i in range(33)]
+    calls = []
+
+    def pull(since, to):
+        calls.append((since, to))
+        return [item for item in items if since <= item <= to][:10]
+
+    results = pull_bisecting(pull, SINCE, SINCE + timedelta(minutes=32), cap=10)
+
+    assert results == items
+    assert min(to - since for since, to in calls) < timedelta(minutes=8)
+
+
+def test_windows_expected_to_reach_the_cap_are_split_before_pulling():
+    items = [SINCE + timedelta(minutes=i) for i in range(32)]
+    pulled = []
+
+    def pull(since, to):
+        found = [item for item in items if since <= item <= to][:10]
+        pulled.extend(found)
+        return found
+
+    results = pull_bisecting(
+        pull, SINCE, SINCE + timedelta(minutes=32), cap=10, expected=32
+    )
+
+    assert results == items
+    assert pulled == items
+
+
+def test_windows_are_not_bisected_below_the_minimum(mocker):
+    pull = mocker.MagicMock(return_value=list(range(10)))
+
+    results = pull_bisecting(
+        pull, SINCE, SINCE + timedelta(minutes=1), cap=10, min_window=timedelta(1)
+    )
+
+    assert len(results) == 10
+    assert pull.call_count == 1
+
+
+def test_halves_dont_share_their_middle():
+    first, second = bisect(SINCE, SINCE + timedelta(minutes=1))
+
+    assert first == {"from": SINCE, "to": SINCE + timedelta(seconds=30) - RESOLUTION}
+    assert second == {
+        "from": SINCE + timedelta(seconds=30),
+        "to": SINCE + timedelta(minutes=1),
+    }